@@ -0,0 +1,39 @@
+"""Tests of TousAnalysis._track_lossrate."""
+import types
+
+import pytest
+
+_np = pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+pytest.importorskip("pyaccel")
+
+from touschek_pack.tous_analysis import TousAnalysis  # noqa: E402
+
+
+def _analysis(nelem=10):
+    """TousAnalysis with only the s positions set."""
+    ana = TousAnalysis.__new__(TousAnalysis)
+    ana._optics = types.SimpleNamespace(spos=_np.arange(nelem, dtype=float))
+    return ana
+
+
+def test_no_particle_lost():
+    """A position losing no particles gives empty results."""
+    dic = {
+        "element_lost": _np.array([], dtype=int),
+        "energy_deviation": _np.array([]),
+    }
+    lost_pos, part_prob = _analysis()._track_lossrate(dic)
+    assert lost_pos.size == 0
+    assert part_prob.size == 0
+
+
+def test_lost_particles_sum():
+    """Loss probabilities add up to the fraction of lost particles."""
+    dic = {
+        "element_lost": _np.array([2, 2, 5, 7]),
+        "energy_deviation": _np.array([0.01, 0.03, 0.05, 0.08]),
+    }
+    lost_pos, part_prob = _analysis()._track_lossrate(dic)
+    assert list(lost_pos) == [2.0, 5.0, 7.0]
+    assert part_prob.sum() == pytest.approx(1.0)
@@ -0,0 +1,4 @@
+"""Entry point of python -m touschek_pack."""
+from touschek_pack.cli import main
+
+main()
@@ -0,0 +1,433 @@
+"""Benchmarks of touschek_pack hot paths.
+
+Run with ``python -m touschek_pack.benchmarks``. Every benchmark runs
+offline on the pymodels SI lattice and/or a small synthetic FODO ring,
+with sizes given on the command line. Results can be saved as a JSON
+baseline and later compared with it to flag slowdowns::
+
+    python -m touschek_pack.benchmarks --save base.json
+    python -m touschek_pack.benchmarks --compare base.json --tolerance 0.2
+"""
+import argparse as _argparse
+import json as _json
+import platform as _platform
+import statistics as _statistics
+import subprocess as _subprocess
+import sys as _sys
+import time as _time
+
+import numpy as _np
+import pyaccel as _pyaccel
+from pyaccel.lattice import get_attribute
+
+import touschek_pack.functions as to_fu
+from touschek_pack.model_state import ModelState
+from touschek_pack.tous_analysis import TousAnalysis
+
+# modules the compute API must not import by itself
+HEAVY_MODULES = ("pandas", "pymodels", "touschek_pack.plotting")
+
+DEFAULT_SIZES = {
+    "ncells": 16,  # cells of the synthetic ring
+    "noffsets": 20,  # energy offsets of calc_amp
+    "nparticles": 40,  # tracked particles
+    "nturns": 3,
+    "npositions": 3,  # scattering positions
+    "ndensity": 1000,  # points of the analytical densities
+    "num_part": 2000,  # Monte-Carlo particles per position
+}
+
+LATTICES = ("si", "synthetic")
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"time": dt, "heavy": heavy}}))
+"""
+
+
+def bench_cold_import(module="touschek_pack.functions", repeat=5):
+    """Measures the cold import time of a module in fresh interpreters.
+
+    module = module to be imported.
+    repeat =   number of interpreters started (the minimum is kept).
+
+    Returns the best import time in seconds and the heavy modules that
+    were imported as a side effect.
+    """
+    script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    best, heavy = float("inf"), []
+    for _ in range(repeat):
+        out = _subprocess.run(
+            [_sys.executable, "-c", script],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        res = _json.loads(out.stdout.strip().splitlines()[-1])
+        best = min(best, res["time"])
+        heavy = res["heavy"]
+    return best, heavy
+
+
+def check_cold_import(budget, modules=None, repeat=5):
+    """Asserts the cold import time of the compute API.
+
+    budget  = maximum import time in seconds.
+    modules =   modules of the compute API (None: default ones).
+    """
+    modules = modules or (
+        "touschek_pack.functions",
+        "touschek_pack.tous_analysis",
+    )
+    results = {}
+    for module in modules:
+        dt, heavy = bench_cold_import(module, repeat)
+        results[module] = {"time": dt, "heavy": heavy}
+        assert not heavy, f"{module} imports {heavy}"
+        assert dt < budget, f"{module} took {dt:.3f} s > {budget:.3f} s"
+    return results
+
+
+def synthetic_ring(ncells=16, energy=3e9):
+    """Small FODO ring with an RF cavity, used as a cheap test lattice.
+
+    ncells = number of FODO cells.
+    energy =      beam energy [eV].
+    """
+    ele = _pyaccel.elements
+    angle = 2 * _np.pi / (2 * ncells)
+    cell = [
+        ele.quadrupole("QF", 0.25, 1.2),
+        ele.drift("D", 0.5),
+        ele.sextupole("SF", 0.1, 0.0),
+        ele.drift("D", 0.2),
+        ele.rbend("B", 1.0, angle, angle / 2, angle / 2),
+        ele.drift("D", 0.5),
+        ele.quadrupole("QD", 0.25, -1.2),
+        ele.drift("D", 0.5),
+        ele.sextupole("SD", 0.1, 0.0),
+        ele.drift("D", 0.2),
+        ele.rbend("B", 1.0, angle, angle / 2, angle / 2),
+        ele.drift("D", 0.5),
+    ]
+    lattice = [ele.marker("start")] + cell * ncells
+    circumference = sum(elem.length for elem in lattice)
+    harmonic_number = 2 * ncells
+    freq = harmonic_number * 299792458 / circumference
+    lattice.append(ele.rfcavity("cav", 0, 1.0e6, freq))
+
+    acc = _pyaccel.accelerator.Accelerator(
+        lattice=lattice,
+        energy=energy,
+        harmonic_number=harmonic_number,
+        cavity_on=False,
+        radiation_on=False,
+        vchamber_on=False,
+    )
+    for elem in acc:
+        elem.hmin, elem.hmax = -12e-3, 12e-3
+        elem.vmin, elem.vmax = -4e-3, 4e-3
+    return acc
+
+
+class _Context:
+    """Lattice and derived quantities shared by the benchmarks."""
+    def __init__(self, lattice, sizes):
+        """."""
+        self.name = lattice
+        self.sizes = sizes
+        if lattice == "si":
+            import pymodels
+
+            self.model = pymodels.si.create_accelerator()
+        else:
+            self.model = synthetic_ring(sizes["ncells"])
+        self._accep = None
+
+    def flagged(self, **flags):
+        """Copy of the model with the given flags."""
+        return ModelState(self.model, **flags).copy()
+
+    @property
+    def accep(self):
+        """."""
+        if self._accep is None:
+            self._accep = _pyaccel.optics.calc_touschek_energy_acceptance(
+                self.model
+            )
+        return self._accep
+
+    def positions(self):
+        """Scattering positions spread along the ring."""
+        spos = _pyaccel.lattice.find_spos(self.model, indices="closed")
+        return _np.linspace(0, spos[-1], self.sizes["npositions"] + 2)[1:-1]
+
+
+BENCHMARKS = {}
+
+
+def _benchmark(*lattices):
+    """Registers a benchmark for the given lattices."""
+
+    def deco(func):
+        BENCHMARKS[func.__name__[len("bench_"):]] = (func, lattices)
+        return func
+
+    return deco
+
+
+@_benchmark("si", "synthetic")
+def bench_calc_amp(ctx):
+    """."""
+    model = ctx.flagged(cavity_on=False, radiation_on=False)
+    offsets = _np.linspace(0, 0.04, ctx.sizes["noffsets"])
+    hmax = get_attribute(model, "hmax", indices="closed")
+    hmin = get_attribute(model, "hmin", indices="closed")
+    return lambda: to_fu.calc_amp(model, offsets, hmax, hmin)
+
+
+@_benchmark("si", "synthetic")
+def bench_calc_amp_fast(ctx):
+    """."""
+    model = ctx.flagged(cavity_on=False, radiation_on=False)
+    offsets = _np.linspace(0, 0.04, ctx.sizes["noffsets"])
+    hmax = get_attribute(model, "hmax", indices="closed")
+    hmin = get_attribute(model, "hmin", indices="closed")
+    return lambda: to_fu.calc_amp_fast(model, offsets, hmax, hmin)
+
+
+@_benchmark("si", "synthetic")
+def bench_track_eletrons_d(ctx):
+    """."""
+    model = ctx.flagged(cavity_on=True, radiation_on=True, vchamber_on=True)
+    deltas = _np.linspace(0, 0.05, ctx.sizes["nparticles"])
+    index = len(model) // 3
+    nturns = ctx.sizes["nturns"]
+    return lambda: to_fu.track_eletrons_d(deltas, nturns, index, model)
+
+
+@_benchmark("si", "synthetic")
+def bench_norm_cutacp(ctx):
+    """."""
+    accep, lsps = ctx.accep, ctx.positions()
+    npt = ctx.sizes["ndensity"]
+    return lambda: to_fu.norm_cutacp(ctx.model, lsps, npt, accep)
+
+
+@_benchmark("si", "synthetic")
+def bench_f_function_arg_mod(ctx):
+    """."""
+    kappam = 0.02
+    kappa = _np.linspace(kappam, _np.pi / 2, ctx.sizes["ndensity"])
+    return lambda: to_fu.f_function_arg_mod(kappa, kappam, 20.0, 5.0, False)
+
+
+@_benchmark("si")
+def bench_scatter_particles(ctx):
+    """create_particles followed by scatter_particles."""
+    env = _pyaccel.optics.calc_beamenvelope(ctx.model, indices=[0])[0]
+    num_part = ctx.sizes["num_part"]
+
+    def run():
+        part1, part2 = to_fu.create_particles(env, num_part)
+        return to_fu.scatter_particles(part1, part2, 1e-4)
+
+    return run
+
+
+@_benchmark("si")
+def bench_histgms(ctx):
+    """."""
+    accep, l_spos = ctx.accep, ctx.positions()
+    num_part = ctx.sizes["num_part"]
+    return lambda: to_fu.histgms(
+        ctx.model, l_spos, num_part, accep, 1e-4, cutaccep=False
+    )
+
+
+def _analysis(ctx):
+    """TousAnalysis with the benchmark sizes."""
+    ana = TousAnalysis(ctx.model, n_turns=ctx.sizes["nturns"])
+    ana._deltas = _np.linspace(0, 0.05, ctx.sizes["nparticles"])
+    return ana
+
+
+def _uncached(ana, func):
+    """Runs func with an empty tracking cache, so every run tracks."""
+
+    def run():
+        ana.track_cache.clear()
+        return func()
+
+    return run
+
+
+@_benchmark("si")
+def bench_concat_track_lossrate(ctx):
+    """."""
+    ana, l_spos = _analysis(ctx), ctx.positions()
+    return _uncached(
+        ana, lambda: ana._concat_track_lossrate(l_spos, False, None)
+    )
+
+
+@_benchmark("si")
+def bench_concat_track_lossrate_cached(ctx):
+    """_concat_track_lossrate when every tracking is a cache hit."""
+    ana, l_spos = _analysis(ctx), ctx.positions()
+    ana._concat_track_lossrate(l_spos, False, None)  # fills the cache
+    return lambda: ana._concat_track_lossrate(l_spos, False, None)
+
+
+@_benchmark("si")
+def bench_get_scat_dict(ctx):
+    """_f_scat_table followed by the reordering of get_scat_dict."""
+    ana, l_spos = _analysis(ctx), ctx.positions()
+    return _uncached(
+        ana,
+        lambda: ana.get_scat_dict(l_spos, "lost_positions", False, None),
+    )
+
+
+def _timeit(func, repeat):
+    """Runs func repeat times and returns the timings statistics."""
+    times = []
+    for _ in range(repeat):
+        t0 = _time.perf_counter()
+        func()
+        times.append(_time.perf_counter() - t0)
+    return {
+        "min": min(times),
+        "median": _statistics.median(times),
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(names=None, lattices=LATTICES, sizes=None, repeat=3):
+    """Runs the benchmarks and returns their timings.
+
+    names    =     benchmarks to run (None: all of them).
+    lattices =            lattices to run the benchmarks on.
+    sizes    = problem sizes updating DEFAULT_SIZES.
+    repeat   =           number of timed runs of each benchmark.
+
+    Benchmarks that fail are reported with the error instead of timings.
+    """
+    sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+    names = names or list(BENCHMARKS)
+    results = {}
+    for lattice in lattices:
+        ctx = None
+        for name in names:
+            func, supported = BENCHMARKS[name]
+            if lattice not in supported:
+                continue
+            key = f"{name}[{lattice}]"
+            try:
+                ctx = ctx or _Context(lattice, sizes)
+                to_fu.set_random_seed(0)
+                results[key] = _timeit(func(ctx), repeat)
+            except Exception as err:  # report and go on with the others
+                results[key] = {"error": f"{type(err).__name__}: {err}"}
+    return {"meta": _metadata(sizes), "results": results}
+
+
+def _metadata(sizes):
+    """."""
+    return {
+        "python": _platform.python_version(),
+        "numpy": _np.__version__,
+        "machine": _platform.machine(),
+        "sizes": sizes,
+    }
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Flags the benchmarks slower than the baseline.
+
+    current   =                      output of run_benchmarks.
+    baseline  = output of run_benchmarks saved as JSON baseline.
+    tolerance =     relative slowdown accepted before flagging.
+
+    Returns a dict of flagged benchmarks with their ratio to the baseline.
+    """
+    if current["meta"]["sizes"] != baseline["meta"]["sizes"]:
+        raise ValueError("baseline was run with other sizes")
+    flagged = {}
+    for key, res in current["results"].items():
+        base = baseline["results"].get(key)
+        if base is None or "min" not in base or "min" not in res:
+            continue
+        ratio = res["min"] / base["min"]
+        if ratio > 1 + tolerance:
+            flagged[key] = ratio
+    return flagged
+
+
+def _print_table(results, baseline=None):
+    """."""
+    for key, res in results["results"].items():
+        if "min" not in res:
+            print(f"{key:40s} {res['error']}")
+            continue
+        line = f"{key:40s} {res['min']*1e3:12.2f} ms"
+        base = (baseline or {}).get("results", {}).get(key, {})
+        if "min" in base:
+            line += f"  x{res['min'] / base['min']:.2f}"
+        print(line)
+
+
+def main(argv=None):
+    """."""
+    parser = _argparse.ArgumentParser(
+        prog="python -m touschek_pack.benchmarks"
+    )
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--lattice", nargs="+", choices=LATTICES)
+    parser.add_argument("--repeat", type=int, default=3)
+    for size, value in DEFAULT_SIZES.items():
+        parser.add_argument(f"--{size}", type=int, default=value)
+    parser.add_argument("--save", help="writes the results as a baseline")
+    parser.add_argument("--compare", help="baseline to check regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=None,
+        help="asserts the cold import time of the compute API [s]",
+    )
+    args = parser.parse_args(argv)
+
+    if args.import_budget is not None:
+        res = check_cold_import(args.import_budget)
+        print(_json.dumps(res, indent=2))
+
+    sizes = {size: getattr(args, size) for size in DEFAULT_SIZES}
+    results = run_benchmarks(
+        args.only, args.lattice or LATTICES, sizes, args.repeat
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as fil:
+            baseline = _json.load(fil)
+    _print_table(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as fil:
+            _json.dump(results, fil, indent=2)
+
+    if baseline is not None:
+        flagged = compare(results, baseline, args.tolerance)
+        for key, ratio in flagged.items():
+            print(f"SLOWDOWN {key}: x{ratio:.2f}")
+        if flagged:
+            _sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Checkpoint store for the tracking of long loss-map runs."""
+import hashlib as _hashlib
+import os as _os
+
+import numpy as _np
+
+from touschek_pack import compact as _cmp
+from touschek_pack.functions import model_fingerprint
+
+
+class CheckpointStore:
+    """Per scattering position tracking results saved on disk.
+
+    Each finished position is written to its own file as soon as it is
+    tracked, so an interrupted run restarts from the last completed
+    position. Files are grouped by a run key that identifies the model,
+    the energy deviations, the number of turns, the scraper apertures,
+    the initial offsets of the particles and the precision.
+    """
+
+    _FIELDS = ("turn_lost", "element_lost", "energy_deviation")
+
+    def __init__(self, path):
+        """.
+
+        path = directory where the checkpoint files are written.
+        """
+        self.path = path
+        _os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def run_key(
+        model, deltas, nturns, vchamber=None, pos_x=1e-5, pos_y=3e-6
+    ):
+        """Returns the key identifying one tracking configuration.
+
+        model    = accelerator model (or ModelState) used for tracking.
+        deltas   =        energy deviations used for tracking.
+        nturns   =                    number of turns tracked.
+        vchamber = scraper apertures (None if not scraping).
+        pos_x    =     x offset of the particles (track_eletrons_d).
+        pos_y    =     y offset of the particles (track_eletrons_d).
+
+        Runs in compact mode get other keys than full precision runs.
+        """
+        sha = _hashlib.sha1()
+        fingerprint = getattr(model, "fingerprint", None)
+        if fingerprint is None:
+            fingerprint = model_fingerprint(model)
+        sha.update(fingerprint.encode())
+        sha.update(_np.asarray(deltas, dtype=float).tobytes())
+        sha.update(repr(int(nturns)).encode())
+        if vchamber is not None:
+            sha.update(_np.asarray(vchamber, dtype=float).tobytes())
+        sha.update(_np.array([pos_x, pos_y], dtype=float).tobytes())
+        sha.update(b"compact" if _cmp.enabled() else b"full")
+        return sha.hexdigest()[:16]
+
+    def filename(self, key, element_idx):
+        """."""
+        return _os.path.join(self.path, f"{key}_{int(element_idx)}.npz")
+
+    def completed(self, key):
+        """Returns the element indices already saved for the run key."""
+        prefix = key + "_"
+        indices = []
+        for name in _os.listdir(self.path):
+            if name.startswith(prefix) and name.endswith(".npz"):
+                indices.append(int(name[len(prefix):-4]))
+        return sorted(indices)
+
+    def load(self, key, element_idx):
+        """Returns the saved tracking dictionary or None if missing."""
+        fname = self.filename(key, element_idx)
+        if not _os.path.isfile(fname):
+            return None
+        with _np.load(fname) as data:
+            return {field: data[field] for field in self._FIELDS}
+
+    def save(self, key, element_idx, dic):
+        """Saves a tracking dictionary given by track_eletrons_d.
+
+        The file is first written under a temporary name and then renamed,
+        so a crash never leaves a truncated checkpoint behind.
+        """
+        fname = self.filename(key, element_idx)
+        tmp = fname + ".tmp"
+        with open(tmp, "wb") as fil:
+            _np.savez(fil, **{field: dic[field] for field in self._FIELDS})
+        _os.replace(tmp, fname)
@@ -0,0 +1,236 @@
+"""Command-line runner of sharded loss-map runs.
+
+A run is described by a JSON config::
+
+    {
+        "lattice": "si",            # or path of a pickled accelerator
+        "positions": {"start": 0, "stop": 518.4, "num": 2000},
+        "deltas": {"max": 0.1, "num": 400},
+        "nturns": 7,
+        "vchamber": [-0.012, 0.012, -0.004, 0.004]
+    }
+
+positions and deltas may also be given as lists, and vchamber may be
+null (nominal appertures). Each node runs one shard of the scattering
+positions with all its cores, then a single merge builds the loss table
+and the loss profile::
+
+    python -m touschek_pack run config.json --shard 3/16 --out results
+    python -m touschek_pack merge results --out final
+"""
+import argparse as _argparse
+import hashlib as _hashlib
+import json as _json
+import os as _os
+import shutil as _shutil
+import sys as _sys
+
+import numpy as _np
+
+import touschek_pack.parallel as to_par
+from touschek_pack.loss_profile import LossProfile
+from touschek_pack.results import (
+    ScatTable,
+    load_scat_table,
+    merge_scat_tables,
+    save_scat_table,
+)
+
+_SHARD_PREFIX = "shard-"
+
+
+def load_config(path):
+    """Reads a run config and fills the defaults."""
+    with open(path, "r") as fil:
+        config = _json.load(fil)
+    config.setdefault("lattice", "si")
+    config.setdefault("deltas", {"max": 0.1, "num": 400})
+    config.setdefault("nturns", 7)
+    config.setdefault("vchamber", None)
+    if "positions" not in config:
+        raise ValueError("the config must give the scattering positions")
+    return config
+
+
+def _grid(value, start=0.0):
+    """Array from a list or from a {start, stop/max, num} dictionary."""
+    if isinstance(value, dict):
+        stop = value.get("stop", value.get("max"))
+        return _np.linspace(value.get("start", start), stop, value["num"])
+    return _np.asarray(value, dtype=float)
+
+
+def create_analysis(config):
+    """TousAnalysis of the lattice given by the config."""
+    from mathphys.functions import load_pickle
+
+    from touschek_pack.tous_analysis import TousAnalysis, _create_nominal_model
+
+    lattice = config["lattice"]
+    if lattice == "si":
+        model = _create_nominal_model()
+    else:
+        model = load_pickle(lattice)
+    ana = TousAnalysis(model, n_turns=config["nturns"])
+    ana._deltas = _grid(config["deltas"])
+    return ana
+
+
+def config_hash(config):
+    """Hash identifying a run config."""
+    text = _json.dumps(config, sort_keys=True)
+    return _hashlib.sha1(text.encode()).hexdigest()
+
+
+def shard_positions(positions, shard, nshards):
+    """Scattering positions of one shard (interleaved for balance)."""
+    return positions[shard::nshards]
+
+
+def shard_dir(out, shard, nshards):
+    """."""
+    return _os.path.join(out, f"{_SHARD_PREFIX}{shard:05d}-of-{nshards:05d}")
+
+
+def run_shard(config, shard=0, nshards=1, out=".", processes=None):
+    """Tracks the positions of one shard and writes its loss table.
+
+    config    =                    run config (see load_config).
+    shard     =            index of the shard (0 to nshards - 1).
+    nshards   =                        total number of shards.
+    out       =             directory where shards are written.
+    processes = number of worker processes (None: all cores).
+
+    The shard is first written to a temporary directory and then renamed,
+    so a killed job never leaves a partial shard behind.
+    """
+    ana = create_analysis(config)
+    spos = ana.spos
+    positions = shard_positions(_grid(config["positions"]), shard, nshards)
+    indices = [int(_np.argmin(_np.abs(pos - spos))) for pos in positions]
+    state = ana.model_state("tracking", config["vchamber"])
+    rate = ana._rate_nom_lattice()
+
+    processes = processes or _os.cpu_count() or 1
+    with to_par.make_pool([state], processes) as pool:
+        futures = [
+            pool.submit(
+                to_par._track_positions,
+                state.fingerprint,
+                ana.deltas,
+                ana.nturns,
+                chunk,
+            )
+            for chunk in to_par._split(indices, 4 * processes)
+        ]
+        tracks = [dic for fut in futures for dic in fut.result()]
+
+    keys, columns = [], []
+    for pos, index, dic in zip(positions, indices, tracks):
+        lost_pos, part_prob = ana._track_lossrate(dic)
+        keys.append(f"{_np.round(pos, 2)}")
+        columns.append((lost_pos, part_prob * rate[index]))
+
+    path = shard_dir(out, shard, nshards)
+    tmp = path + ".tmp"
+    _shutil.rmtree(tmp, ignore_errors=True)
+    save_scat_table(tmp, ScatTable.from_columns(keys, columns))
+    with open(_os.path.join(tmp, "shard.json"), "w") as fil:
+        _json.dump(
+            {
+                "shard": shard,
+                "nshards": nshards,
+                "config": config,
+                "config_hash": config_hash(config),
+            },
+            fil,
+        )
+    _shutil.rmtree(path, ignore_errors=True)
+    _os.replace(tmp, path)
+    return path
+
+
+def merge_shards(out, dest):
+    """Merges the shards written in out into the final results.
+
+    out  = directory with the shards of a run.
+    dest = directory of the merged loss table; the loss profile is saved
+           in dest/profile.npz.
+
+    Raises RuntimeError if a shard is missing or repeated, or if the
+    shards do not come from the same run (number of shards or config).
+    """
+    names = sorted(
+        name
+        for name in _os.listdir(out)
+        if name.startswith(_SHARD_PREFIX) and not name.endswith(".tmp")
+    )
+    if not names:
+        raise RuntimeError(f"no shards found in {out}")
+    infos = []
+    for name in names:
+        with open(_os.path.join(out, name, "shard.json"), "r") as fil:
+            infos.append(_json.load(fil))
+    nshards = {info["nshards"] for info in infos}
+    if len(nshards) != 1:
+        raise RuntimeError(f"shards of runs with different n: {nshards}")
+    nshards = nshards.pop()
+    hashes = {config_hash(info["config"]) for info in infos}
+    if len(hashes) != 1:
+        raise RuntimeError("shards of runs with different configs")
+    shards = [info["shard"] for info in infos]
+    repeated = sorted({shard for shard in shards if shards.count(shard) > 1})
+    if repeated:
+        raise RuntimeError(f"repeated shards: {repeated}")
+    missing = sorted(set(range(nshards)) - set(shards))
+    if missing:
+        raise RuntimeError(f"missing shards: {missing}")
+    extra = sorted(set(shards) - set(range(nshards)))
+    if extra:
+        raise RuntimeError(f"shards out of range: {extra}")
+
+    table = merge_scat_tables(
+        load_scat_table(_os.path.join(out, name)) for name in names
+    )
+    save_scat_table(dest, table)
+    lost_pos, summed = LossProfile.from_scat_dict(table).profile()
+    _np.savez(
+        _os.path.join(dest, "profile.npz"),
+        lost_positions=lost_pos,
+        summed=summed,
+    )
+    return table
+
+
+def main(argv=None):
+    """."""
+    parser = _argparse.ArgumentParser(prog="python -m touschek_pack")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="runs one shard of a loss map")
+    run.add_argument("config", help="JSON run config")
+    run.add_argument("--shard", default="0/1", help="shard as k/n")
+    run.add_argument("--out", default="results")
+    run.add_argument("--processes", type=int, default=None)
+
+    merge = sub.add_parser("merge", help="merges the shards of a run")
+    merge.add_argument("out", help="directory with the shards")
+    merge.add_argument("--dest", default=None, help="default: out/merged")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        shard, nshards = (int(val) for val in args.shard.split("/"))
+        if not 0 <= shard < nshards:
+            parser.error("--shard must be k/n with 0 <= k < n")
+        path = run_shard(
+            load_config(args.config), shard, nshards, args.out, args.processes
+        )
+        print(path)
+    else:
+        dest = args.dest or _os.path.join(args.out, "merged")
+        try:
+            table = merge_shards(args.out, dest)
+        except RuntimeError as err:
+            print(err, file=_sys.stderr)
+            _sys.exit(1)
+        print(f"{len(table.scat_keys)} positions merged into {dest}")
@@ -0,0 +1,157 @@
+"""Clusters of scattering positions with similar optics.
+
+Positions whose local optics (betax, alphax, rx), energy acceptance and
+Touschek coefficients (b1, b2) agree within a tolerance, and whose
+downstream elements are identical, lose particles in the same way up to
+a shift of element indices. Only one representative of each cluster is
+tracked; the losses of the other members are its losses shifted by the
+distance between the member and the representative.
+"""
+import hashlib as _hashlib
+
+import numpy as _np
+
+from touschek_pack.functions import element_signature, track_eletrons_d
+from touschek_pack.periodicity import _lost_map
+
+
+class PositionClusters:
+    """Cluster of each scattering position and the maps between them."""
+
+    def __init__(self, nelem, indices, labels, representatives):
+        """.
+
+        nelem           =             number of elements of the ring.
+        indices         =        element indices of the positions.
+        labels          =            cluster of each position.
+        representatives = element index tracked for each cluster.
+        """
+        self.nelem = int(nelem)
+        self.indices = _np.asarray(indices, dtype=int)
+        self.labels = _np.asarray(labels, dtype=int)
+        self.representatives = _np.asarray(representatives, dtype=int)
+
+    def __len__(self):
+        """Number of clusters."""
+        return self.representatives.size
+
+    def representative(self, index):
+        """Tracked element of the cluster of index and the shift back."""
+        pos = int(_np.flatnonzero(self.indices == index % self.nelem)[0])
+        rep = int(self.representatives[self.labels[pos]])
+        return rep, int(index) - rep
+
+    def map_track(self, dic, shift):
+        """Tracking dictionary of track_eletrons_d shifted by shift."""
+        dic = dict(dic)
+        dic["element_lost"] = _np.intp(
+            (_np.asarray(dic["element_lost"]) + shift) % self.nelem
+        )
+        return dic
+
+
+def position_features(optics, indices, accep=None):
+    """Optics features of the positions used by cluster_positions.
+
+    optics  = OpticsSnapshot of the model giving the optics.
+    indices =          element indices of the positions.
+    accep   = energy acceptance (None: the snapshot acceptance).
+
+    Columns are betax, alphax, rx, positive and negative acceptance, b1
+    and b2; the acceptance and the coefficients are taken at the nearest
+    point of the get_scaccep grid.
+    """
+    indices = _np.asarray(indices, dtype=int)
+    twiss = optics.twiss
+    scalc, daccpp, daccpn = optics.scaccep(accep)
+    spos = optics.spos[indices]
+    grid = _np.array([_np.argmin(_np.abs(scalc - s)) for s in spos])
+    return _np.column_stack(
+        [
+            twiss.betax[indices],
+            twiss.alphax[indices],
+            twiss.rx[indices],
+            daccpp[grid],
+            daccpn[grid],
+            optics.b1[grid],
+            optics.b2[grid],
+        ]
+    )
+
+
+def downstream_signatures(acc, indices, ndown=20):
+    """Hash of the ndown elements following each index (ring wraps)."""
+    sigs = [element_signature(elem) for elem in acc]
+    nelem = len(sigs)
+    return [
+        _hashlib.sha1(
+            b"".join(sigs[(idx + off) % nelem] for off in range(ndown))
+        ).hexdigest()
+        for idx in indices
+    ]
+
+
+def cluster_positions(optics, acc, indices, tol=0.02, ndown=20, accep=None):
+    """Groups scattering positions with similar optics.
+
+    optics  =  OpticsSnapshot of the model giving the optics features.
+    acc     = model used for tracking (downstream elements are compared
+              on it, so scrapers and appertures split clusters).
+    indices =                      element indices of the positions.
+    tol     = size of the feature cells, relative to the spread of each
+              feature over the positions.
+    ndown   =      number of downstream elements that must be equal.
+    accep   =       energy acceptance (None: snapshot acceptance).
+
+    Features are binned in cells of tol times their range; positions in
+    the same cell with the same downstream elements form a cluster, whose
+    first position is tracked.
+    """
+    indices = _np.asarray(indices, dtype=int) % len(acc)
+    uniq = _np.unique(indices)
+    feats = position_features(optics, uniq, accep)
+    scale = _np.ptp(feats, axis=0)
+    scale[scale == 0] = 1.0
+    cells = _np.floor((feats - feats.min(axis=0)) / (tol * scale))
+    downs = downstream_signatures(acc, uniq, ndown)
+
+    keys, labels, reps = {}, [], []
+    for idx, cell, down in zip(uniq, cells.astype(int), downs):
+        key = (tuple(cell), down)
+        if key not in keys:
+            keys[key] = len(reps)
+            reps.append(idx)
+        labels.append(keys[key])
+    return PositionClusters(len(acc), uniq, labels, reps)
+
+
+def validate_clusters(model, clusters, deltas, nturns, nsample=3, seed=0):
+    """Compares mapped tracking with direct tracking on a sample.
+
+    model    =                   accelerator model used for tracking.
+    clusters =                       PositionClusters of the positions.
+    deltas   =                     energy deviations for tracking.
+    nturns   =                                     number of turns.
+    nsample  = number of positions checked, taken among the positions
+               that are not representatives.
+    seed     =                   seed of the choice of positions.
+
+    Returns, for each checked index, the fraction of tracked particles
+    lost at the same element and turn by both computations.
+    """
+    members = _np.setdiff1d(clusters.indices, clusters.representatives)
+    rng = _np.random.default_rng(seed)
+    sample = rng.choice(members, min(nsample, members.size), replace=False)
+    agreement = []
+    for index in sample:
+        rep, shift = clusters.representative(index)
+        full = _lost_map(track_eletrons_d(deltas, nturns, index, model))
+        mapped = _lost_map(
+            clusters.map_track(
+                track_eletrons_d(deltas, nturns, rep, model), shift
+            )
+        )
+        same = sum(full.get(delta) == lost for delta, lost in mapped.items())
+        total = len(set(full) | set(mapped))
+        agreement.append(1.0 if not total else same / total)
+    return {"indices": [int(idx) for idx in sample], "agreement": agreement}
@@ -0,0 +1,135 @@
+"""Reduced-precision storage of particles, loss records and densities.
+
+Compact mode is off by default. When enabled::
+
+    compact.enable()  # or: with compact.compact(): ...
+
+Monte-Carlo particle coordinates and histograms, and loss densities are
+kept in float32. Loss records use int32 element indices, int16 turns
+(int32 beyond 32767 turns) and float32 energy deviations. The momentum
+algebra of the scattering, where cancellations happen, still runs in
+float64. accuracy_report measures the impact on a given model.
+"""
+import contextlib as _contextlib
+
+import numpy as _np
+
+_ENABLED = False
+
+FLOAT = _np.float32
+ELEMENT = _np.int32
+TURN = _np.int16
+
+
+def enable():
+    """."""
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    """."""
+    global _ENABLED
+    _ENABLED = False
+
+
+def enabled():
+    """True if compact mode is on."""
+    return _ENABLED
+
+
+@_contextlib.contextmanager
+def compact(on=True):
+    """Sets compact mode inside a with block."""
+    global _ENABLED
+    previous = _ENABLED
+    _ENABLED = on
+    try:
+        yield
+    finally:
+        _ENABLED = previous
+
+
+def float_dtype():
+    """dtype of stored coordinates and densities."""
+    return FLOAT if _ENABLED else _np.float64
+
+
+def compact_track(dic, n_turn):
+    """Loss record of track_eletrons_d in compact dtypes (if enabled)."""
+    if not _ENABLED:
+        return dic
+    turn = TURN if n_turn <= _np.iinfo(TURN).max else ELEMENT
+    return {
+        "turn_lost": dic["turn_lost"].astype(turn),
+        "element_lost": dic["element_lost"].astype(ELEMENT),
+        "energy_deviation": dic["energy_deviation"].astype(FLOAT),
+    }
+
+
+def nbytes(obj):
+    """Bytes held by the arrays of obj (array, dict, list or tuple)."""
+    if isinstance(obj, _np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        obj = obj.values()
+    if isinstance(obj, (list, tuple, type({}.values()))):
+        return sum(nbytes(item) for item in obj)
+    return 0
+
+
+def accuracy_report(acc, l_spos, accep, num_part=20000, de_min=1e-4):
+    """Compares compact and full precision results on acc.
+
+    acc      =                        accelerator model.
+    l_spos   =          positions used in the comparison.
+    accep    =               touschek energy acceptance.
+    num_part = particles of the Monte-Carlo comparison.
+    de_min   =             minimum energy deviation.
+
+    Returns, for the loss densities and the Monte-Carlo histograms, the
+    bytes used in both modes and the largest relative difference of the
+    densities and the Kolmogorov-Smirnov distance of the histograms
+    (same random seed in both modes). The float32 rounding of energy
+    deviations in loss records is also given.
+    """
+    from touschek_pack import functions as to_fu
+    from touschek_pack.optics import snapshot
+
+    report = {}
+    rng = to_fu._RNG
+    opt = snapshot(acc)
+    args = (acc, l_spos, num_part, accep, de_min, False)
+    with compact(False):
+        dens = to_fu.norm_cutacp(acc, l_spos, 5000, accep, True, opt)
+        to_fu.set_random_seed(0)
+        hist = to_fu.histgms(*args, optics=opt)
+    with compact(True):
+        dens_c = to_fu.norm_cutacp(acc, l_spos, 5000, accep, True, opt)
+        to_fu.set_random_seed(0)
+        hist_c = to_fu.histgms(*args, optics=opt)
+    to_fu._RNG = rng
+
+    scale = {key: _np.abs(val).max() or 1.0 for key, val in dens.items()}
+    report["densities"] = {
+        "bytes": nbytes(dens),
+        "bytes_compact": nbytes(dens_c),
+        "max_rel_error": max(
+            float(_np.max(_np.abs(dens_c[key] - val)) / scale[key])
+            for key, val in dens.items()
+        ),
+    }
+    report["histograms"] = {
+        "bytes": nbytes(hist[:2]),
+        "bytes_compact": nbytes(hist_c[:2]),
+        "ks_distance": max(
+            to_fu.ks_distance(full, cmp)
+            for full, cmp in zip(hist[0] + hist[1], hist_c[0] + hist_c[1])
+        ),
+    }
+    report["loss_records"] = {
+        "bytes_per_particle": 8 * 3,
+        "bytes_per_particle_compact": 4 + 2 + 4,
+        "delta_rounding": float(_np.finfo(FLOAT).eps),
+    }
+    return report
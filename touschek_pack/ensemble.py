@@ -0,0 +1,201 @@
+"""Loss maps over ensembles of error-seeded lattices."""
+import os as _os
+
+import numpy as _np
+from pyaccel.lattice import find_spos
+
+import touschek_pack.parallel as to_par
+from touschek_pack.loss_profile import LossProfile
+from touschek_pack.model_state import ModelState
+
+
+class Ensemble:
+    """Runs the analysis of many fitted models on a process pool.
+
+    The template TousAnalysis gives everything that only depends on the
+    nominal model: the linear-model amplitudes (calc_amp), the scraper
+    indices, the s positions and the energy deviation grids. These are
+    computed once and shared. The acceptance, the Touschek rate, the loss
+    densities and the tracking of each seed run concurrently. With the
+    template in the "tracked" accep_mode, the momentum acceptance of each
+    seed is tracked with the template accep_* settings::
+
+        ens = Ensemble(analysis, error_models)
+        res = ens.run(l_spos)
+        res["mean"], res["std"]  # loss profile statistics over the seeds
+    """
+
+    def __init__(
+        self, analysis, models, track_seeds=True, processes=None
+    ):
+        """.
+
+        analysis    =        TousAnalysis of the nominal lattice (template).
+        models      =                 fitted models of the error seeds.
+        track_seeds =  if False, the loss map tracking of the nominal model
+                       is shared and only the rates change with the seed.
+        processes   =       number of worker processes (None: all cores).
+        """
+        self.analysis = analysis
+        self.models = list(models)
+        self.track_seeds = track_seeds
+        self.processes = processes
+
+    def shared(self):
+        """Results that only depend on the nominal model."""
+        ana = self.analysis
+        _ = ana.amp_and_limidx  # nominal calc_amp, computed once
+        return {
+            "amps": (ana.amp_pos, ana.amp_neg),
+            "limit_indices": (ana.inds_pos, ana.inds_neg),
+            "scrap_inds": (ana.scraph_inds, ana.scrapv_inds),
+            "spos": ana.spos,
+            "deltas": ana.deltas,
+            "off_energy": ana.off_energy,
+        }
+
+    def run(self, l_scattered_pos, vchamber=None, npt=5000):
+        """Acceptance, densities, tracking and loss profile of every seed.
+
+        l_scattered_pos = scattered positions (list or numpy.array).
+        vchamber        = scrapers' apperture (None: nominal appertures).
+        npt             =  points of the loss densities (0: not computed).
+
+        Returns the shared results, one dictionary per seed (accep, rate,
+        densities, tracks and profile) and the lost positions with the
+        mean and standard deviation of the loss profile over the seeds.
+        """
+        ana = self.analysis
+        shared = self.shared()
+        spos = shared["spos"]
+        indices = [
+            int(_np.argmin(_np.abs(pos - spos))) for pos in l_scattered_pos
+        ]
+
+        fit_states = [ModelState(model) for model in self.models]
+        if self.track_seeds:
+            track_states = [
+                ModelState(
+                    model,
+                    vchamber=vchamber,
+                    scrap_inds=shared["scrap_inds"],
+                    **ana._STATE_FLAGS["tracking"],
+                )
+                for model in self.models
+            ]
+        else:
+            track_states = [ana.model_state("tracking", vchamber)]
+        accep_states = []
+        if ana.accep_mode == "tracked":
+            accep_states = [
+                ModelState(model, **ana._STATE_FLAGS["tracking"])
+                for model in self.models
+            ]
+
+        with to_par.make_pool(
+            fit_states + track_states + accep_states, self.processes
+        ) as pool:
+            acceps = [
+                self._submit_acceptance(pool, model, stt)
+                for model, stt in zip(self.models, accep_states)
+            ]
+            tracks = [
+                [
+                    pool.submit(
+                        to_par._track_positions,
+                        stt.fingerprint,
+                        shared["deltas"],
+                        ana.nturns,
+                        [index],
+                        True,
+                    )
+                    for index in indices
+                ]
+                for stt in track_states
+            ]
+            acceps = [
+                self._acceptance(model, *futs)
+                for model, futs in zip(self.models, acceps)
+            ] or [None] * len(fit_states)
+            optics = [
+                pool.submit(
+                    to_par._seed_optics,
+                    stt.fingerprint,
+                    l_scattered_pos,
+                    npt,
+                    accep,
+                )
+                for stt, accep in zip(fit_states, acceps)
+            ]
+            optics = [fut.result() for fut in optics]
+            tracks = [[fut.result()[0] for fut in futs] for futs in tracks]
+
+        # tracks are binned in the workers, with the tracking
+        binned = [[lost for _, lost in trk] for trk in tracks]
+        tracks = [[dic for dic, _ in trk] for trk in tracks]
+        seeds = []
+        for iseed, seed_optics in enumerate(optics):
+            iset = iseed if self.track_seeds else 0
+            profile = LossProfile()
+            rate = seed_optics["rate"]
+            for index, (lost_pos, part_prob) in zip(indices, binned[iset]):
+                profile.add(spos[index], lost_pos, part_prob * rate[index])
+            seeds.append(
+                dict(seed_optics, tracks=tracks[iset], profile=profile)
+            )
+
+        lost_pos, profiles = stack_profiles(
+            [seed["profile"] for seed in seeds]
+        )
+        return {
+            "shared": shared,
+            "indices": indices,
+            "seeds": seeds,
+            "lost_positions": lost_pos,
+            "profiles": profiles,
+            "mean": profiles.mean(axis=0),
+            "std": profiles.std(axis=0),
+        }
+
+    def _submit_acceptance(self, pool, model, state):
+        """Submits the tracked acceptance of one seed to the pool."""
+        ana = self.analysis
+        indices = to_par.acceptance_indices(len(model), ana.accep_points)
+        processes = self.processes or _os.cpu_count() or 1
+        futures = to_par.submit_acceptance(
+            pool,
+            state,
+            indices,
+            ana.accep_nturns,
+            float(_np.max(ana.deltas)),
+            ana.accep_tolerance,
+            nchunks=4 * processes,
+        )
+        return indices, futures
+
+    @staticmethod
+    def _acceptance(model, indices, futures):
+        """Acceptance of every element of a seed from its futures."""
+        accs = to_par.acceptance_result(futures)
+        spos = find_spos(model, indices="closed")
+        return to_par.interp_acceptance(spos, indices, accs)
+
+
+def stack_profiles(profiles):
+    """Aligns loss profiles on the union of their lost positions.
+
+    profiles = list of LossProfile.
+
+    Returns the sorted lost positions and an array (nprofiles, npositions)
+    with zeros where a profile has no loss.
+    """
+    curves = [profile.profile() for profile in profiles]
+    keys = _np.unique(
+        _np.concatenate([_np.asarray(k, dtype=float) for k, _ in curves])
+    )
+    stacked = _np.zeros((len(curves), keys.size))
+    for row, (lost_pos, summed) in zip(stacked, curves):
+        row[_np.searchsorted(keys, _np.asarray(lost_pos, dtype=float))] = (
+            summed
+        )
+    return keys, stacked
@@ -1,58 +1,518 @@
 """Functions_for_TousAnalysis."""
+import hashlib as _hashlib
 import pyaccel as _pyaccel
-import matplotlib.pyplot as _plt
 import numpy as _np
 import scipy.integrate as _scyint
 import scipy.special as _special
 from mathphys.beam_optics import beam_rigidity as _beam_rigidity
 
+from touschek_pack import compact as _cmp
+from touschek_pack import memory as _mem
+from touschek_pack import profiling as _prof
+
+
+_RNG = _np.random.default_rng()
+
+_FINGERPRINT_FLAGS = (
+    "energy",
+    "harmonic_number",
+    "cavity_on",
+    "radiation_on",
+    "vchamber_on",
+)
+_FINGERPRINT_ATTRS = (
+    "length",
+    "angle",
+    "polynom_a",
+    "polynom_b",
+    "hkick",
+    "vkick",
+    "voltage",
+    "frequency",
+    "hmin",
+    "hmax",
+    "vmin",
+    "vmax",
+    "t_in",
+    "t_out",
+    "r_in",
+    "r_out",
+)
+_APERTURE_ATTRS = ("hmin", "hmax", "vmin", "vmax")
+
+
+def set_random_seed(seed=None):
+    """Reseeds the random generator of the Monte-Carlo functions.
+
+    seed = any seed accepted by numpy.random.default_rng.
+    """
+    global _RNG
+    _RNG = _np.random.default_rng(seed)
 
-def calc_amp(acc, energy_offsets, hmax, hmin):
-    """Calculates the amplitudes and gets the physical limitants.
 
-    acc            =                                 accelerator model.
-    energy_offsets = energy deviation for calculate physical limitants.
-    hmax           =                          horizontal max apperture.
-    hmin           =                          horizontal min apperture.
+def model_fingerprint(acc, apertures=True):
+    """Returns a hash identifying the lattice, apertures and flags of acc.
+
+    acc       =                       accelerator model.
+    apertures = if False, the appertures are left out of the hash.
     """
-    a_def = _np.zeros(energy_offsets.size)
-    indices = _np.zeros(energy_offsets.size)
+    sha = _hashlib.sha1()
+    for flag in _FINGERPRINT_FLAGS:
+        sha.update(repr(getattr(acc, flag, None)).encode())
+    for elem in acc:
+        sha.update(element_signature(elem, apertures))
+    return sha.hexdigest()
+
+
+def element_signature(elem, apertures=True):
+    """Returns bytes identifying the type, fields and apertures of elem.
+
+    elem      =                           lattice element.
+    apertures = if False, the appertures are left out.
+    """
+    parts = [elem.fam_name.encode(), elem.pass_method.encode()]
+    for attr in _FINGERPRINT_ATTRS:
+        if not apertures and attr in _APERTURE_ATTRS:
+            continue
+        value = _np.asarray(getattr(elem, attr, 0), dtype=float)
+        parts.append(value.tobytes())
+    return b"".join(parts)
+
+
+def calc_optics_offsets(acc, energy_offsets, vertical=False):
+    """Calculates rx and betax at every element for each energy offset.
+
+    acc            =                          accelerator model.
+    energy_offsets = energy deviations used in the twiss solves.
+    vertical       = if True, ry and betay of the same twiss solves are
+                     also returned.
+
+    Rows of offsets beyond the first unstable one are left as nan.
+    """
+    shape = (energy_offsets.size, len(acc) + 1)
+    rx = _np.full(shape, _np.nan)
+    betax = _np.full(shape, _np.nan)
+    ry = _np.full(shape, _np.nan) if vertical else None
+    betay = _np.full(shape, _np.nan) if vertical else None
     try:
         for idx, delta in enumerate(energy_offsets):
-            twi, *_ = _pyaccel.optics.calc_twiss(
-                accelerator=acc, energy_offset=delta, indices="closed"
-            )
+            with _prof.stage("twiss"):
+                twi, *_ = _pyaccel.optics.calc_twiss(
+                    accelerator=acc, energy_offset=delta, indices="closed"
+                )
+            _prof.count("twiss_calls")
             if _np.any(_np.isnan(twi[0].betax)):
                 raise _pyaccel.optics.OpticsException("error")
-            rx = twi.rx
-            betax = twi.betax
-
-            a_sup = (hmax - rx) ** 2 / betax
-            a_inf = (hmin - rx) ** 2 / betax
-
-            a_max = _np.minimum(a_sup, a_inf)
-            idx_min = _np.argmin(a_max)
-            indices[idx] = idx_min
-            a_def[idx] = a_max[idx_min]
+            rx[idx] = twi.rx
+            betax[idx] = twi.betax
+            if vertical:
+                ry[idx] = twi.ry
+                betay[idx] = twi.betay
     except (
         _pyaccel.optics.OpticsException,
         _pyaccel.tracking.TrackingException,
     ):
         pass
-    return _np.sqrt(a_def), indices
+    if vertical:
+        return rx, betax, ry, betay
+    return rx, betax
+
+
+def _amp_limits(rx, betax, hmax, hmin):
+    """Squared amplitude limit of each element for each offset."""
+    a_sup = (hmax - rx) ** 2 / betax
+    a_inf = (hmin - rx) ** 2 / betax
+    return _np.minimum(a_sup, a_inf)
+
+
+def calc_amp(acc, energy_offsets, hmax, hmin, return_optics=False):
+    """Calculates the amplitudes and gets the physical limitants.
+
+    acc            =                                 accelerator model.
+    energy_offsets = energy deviation for calculate physical limitants.
+    hmax           =                          horizontal max apperture.
+    hmin           =                          horizontal min apperture.
+    return_optics  =      if True, also returns the arrays needed by
+                          update_amp (rx, betax and element limits) and
+                          by select_planes (ry and betay of the same
+                          twiss solves).
+    """
+    if return_optics:
+        rx, betax, ry, betay = calc_optics_offsets(
+            acc, energy_offsets, vertical=True
+        )
+    else:
+        rx, betax = calc_optics_offsets(acc, energy_offsets)
+    optics = _amp_select(rx, betax, hmax, hmin)
+    a_def, indices = optics["a_def"], optics["indices"]
+
+    if not return_optics:
+        return _np.sqrt(a_def), indices
+    optics["ry"], optics["betay"] = ry, betay
+    return _np.sqrt(a_def), indices.copy(), optics
+
+
+def calc_amp_planes(
+    acc, energy_offsets, hmax, hmin, vmax, vmin, coupling=1.0
+):
+    """Horizontal, vertical and combined limits from one twiss pass.
+
+    acc            =                                 accelerator model.
+    energy_offsets = energy deviation for calculate physical limitants.
+    hmax           =                          horizontal max apperture.
+    hmin           =                          horizontal min apperture.
+    vmax           =                            vertical max apperture.
+    vmin           =                            vertical min apperture.
+    coupling       =   ratio of the vertical to the horizontal invariant
+                       used for the combined limit.
+
+    Returns a dictionary with the planes "x", "y" and "xy", each with the
+    amplitudes ("amp"), the limitant indices ("indices"), the squared
+    limits of every element ("limits") and the stable offsets
+    ("stable"). The combined limit of an element is the smallest
+    horizontal invariant reaching its horizontal or vertical apperture
+    when the vertical invariant is coupling times the horizontal one;
+    "xy" also gives the plane setting each limit (0: x, 1: y).
+    """
+    rx, betax, ry, betay = calc_optics_offsets(
+        acc, energy_offsets, vertical=True
+    )
+    optics = {"rx": rx, "betax": betax, "ry": ry, "betay": betay}
+    return select_planes(optics, hmax, hmin, vmax, vmin, coupling)
+
+
+def select_planes(optics, hmax, hmin, vmax, vmin, coupling=1.0):
+    """calc_amp_planes from the twiss arrays of calc_amp.
+
+    optics   = dictionary with rx, betax, ry and betay of each offset,
+               e.g. the one of calc_amp(return_optics=True).
+    hmax     =                          horizontal max apperture.
+    hmin     =                          horizontal min apperture.
+    vmax     =                            vertical max apperture.
+    vmin     =                            vertical min apperture.
+    coupling =         ratio of the vertical to the horizontal invariant.
+
+    No twiss is solved; see calc_amp_planes for the result.
+    """
+    lim_x = _amp_limits(optics["rx"], optics["betax"], hmax, hmin)
+    lim_y = _amp_limits(optics["ry"], optics["betay"], vmax, vmin)
+    lim_xy = _np.minimum(lim_x, lim_y / coupling)
+
+    planes = {"coupling": coupling}
+    for plane, a_max in (("x", lim_x), ("y", lim_y), ("xy", lim_xy)):
+        stable, indices, a_def = _limit_select(a_max)
+        planes[plane] = {
+            "amp": _np.sqrt(a_def),
+            "indices": indices,
+            "limits": a_max,
+            "stable": stable,
+            "a_def": a_def,
+        }
+    _limit_planes(planes)
+    return planes
+
+
+def _limit_planes(planes):
+    """Plane (0: x, 1: y) setting each combined limit."""
+    idcs = _np.intp(planes["xy"]["indices"])
+    rows = _np.arange(idcs.size)
+    lim_x = planes["x"]["limits"][rows, idcs]
+    lim_y = planes["y"]["limits"][rows, idcs]
+    planes["xy"]["plane"] = _np.intp(lim_x > lim_y / planes["coupling"])
+
+
+def update_planes(planes, optics, elements, hmax, hmin, vmax, vmin):
+    """Updates select_planes results after a local apperture change.
+
+    planes   =        dictionary returned by select_planes (in place).
+    optics   =              twiss arrays planes was computed from.
+    elements =       indices of the elements whose apperture changed.
+    hmax     =                       new horizontal max apperture.
+    hmin     =                       new horizontal min apperture.
+    vmax     =                         new vertical max apperture.
+    vmin     =                         new vertical min apperture.
+
+    Only the columns of the modified elements are recomputed, as in
+    update_amp.
+    """
+    elements = _np.asarray(elements, dtype=int)
+    if not elements.size:
+        return planes
+    shape = planes["x"]["limits"].shape[1:]
+
+    def cols(rkey, bkey, vmx, vmn):
+        return _amp_limits(
+            optics[rkey][:, elements],
+            optics[bkey][:, elements],
+            _np.broadcast_to(vmx, shape)[elements],
+            _np.broadcast_to(vmn, shape)[elements],
+        )
+
+    new_x = cols("rx", "betax", hmax, hmin)
+    new_y = cols("ry", "betay", vmax, vmin)
+    new_xy = _np.minimum(new_x, new_y / planes["coupling"])
+    for plane, new_cols in (("x", new_x), ("y", new_y), ("xy", new_xy)):
+        sel = planes[plane]
+        _patch_limits(sel, elements, new_cols)
+        sel["amp"] = _np.sqrt(sel["a_def"])
+    _limit_planes(planes)
+    return planes
+
+
+def _limit_select(a_max):
+    """Stable offsets, limitant element and limit of each offset."""
+    stable = ~_np.isnan(a_max[:, 0])
+    indices = _np.zeros(a_max.shape[0])
+    a_def = _np.zeros(a_max.shape[0])
+    if _np.any(stable):
+        idx_min = _np.argmin(a_max[stable], axis=1)
+        indices[stable] = idx_min
+        a_def[stable] = a_max[stable, idx_min]
+    return stable, indices, a_def
+
+
+def _amp_select(rx, betax, hmax, hmin):
+    """Limit of each offset and the element setting it (calc_amp)."""
+    a_max = _amp_limits(rx, betax, hmax, hmin)
+    stable, indices, a_def = _limit_select(a_max)
+
+    return {
+        "rx": rx,
+        "betax": betax,
+        "limits": a_max,
+        "stable": stable,
+        "a_def": a_def,
+        "indices": indices,
+    }
+
+
+def calc_amp_fast(
+    acc, energy_offsets, hmax, hmin, order=4, nfit=9, ncheck=3
+):
+    """Chromatic-expansion surrogate of calc_amp.
+
+    acc            =                                 accelerator model.
+    energy_offsets = energy deviation for calculate physical limitants.
+    hmax           =                          horizontal max apperture.
+    hmin           =                          horizontal min apperture.
+    order          =        order of the polynomials in energy offset.
+    nfit           =       number of twiss solves used in the fit.
+    ncheck         = number of exact twiss solves checking the fit.
+
+    rx, betax, ry and betay of every element are fitted by polynomials in
+    the energy offset over nfit Chebyshev nodes, and evaluated on
+    energy_offsets.
+    Offsets outside the range of the stable nodes are unstable. Returns
+    the amplitudes, the limitant indices and the same dictionary as
+    calc_amp(return_optics=True), so update_amp keeps working, with the
+    fit residuals at the check offsets in its "fit" entry.
+    """
+    offsets = _np.asarray(energy_offsets, dtype=float)
+    dmin, dmax = offsets.min(), offsets.max()
+    mid, half = (dmax + dmin) / 2, max((dmax - dmin) / 2, 1e-12)
+    nodes = mid + half * _np.cos(_np.pi * _np.arange(nfit) / (nfit - 1))
+    # outward from zero, as calc_optics_offsets stops at the first failure
+    nodes = nodes[_np.argsort(_np.abs(nodes))]
+    fit = calc_optics_offsets(acc, nodes, vertical=True)
+    ok = ~_np.isnan(fit[1][:, 0])
+
+    shape = (offsets.size, len(acc) + 1)
+    rx, betax, ry, betay = (_np.full(shape, _np.nan) for _ in range(4))
+    report = {"order": 0, "twiss_calls": nfit, "check_offsets": []}
+    if _np.any(ok):
+        order = int(min(order, ok.sum() - 1))
+        lims = nodes[ok].min(), nodes[ok].max()
+        inside = (offsets >= lims[0]) & (offsets <= lims[1])
+        xfit = (nodes[ok] - mid) / half
+        coefs = _np.polynomial.polynomial.polyfit(
+            xfit, _np.hstack([arr[ok] for arr in fit]), order
+        )
+        vander = _np.polynomial.polynomial.polyvander(
+            (offsets[inside] - mid) / half, order
+        )
+        (
+            rx[inside],
+            betax[inside],
+            ry[inside],
+            betay[inside],
+        ) = _np.hsplit(vander @ coefs, 4)
+        # a non positive beta function means the fit left the stable range
+        unstable = _np.any(betax <= 0, axis=1) | _np.any(betay <= 0, axis=1)
+        betax[unstable] = _np.nan
+        betay[unstable] = _np.nan
+        report["order"] = order
+
+    # exact checkpoints spread over the stable offsets
+    cands = _np.where(_np.isfinite(betax[:, 0]))[0]
+    if cands.size and ncheck:
+        fracs = (_np.arange(ncheck) + 0.5) / ncheck
+        check = _np.unique(cands[(fracs * (cands.size - 1)).astype(int)])
+        check = check[_np.argsort(_np.abs(offsets[check]))]
+        rx_chk, betax_chk = calc_optics_offsets(acc, offsets[check])
+        report["twiss_calls"] += check.size
+        report["check_offsets"] = offsets[check]
+        report.update(
+            _fit_residuals(
+                (rx_chk, betax_chk),
+                (rx[check], betax[check]),
+                hmax,
+                hmin,
+            )
+        )
+
+    optics = _amp_select(rx, betax, hmax, hmin)
+    optics["ry"], optics["betay"] = ry, betay
+    optics["fit"] = report
+    return _np.sqrt(optics["a_def"]), optics["indices"].copy(), optics
+
+
+def _fit_residuals(exact, fitted, hmax, hmin):
+    """Residuals of the calc_amp_fast surrogate against exact optics."""
+    exa = _amp_select(*exact, hmax, hmin)
+    fit = _amp_select(*fitted, hmax, hmin)
+    both = exa["stable"] & fit["stable"]
+    if not _np.any(both):
+        return {}
+    amp_exa = _np.sqrt(exa["a_def"][both])
+    amp_fit = _np.sqrt(fit["a_def"][both])
+    # absolute residual where the exact amplitude vanishes
+    amp_res = _np.abs(amp_fit - amp_exa)
+    nonzero = amp_exa > 0
+    amp_res[nonzero] /= amp_exa[nonzero]
+    return {
+        "rx_residual": _np.max(_np.abs(fitted[0] - exact[0])[both]),
+        "betax_residual": _np.max(
+            _np.abs(fitted[1] / exact[1] - 1)[both]
+        ),
+        "amp_residual": _np.max(amp_res),
+        "index_match": _np.mean(
+            exa["indices"][both] == fit["indices"][both]
+        ),
+    }
+
+
+def update_amp(optics, elements, hmax, hmin):
+    """Updates calc_amp results after a local change of the appertures.
+
+    optics   =         dictionary returned by calc_amp(return_optics=True).
+    elements =              indices of the elements whose apperture changed.
+    hmax     =                               new horizontal max apperture.
+    hmin     =                               new horizontal min apperture.
+
+    Only the columns of the modified elements are recomputed. Offsets whose
+    limitant is one of them are rescanned, all the others only compare the
+    new columns with their current limit. optics is updated in place.
+    """
+    elements = _np.asarray(elements, dtype=int)
+    a_max = optics["limits"]
+    if not elements.size or not _np.any(optics["stable"]):
+        return _np.sqrt(optics["a_def"]), optics["indices"].copy()
+
+    hmax = _np.broadcast_to(hmax, a_max.shape[1:])[elements]
+    hmin = _np.broadcast_to(hmin, a_max.shape[1:])[elements]
+    new_cols = _amp_limits(
+        optics["rx"][:, elements], optics["betax"][:, elements], hmax, hmin
+    )
+    _patch_limits(optics, elements, new_cols)
+    return _np.sqrt(optics["a_def"]), optics["indices"].copy()
+
+
+def _patch_limits(sel, elements, new_cols):
+    """Puts new limit columns in a selection and updates its limitants."""
+    a_max = sel["limits"]
+    stable = sel["stable"]
+    indices = sel["indices"]
+    a_def = sel["a_def"]
+    a_max[:, elements] = new_cols
+
+    rescan = stable & _np.isin(indices, elements)
+    if _np.any(rescan):
+        idx_min = _np.argmin(a_max[rescan], axis=1)
+        indices[rescan] = idx_min
+        a_def[rescan] = a_max[rescan, idx_min]
+
+    compare = stable & ~rescan
+    if _np.any(compare):
+        col_min = _np.argmin(new_cols[compare], axis=1)
+        val_min = new_cols[compare, col_min]
+        better = val_min < a_def[compare]
+        rows = _np.where(compare)[0][better]
+        indices[rows] = elements[col_min[better]]
+        a_def[rows] = val_min[better]
+
+
+def set_vchamber_scraper(model, vchamber, scraph_inds, scrapv_inds):
+    """Sets the vchamber apperture of the scrapers.
+
+    model       =                            accelerator model.
+    vchamber    = scrapers' apperture (hmin, hmax, vmin, vmax).
+    scraph_inds =               indices of horizontal scrapers.
+    scrapv_inds =                 indices of vertical scrapers.
+    """
+    for iten in scraph_inds:
+        model[iten].hmin = vchamber[0]
+        model[iten].hmax = vchamber[1]
+    for iten in scrapv_inds:
+        model[iten].vmin = vchamber[2]
+        model[iten].vmax = vchamber[3]
+
 
 def track_eletrons_d(
-    deltas, n_turn, element_idx, model, pos_x=1e-5, pos_y=3e-6
+    deltas,
+    n_turn,
+    element_idx,
+    model,
+    pos_x=1e-5,
+    pos_y=3e-6,
+    parallel=True,
 ):
     """Tracking simulation for touschek scattering that ocorred in element_idx.
 
-    model  =       accelerator model.
-    deltas =        energy deviation.
-    n_turn = number of turns desired.
-    pos_x  =  small pertubation in x.
-    pos_y  =  small pertubation in y.
+    model    =                        accelerator model.
+    deltas   =                         energy deviation.
+    n_turn   =                  number of turns desired.
+    pos_x    =                   small pertubation in x.
+    pos_y    =                   small pertubation in y.
+    parallel = ring_pass parallelism (False in workers).
     """
-    orb = _pyaccel.tracking.find_orbit6(model, indices=[0, element_idx])
+    turn_lost, element_lost = _track_lost(
+        deltas, n_turn, element_idx, model, pos_x, pos_y, parallel
+    )
+    return _lost_dict(deltas, turn_lost, element_lost, n_turn, element_idx)
+
+
+def track_eletrons_pm(
+    deltas,
+    n_turn,
+    element_idx,
+    model,
+    pos_x=1e-5,
+    pos_y=3e-6,
+    parallel=True,
+):
+    """Tracks +deltas and -deltas with one orbit search and one ring_pass.
+
+    Same parameters as track_eletrons_d. Returns the dictionaries given
+    by track_eletrons_d for the positive and the negative deviations.
+    """
+    deltas = _np.asarray(deltas, dtype=float)
+    both = _np.concatenate([deltas, -deltas])
+    turn_lost, element_lost = _track_lost(
+        both, n_turn, element_idx, model, pos_x, pos_y, parallel
+    )
+    num = deltas.size
+    return tuple(
+        _lost_dict(
+            both[slc], turn_lost[slc], element_lost[slc], n_turn, element_idx
+        )
+        for slc in (slice(0, num), slice(num, 2 * num))
+    )
+
+
+def _initial_particles(deltas, element_idx, model, pos_x, pos_y):
+    """Particles on the closed orbit at element_idx, offset by deltas."""
+    with _prof.stage("find_orbit"):
+        orb = _pyaccel.tracking.find_orbit6(model, indices=[0, element_idx])
     orb = orb[:, 1]
 
     rin = _np.zeros((6, deltas.size))
@@ -60,161 +520,212 @@ def track_eletrons_d(
     rin[0] += pos_x
     rin[2] += pos_y
     rin[4] += deltas
+    return rin
+
+
+def _track_lost(deltas, n_turn, element_idx, model, pos_x, pos_y, parallel):
+    """Lost turn and element of each particle tracked from element_idx."""
+    rin = _initial_particles(deltas, element_idx, model, pos_x, pos_y)
+
+    # particles are tracked in chunks that fit in the memory budget
+    chunk = _mem.plan("tracking", deltas.size, _mem.tracking_bytes(1, n_turn))
+    turn_lost, element_lost = [], []
+    for slc in _mem.chunks(deltas.size, chunk):
+        with _prof.stage("ring_pass"):
+            track = _pyaccel.tracking.ring_pass(
+                model,
+                rin[:, slc],
+                nr_turns=n_turn,
+                turn_by_turn=True,
+                element_offset=element_idx,
+                parallel=parallel,
+            )
+        turn_lost.extend(track[2])
+        element_lost.extend(track[3])
+        del track
+    _prof.count("particle_turns", deltas.size * n_turn)
+    return _np.array(turn_lost), _np.intp(element_lost)
 
-    track = _pyaccel.tracking.ring_pass(
-        model,
-        rin,
-        nr_turns=n_turn,
-        turn_by_turn=True,
-        element_offset=element_idx,
-        parallel=True,
-    )
-
-    _, _, turn_lost, element_lost, _ = track
 
+def _lost_dict(deltas, turn_lost, element_lost, n_turn, element_idx):
+    """Tracking dictionary keeping only the particles that were lost."""
+    lost = ~((turn_lost == n_turn) & (element_lost == element_idx))
     dic = {}
-    t_lost, e_lost, delta = [], [], []
+    dic["turn_lost"] = turn_lost[lost]
+    dic["element_lost"] = element_lost[lost]
+    dic["energy_deviation"] = _np.asarray(deltas)[lost]
+    return _cmp.compact_track(dic, n_turn)
 
-    for i, item in enumerate(turn_lost):
-        if item == n_turn and element_lost[i] == element_idx:
-            pass
-        else:
-            t_lost.append(item)
-            e_lost.append(element_lost[i])
-            delta.append(deltas[i])
 
-    dic["turn_lost"] = _np.array(t_lost)
-    dic["element_lost"] = _np.intp(e_lost)
-    dic["energy_deviation"] = _np.array(delta)
+@_prof.timed("binning")
+def track_lossrate(spos, dic):
+    """Loss probability at each lost position for one tracking.
 
-    return dic
-
-
-def plot_track_d(
-    acc,
-    dic_tracked,
-    index_list,
-    offs_list,
-    par,
+    spos = s position of every element (closed).
+    dic  =  tracking dictionary given by track_eletrons_d.
+    """
+    import pandas as _pd
+
+    fact = 0.03
+
+    lostinds = dic["element_lost"]
+    deltas = dic["energy_deviation"]
+    if not len(deltas):  # no particle lost, e.g. wide appertures
+        return _np.array([]), _np.array([])
+
+    # lostinds = _np.zeros(len(single_track))
+    # deltas = _np.zeros(len(single_track))
+    # for idx, iten in enumerate(single_track):
+    #     _, ellost, delta = iten
+    #     lostinds[idx] = ellost
+    #     deltas[idx] = delta
+    # lostinds = _np.intp(lostinds)
+
+    lost_positions = _np.round(spos[lostinds], 2)
+
+    step = int((deltas[0] + deltas[-1]) / fact)
+    itv_track = _np.linspace(deltas[0], deltas[-1], step)
+
+    data = _pd.DataFrame({"lost_pos_by_tracking": lost_positions})
+    # dataframe that storages the tracking data
+    lost_pos_column = (
+        data.groupby("lost_pos_by_tracking").groups
+    ).keys()
+    data = _pd.DataFrame({"lost_pos_by_tracking": lost_pos_column})
+    # this step agroups the lost_positions
+
+    itv_delta = []
+    for current, next_iten in zip(itv_track, itv_track[1:]):
+        stri = f"{current*1e2:.2f} % < delta < {next_iten*1e2:.2f} %"
+        data[stri] = _np.zeros(len(list(lost_pos_column)))  # this step
+        # creates new columns in the dataframe and fill with zeros
+
+        itv_delta.append((current, next_iten))
+        # Next step must calculate each matrix element from the
+        # dataframe
+
+    var = list(data.index)
+    if var == lost_pos_column:
+        pass
+    else:
+        data = data.set_index("lost_pos_by_tracking")
+
+    for idx, lost_pos in enumerate(lost_positions):  # essas duas
+        # estruturas de repetição são responsáveis por calcular
+        # o percentual dos eletrons que possuem um determinado desvio
+        # de energia e se perdem em um intervalo de desvio de energia
+        # específico
+        delta = deltas[idx]
+        # lps = []
+        for i, interval in enumerate(itv_delta):
+            if not i:  # subtle difference: <= in first iteraction
+                if interval[0] <= delta <= interval[1]:
+                    stri = f"{interval[0]*1e2:.2f} % < delta < {interval[1]*1e2:.2f} %"
+                    data.loc[lost_pos, stri] += 1
+
+            else:
+                if interval[0] < delta <= interval[1]:
+                    stri = f"{interval[0]*1e2:.2f} % < delta < {interval[1]*1e2:.2f} %"
+                    data.loc[lost_pos, stri] += 1
+
+    data = data / len(deltas)
+
+    lost_pos_df = []
+    part_prob = []
+    # Calculates the loss probablity by tracking
+    for indx, iten in data.iterrows():
+        t_prob = 0
+        for idx, m in enumerate(iten):
+            t_prob += m
+            if idx == iten.count() - 1:
+                # appends the probability after sum
+                part_prob.append(t_prob)
+                lost_pos_df.append(indx)
+
+    lost_pos_df = _np.array(lost_pos_df)
+    part_prob = _np.array(part_prob)
+
+    return lost_pos_df, part_prob
+
+
+def bisect_acceptance(
+    model,
     element_idx,
-    accep,
-    delt,
-    f_dens,
+    n_turn,
+    delta_max=0.1,
+    tol=1e-4,
+    ntrial=4,
+    pos_x=1e-5,
+    pos_y=3e-6,
+    parallel=True,
 ):
-    """Plot the tracking results for a given s position.
-
-    acc         =                                    accelerator model.
-    dic_tracked =      dictionary of informations provided by tracking.
-    index_list  =     defines the physical limitants from linear model.
-    offs_list   =                       list of e_dev used in tracking.
-    par         =  defines the analysis for positive or negative e_dev.
-    element_idx =              defines initial conditions for tracking.
-    accep       =                           touschek energy acceptance.
-    delt        =  energy deviation for the touschek loss rate density.
-    fdens       =                           touschek loss rate density.
+    """Tracked momentum acceptance at element_idx by interval search.
+
+    model       =              accelerator model used for tracking.
+    element_idx =              element where the particles start.
+    n_turn      =                   number of turns to survive.
+    delta_max   =          largest energy deviation searched.
+    tol         =  width of the final interval of each sign.
+    ntrial      = trial deviations of each sign per ring_pass.
+    pos_x       =                    small pertubation in x.
+    pos_y       =                    small pertubation in y.
+    parallel    =     ring_pass parallelism (False in workers).
+
+    Each step tracks ntrial deviations inside the current interval of
+    both signs in a single ring_pass, and keeps the interval between the
+    last surviving and the first lost trial, until it is narrower than
+    tol. Returns the negative and the positive acceptance (the largest
+    deviations found to survive).
     """
-    # ----------------
-
-    turn_lost = dic_tracked["turn_lost"]
-    element_lost = dic_tracked["element_lost"]
-    deltas = dic_tracked["energy_deviation"] * 1e2
-
-    cm = 1 / 2.54  # 'poster'
-    twi0, *_ = _pyaccel.optics.calc_twiss(acc, indices="open")
-    betax = twi0.betax
-    betax = betax * (1 / 5)
-    spos = _pyaccel.lattice.find_spos(acc)
-
-    fig = _plt.figure(figsize=(38.5 * cm, 18 * cm))
-    gs = _plt.GridSpec(
-        1,
-        3,
-        left=0.1,
-        right=0.98,
-        wspace=0.03,
-        top=0.95,
-        bottom=0.1,
-        width_ratios=[2, 3, 8],
-    )
-    a1 = fig.add_subplot(gs[0, 0])
-    a2 = fig.add_subplot(gs[0, 1], sharey=a1)
-    a3 = fig.add_subplot(gs[0, 2], sharey=a1)
-    a1.tick_params(axis="both", labelsize=18)
-    a2.tick_params(
-        axis="y",
-        which="both",
-        left=False,
-        right=False,
-        labelleft=False,
-        labelsize=18,
-    )
-    a3.tick_params(
-        axis="y",
-        which="both",
-        left=False,
-        right=False,
-        labelleft=False,
-        labelsize=18,
-    )
-    a2.tick_params(axis="both", labelsize=18)
-    a3.tick_params(axis="both", labelsize=18)
-    a1.set_title(r"$\delta \times scat. rate$", fontsize=20)
-    a2.set_title(r"$\delta \times$ lost turn", fontsize=20)
-    a3.set_title(r"tracking ", fontsize=20)
-
-    a1.set_xlabel(r"$\tau _T$ [1/s]", fontsize=25)
-    a2.set_xlabel(r"number of turns", fontsize=25)
-    a3.set_xlabel(r"$s$ [m]", fontsize=25)
-
-    a1.grid(True, alpha=0.5, ls="--", color="k", axis="y")
-    a2.grid(True, alpha=0.5, ls="--", color="k", axis="y")
-    a3.grid(True, alpha=0.5, ls="--", color="k", axis="y")
-    _plt.subplots_adjust(wspace=0.1)
-
-    if "pos" in par:
-        a1.set_ylabel(r"positive $\delta$ [%]", fontsize=25)
-        a3.plot(spos[element_lost], deltas, "r.", label="lost pos. (track)")
-        acp_s = accep[1][element_idx]
-        indx = _np.argmin(_np.abs(offs_list - acp_s))
-        a3.plot(
-            spos[index_list][:indx],
-            offs_list[:indx] * 1e2,
-            "b.",
-            label=r"accep. limit",
-            alpha=0.25,
+    orb = _initial_particles(_np.zeros(1), element_idx, model, pos_x, pos_y)
+    low, high = _np.zeros(2), _np.full(2, float(delta_max))
+    tested = _np.zeros(2, dtype=bool)  # high is known to be lost
+    signs = _np.array([-1.0, 1.0])
+    steps = _np.arange(1, ntrial + 1)
+    while True:
+        todo = ~tested | (high - low > tol)
+        if not _np.any(todo):
+            break
+        fracs = [steps / (ntrial + tested[i]) for i in range(2)]
+        trials = [low[i] + (high[i] - low[i]) * fracs[i] for i in range(2)]
+        deltas = _np.concatenate(
+            [signs[i] * trials[i] for i in range(2) if todo[i]]
         )
+        rin = orb + _np.zeros((6, deltas.size))
+        rin[4] += deltas
+        with _prof.stage("ring_pass"):
+            track = _pyaccel.tracking.ring_pass(
+                model,
+                rin,
+                nr_turns=n_turn,
+                element_offset=element_idx,
+                parallel=parallel,
+            )
+        _prof.count("particle_turns", deltas.size * n_turn)
+        lost = _np.asarray(track[1], dtype=bool).reshape(-1, ntrial)
+        for i, row in zip(_np.flatnonzero(todo), lost):
+            if not row.any():
+                low[i] = trials[i][-1]
+                if not tested[i]:  # delta_max survives
+                    high[i] = low[i]
+                    tested[i] = True
+                continue
+            first = int(_np.argmax(row))
+            high[i] = trials[i][first]
+            if first:
+                low[i] = trials[i][first - 1]
+            tested[i] = True
+    return -low[0], low[1]
+
+
+def plot_track_d(*args, **kwargs):
+    """Plot the tracking results for a given s position.
 
-    elif "neg" in par:
-        a1.set_ylabel(r"negative $\delta$ [%]", fontsize=25)
-        a3.plot(spos[element_lost], deltas, "r.", label="lost pos. (track)")
-        acp_s = accep[0][element_idx]
-        indx = _np.argmin(_np.abs(offs_list + acp_s))
-        a3.plot(
-            spos[index_list][:indx],
-            -offs_list[:indx] * 1e2,
-            "b.",
-            label=r"accep. limit",
-            alpha=0.25,
-        )
+    Kept for backward compatibility, see touschek_pack.plotting.
+    """
+    from touschek_pack import plotting
 
-    a1.plot(f_dens, delt, label="Scattering touschek rate", color="black")
-    a2.plot(turn_lost, deltas, "k.")
-    stri = f"{acc[element_idx].fam_name}, ({spos[element_idx]:.2f} m)"
-    a3.plot(spos[element_idx], 0, "ko", label=stri)
-    a3.plot(
-        spos, _np.sqrt(betax), color="orange", label=r"$ \sqrt{\beta_x}  $"
-    )
-    _plt.hlines(
-        acp_s * 1e2,
-        spos[0],
-        spos[-1],
-        color="black",
-        linestyles="dashed",
-        alpha=0.5,
-    )
-    _pyaccel.graphics.draw_lattice(acc, offset=-0.5, height=0.5, gca=True)
-    a3.legend(loc="upper right", ncol=1, fontsize=15)
-    fig.show()
+    return plotting.plot_track_d(*args, **kwargs)
 
 
 # def t_list(elmnt): # não sei se isso é útil
@@ -259,13 +770,15 @@ def f_function_arg_mod(kappa, kappam, b1_, b2_, norm):
     return arg * bessel
 
 
-def get_scaccep(acc, accep):
+def get_scaccep(acc, accep, spos=None):
     """Returns the s position and the energy acceptance every 10 cm.
 
     acc   = accelerator model used to acquire the optical parameters.
     accep =                  positive and negative energy acceptance.
+    spos  =     s position of every element, closed (None: computed).
     """
-    spos = _pyaccel.lattice.find_spos(acc, indices="closed")
+    if spos is None:
+        spos = _pyaccel.lattice.find_spos(acc, indices="closed")
 
     npt = int((spos[-1] - spos[0]) / 0.1)
     scalc = _np.linspace(spos[0], spos[-1], npt)
@@ -280,18 +793,42 @@ def get_scaccep(acc, accep):
 # minado ponto.
 
 
-def norm_cutacp(acc, lsps, npt, accep, norm=False):
+def get_elements_rate(acc, ltime=None, optics=None):
+    """Returns the Touschek scattering rate interpolated at every element.
+
+    acc    =                       accelerator model.
+    ltime  = Lifetime object of acc (None: created).
+    optics =   OpticsSnapshot of acc (None: not used).
+    """
+    if optics is not None:
+        return optics.elements_rate
+    spos = _pyaccel.lattice.find_spos(acc, indices="closed")
+    if ltime is None:
+        with _prof.stage("lifetime"):
+            ltime = _pyaccel.lifetime.Lifetime(acc)
+    tous_rate = ltime.touschek_data["rate"]  # scattering rate
+    npt = int((spos[-1] - spos[0]) / 0.1)
+    scalc = _np.linspace(spos[0], spos[-1], npt)
+    return _np.interp(spos, scalc, tous_rate)
+
+
+def norm_cutacp(acc, lsps, npt, accep, norm=False, optics=None):
     """Plot loss rate for a list of s positions.
 
-    acc   =  accelerator model used to acquire the optical parameters.
-    lsps  =             list of s positions to calculate loss density.
-    npt   =                      number of points to a linspace array.
-    accep =                   positive and negative energy acceptance.
-    norm  =   parameter to define if the function will return density.
+    acc    =  accelerator model used to acquire the optical parameters.
+    lsps   =             list of s positions to calculate loss density.
+    npt    =                      number of points to a linspace array.
+    accep  =                   positive and negative energy acceptance.
+    norm   =   parameter to define if the function will return density.
+    optics = OpticsSnapshot of acc, whose lifetime and acceptance grid
+             are reused (None: computed here).
     """
     dic = {}
 
-    scalc, daccpp, daccpn = get_scaccep(acc, accep)
+    if optics is None:
+        scalc, daccpp, daccpn = get_scaccep(acc, accep)
+    else:
+        scalc, daccpp, daccpn = optics.scaccep(accep)
     beta = _beam_rigidity(energy=3)[2]
 
     taum_p = (beta * daccpp) ** 2
@@ -299,50 +836,50 @@ def norm_cutacp(acc, lsps, npt, accep, norm=False):
     kappam_p = _np.arctan(_np.sqrt(taum_p))
     kappam_n = _np.arctan(_np.sqrt(taum_n))
 
-    ltime = _pyaccel.lifetime.Lifetime(acc)
-    b1 = ltime.touschek_data["touschek_coeffs"]["b1"]
-    b2 = ltime.touschek_data["touschek_coeffs"]["b2"]
-
-    fdens_p, fdens_n = [], []
-    deltasp, deltasn = [], []
-
-    for _, s in enumerate(lsps):
-        idx = _np.argmin(_np.abs(scalc - s))
-        kappam_p0 = kappam_p[idx]
-        kappam_n0 = kappam_n[idx]
-
-        kappap = _np.linspace(kappam_p0, _np.pi / 2, npt)
-        deltap = 1 / beta * _np.tan(kappap)
-        kappan = _np.linspace(kappam_n0, _np.pi / 2, npt)
-        deltan = 1 / beta * _np.tan(kappan)
-
-        y_p = f_function_arg_mod(
-            kappa=kappap, kappam=kappam_p0, b1_=b1[idx], b2_=b2[idx], norm=norm
-        ).squeeze()
-        y_n = f_function_arg_mod(
-            kappa=kappan, kappam=kappam_n0, b1_=b1[idx], b2_=b2[idx], norm=norm
-        ).squeeze()
-        norm_facp = _scyint.trapz(y_p, deltap)
-        norm_facn = _scyint.trapz(y_n, deltan)
-
-        y_p /= norm_facp
-        y_n /= norm_facn
-
-        # eliminating the negative values from array
-        indp = _np.where(y_p < 0)[0]
-        indn = _np.where(y_n < 0)[0]
-        y_p[indp] = 0
-        y_n[indn] = 0
-
-        fdens_p.append(y_p)
-        fdens_n.append(y_n)
-        deltasp.append(deltap)
-        deltasn.append(deltan)
-
-    fdens_p = _np.array(fdens_p)
-    fdens_n = _np.array(fdens_n)
-    deltasp = _np.array(deltasp)
-    deltasn = _np.array(deltasn)
+    if optics is None:
+        with _prof.stage("lifetime"):
+            ltime = _pyaccel.lifetime.Lifetime(acc)
+            b1 = ltime.touschek_data["touschek_coeffs"]["b1"]
+            b2 = ltime.touschek_data["touschek_coeffs"]["b2"]
+    else:
+        b1, b2 = optics.b1, optics.b2
+
+    idcs = _np.array(
+        [_np.argmin(_np.abs(scalc - s)) for s in lsps], dtype=int
+    )
+    npos = idcs.size
+    dtype = _cmp.float_dtype()
+    fdens_p = _np.empty((npos, npt), dtype=dtype)
+    fdens_n = _np.empty((npos, npt), dtype=dtype)
+    deltasp = _np.empty((npos, npt), dtype=dtype)
+    deltasn = _np.empty((npos, npt), dtype=dtype)
+
+    # positions are evaluated together, in chunks that fit in the budget
+    chunk = _mem.plan("densities", npos, _mem.density_bytes(1, npt))
+    lin = _np.linspace(0, 1, npt)
+    for slc in _mem.chunks(npos, chunk):
+        idx = idcs[slc]
+        for kappam, fdens, deltas in (
+            (kappam_p[idx], fdens_p, deltasp),
+            (kappam_n[idx], fdens_n, deltasn),
+        ):
+            kappa = kappam[:, None] + (_np.pi / 2 - kappam[:, None]) * lin
+            kappa[:, -1] = _np.pi / 2
+            delta = 1 / beta * _np.tan(kappa)
+            y_d = f_function_arg_mod(
+                kappa=kappa.ravel(),
+                kappam=_np.repeat(kappam, npt)[:, None],
+                b1_=_np.repeat(b1[idx], npt)[:, None],
+                b2_=_np.repeat(b2[idx], npt)[:, None],
+                norm=norm,
+            ).reshape(kappa.shape)
+            y_d /= _scyint.trapz(y_d, delta, axis=1)[:, None]
+
+            # eliminating the negative values from array
+            y_d[y_d < 0] = 0
+
+            fdens[slc] = y_d
+            deltas[slc] = delta
 
     dic["fdensp"] = fdens_p
     dic["fdensn"] = fdens_n
@@ -372,7 +909,7 @@ def create_particles(cov_matrix, num_part):
     sig_yy = cov_matrix[3:, 3:]
     inv_yy = _np.linalg.inv(sig_yy)
 
-    part1 = _np.random.Generator.multivariate_normal(
+    part1 = _RNG.multivariate_normal(
         _np.zeros(6), cov_matrix, num_part
     ).T
 
@@ -382,13 +919,14 @@ def create_particles(cov_matrix, num_part):
     new_mean = (sig_xy @ inv_yy) @ vec_a
     new_cov = sig_xx - sig_xy @ inv_yy @ sig_yx
 
-    part2[:3] = _np.random.Generator.multivariate_normal(
+    part2[:3] = _RNG.multivariate_normal(
         _np.zeros(3), new_cov, num_part
     ).T
     part2[:3] += new_mean
 
-    part2 = part2[idcs_r, :]
-    part1 = part1[idcs_r, :]
+    dtype = _cmp.float_dtype()
+    part2 = part2[idcs_r, :].astype(dtype, copy=False)
+    part1 = part1[idcs_r, :].astype(dtype, copy=False)
 
     return part1, part2
 
@@ -427,7 +965,7 @@ def cross_section_draw_samples(psim, num_part):
     num_part =                           number of particles for simulation.
     """
     psi, cross = get_cross_section_distribution(psim)
-    crs = _np.random.Generator.rand(num_part)
+    crs = _RNG.random(num_part)
     return _np.interp(crs, cross, psi)
 
 
@@ -442,6 +980,11 @@ def scatter_particles(part1, part2, de_min):
     beta = _np.sqrt(1 - 1 / gamma / gamma)
     num_part = part1.shape[1]
 
+    # the momentum algebra always runs in double precision
+    dtype = part1.dtype
+    part1 = part1.astype(_np.float64, copy=False)
+    part2 = part2.astype(_np.float64, copy=False)
+
     xl1, yl1, de1 = part1[1], part1[3], part1[4]
     xl2, yl2, de2 = part2[1], part2[3], part2[4]
 
@@ -470,8 +1013,8 @@ def scatter_particles(part1, part2, de_min):
     chi = _np.sqrt(zeta**2 + theta**2) / 2
 
     # draw the scattering angles from uniform distribution:
-    phi = _np.random.Generator.rand(num_part) * 2 * _np.pi
-    psi = _np.random.Generator.rand(num_part) * _np.pi / 2
+    phi = _RNG.random(num_part) * 2 * _np.pi
+    psi = _RNG.random(num_part) * _np.pi / 2
 
     # draw the psi angle from the cross section probability density:
     # we need to define a maximum angle to normalize the cross section
@@ -488,7 +1031,6 @@ def scatter_particles(part1, part2, de_min):
     # carefully, though.
     psim = _np.arccos(de_min / gamma / (chi.max() * 2))
     fact = psim * 2 / _np.pi
-    print(psim * 2 / _np.pi)
     psi = cross_section_draw_samples(psim, num_part)
 
     # new momentum in j,k,l (eq. 16 of Piwinski paper)
@@ -523,10 +1065,63 @@ def scatter_particles(part1, part2, de_min):
     part2_new[3] = pnew_2[1]
     part2_new[4] = delta2
 
+    part1_new = part1_new.astype(dtype, copy=False)
+    part2_new = part2_new.astype(dtype, copy=False)
+
     return part1_new, part2_new, fact
 
 
-def histgms(acc, l_spos, num_part, accep, de_min, cutaccep):
+def _mc_setup(acc, l_spos, accep, optics=None):
+    """Element index, beam envelope and acceptance of each MC position."""
+    if optics is None:
+        spos = _pyaccel.lattice.find_spos(acc, indices="closed")
+        scalc, daccpp, daccpn = get_scaccep(acc, accep, spos=spos)
+    else:
+        spos = optics.spos
+        scalc, daccpp, daccpn = optics.scaccep(accep)
+    idcs_model = [int(_np.argmin(_np.abs(spos - iten))) for iten in l_spos]
+    # envelopes only where needed; the end of the ring is its start
+    env_idcs = _np.unique(_np.array(idcs_model, dtype=int) % len(acc))
+    if optics is None:
+        with _prof.stage("envelopes"):
+            envelopes = _pyaccel.optics.calc_beamenvelope(
+                acc, indices=env_idcs
+            )
+    else:
+        envelopes = optics.envelopes[env_idcs]
+    envelopes = dict(zip(env_idcs, envelopes))
+
+    positions = []
+    for iten, idx_model in zip(l_spos, idcs_model):
+        idx = _np.argmin(_np.abs(scalc - iten))
+        env = envelopes[idx_model % len(acc)]
+        positions.append((idx_model, env, (daccpp[idx], daccpn[idx])))
+    return positions
+
+
+def _mc_batch(env, nbatch, de_min, cutaccep, accp):
+    """Scattered e_dev [%] of one batch beyond the cutoff (both signs)."""
+    with _prof.stage("monte_carlo"):
+        part1, part2 = create_particles(env, nbatch)
+        part1_new, part2_new, _ = scatter_particles(part1, part2, de_min)
+    _prof.count("mc_samples", nbatch)
+
+    if cutaccep:  # if true the cutoff is the accp at the s
+        acpp, acpn = accp
+        check1 = acpp - part1_new[4]
+        check2 = -(acpn - part2_new[4])
+
+        ind1 = _np.intp(_np.where(check1 < 0)[0])
+        ind2 = _np.intp(_np.where(check2 < 0)[0])
+
+    else:  # ximenes cutoff
+        ind1 = _np.intp(_np.where(part1_new[4] >= 0.01)[0])
+        ind2 = _np.intp(_np.where(part2_new[4] <= -0.01)[0])
+
+    return part1_new[4][ind1] * 1e2, part2_new[4][ind2] * 1e2
+
+
+def histgms(acc, l_spos, num_part, accep, de_min, cutaccep, optics=None):
     """Calculates the touschek scattering densities.
 
     l_spos   =                           list of positions.
@@ -534,41 +1129,108 @@ def histgms(acc, l_spos, num_part, accep, de_min, cutaccep):
     accep    =                  touschek energy acceptance.
     de_min   =                minimum energy deviation for.
     cutaccep = defines the cutoff on the energy acceptance.
+    optics   =    OpticsSnapshot of acc (None: not used).
     """
-    envelopes = _pyaccel.optics.calc_beamenvelope(acc)
-    spos = _pyaccel.lattice.find_spos(acc, indices="closed")
-    scalc, daccpp, daccpn = get_scaccep(acc, accep)
-
     histsp1, histsp2, indices = [], [], []
 
-    for iten in l_spos:
-        idx_model = _np.argmin(_np.abs(spos - iten))
-        idx = _np.argmin(_np.abs(scalc - iten))
-        indices.append(idx_model)
+    # samples are drawn in batches that fit in the memory budget
+    chunk = _mem.plan("monte_carlo", num_part, _mem.mc_bytes(1))
 
-        env = envelopes[idx_model]
-
-        part1, part2 = create_particles(env, num_part)
-        part1_new, part2_new, _ = scatter_particles(part1, part2, de_min)
+    for idx_model, env, accp in _mc_setup(acc, l_spos, accep, optics):
+        indices.append(idx_model)
 
-        if cutaccep:  # if true the cutoff is the accp at the s
-            acpp, acpn = daccpp[idx], daccpn[idx]
-            check1 = acpp - part1_new[4]
-            check2 = -(acpn - part2_new[4])
+        hist1, hist2 = [], []
+        for slc in _mem.chunks(num_part, chunk):
+            nbatch = slc.stop - slc.start
+            batch = _mc_batch(env, nbatch, de_min, cutaccep, accp)
+            hist1.append(batch[0])
+            hist2.append(batch[1])
 
-            ind1 = _np.intp(_np.where(check1 < 0)[0])
-            ind2 = _np.intp(_np.where(check2 < 0)[0])
+        histsp1.append(_np.concatenate(hist1))
+        histsp2.append(_np.concatenate(hist2))
 
-            histsp1.append(part1_new[4][ind1] * 1e2)
-            histsp2.append(part2_new[4][ind2] * 1e2)
+    indices = _np.array(indices)
 
-        else:  # ximenes cutoff
-            ind1 = _np.intp(_np.where(part1_new[4] >= 0.01)[0])
-            ind2 = _np.intp(_np.where(part2_new[4] <= -0.01)[0])
+    return histsp1, histsp2, indices
 
-            histsp1.append(part1_new[4][ind1] * 1e2)
-            histsp2.append(part2_new[4][ind2] * 1e2)
 
-    indices = _np.array(indices)
+def histgms_adaptive(
+    acc,
+    l_spos,
+    accep,
+    de_min,
+    cutaccep,
+    tol=0.02,
+    batch=10000,
+    max_part=200000,
+    criterion="ks",
+    optics=None,
+):
+    """Touschek scattering densities with convergence-driven stopping.
+
+    l_spos    =                                 list of positions.
+    accep     =                        touschek energy acceptance.
+    de_min    =                      minimum energy deviation for.
+    cutaccep  =       defines the cutoff on the energy acceptance.
+    tol       =                  tolerance of the stop criterion.
+    batch     =               particles drawn in each M.C. batch.
+    max_part  =          largest number of particles per position.
+    criterion = "ks": Kolmogorov-Smirnov distance between the new batch
+                and the samples already drawn; "bins": relative error
+                of the populated histogram bins.
+    optics    =            OpticsSnapshot of acc (None: not used).
+
+    Batches are drawn at each position until the criterion is below tol
+    for both signs, or max_part is reached. Returns the same as histgms
+    plus the number of particles drawn at each position.
+    """
+    histsp1, histsp2, indices, samples = [], [], [], []
+    chunk = _mem.plan("monte_carlo", batch, _mem.mc_bytes(1))
+    batch = min(batch, chunk)
 
-    return histsp1, histsp2, indices
+    for idx_model, env, accp in _mc_setup(acc, l_spos, accep, optics):
+        indices.append(idx_model)
+        hist1, hist2 = [], []
+        drawn = 0
+        while drawn < max_part:
+            nbatch = min(batch, max_part - drawn)
+            new1, new2 = _mc_batch(env, nbatch, de_min, cutaccep, accp)
+            drawn += nbatch
+            done = hist1 and all(
+                _mc_converged(_np.concatenate(old), new, tol, criterion)
+                for old, new in ((hist1, new1), (hist2, new2))
+            )
+            hist1.append(new1)
+            hist2.append(new2)
+            if done:
+                break
+
+        histsp1.append(_np.concatenate(hist1))
+        histsp2.append(_np.concatenate(hist2))
+        samples.append(drawn)
+    _prof.count("mc_positions", len(samples))
+
+    return histsp1, histsp2, _np.array(indices), _np.array(samples)
+
+
+def _mc_converged(old, new, tol, criterion, nbins=50, min_frac=0.01):
+    """Stop criterion of histgms_adaptive for one sign."""
+    if not new.size or not old.size:
+        return not new.size and not old.size
+    if criterion == "ks":
+        return ks_distance(old, new) < tol
+    if criterion == "bins":
+        counts, _ = _np.histogram(_np.concatenate([old, new]), bins=nbins)
+        filled = counts[counts >= min_frac * counts.sum()]
+        return _np.max(1 / _np.sqrt(filled)) < tol
+    raise ValueError(f"unknown criterion: {criterion}")
+
+
+def ks_distance(old, new):
+    """Kolmogorov-Smirnov distance between two samples."""
+    if not old.size or not new.size:
+        return float(old.size != new.size)
+    both = _np.sort(_np.concatenate([old, new]))
+    cdf_old = _np.searchsorted(_np.sort(old), both, "right") / old.size
+    cdf_new = _np.searchsorted(_np.sort(new), both, "right") / new.size
+    return float(_np.max(_np.abs(cdf_old - cdf_new)))
@@ -0,0 +1,344 @@
+"""Asyncio job API for loss-map, density and Monte-Carlo workloads.
+
+The CPU bound work runs in a local process pool. Each submission returns
+a Job that can be awaited, streams one progress event per finished
+position and can be cancelled. Callbacks given at submission (disk
+writes, plotting) run in threads while the tracking goes on.
+"""
+import asyncio as _asyncio
+
+import numpy as _np
+
+import touschek_pack.parallel as to_par
+from touschek_pack.loss_profile import LossProfile
+from touschek_pack.model_state import ModelState
+
+
+class Job:
+    """Handle of a submitted workload.
+
+    Await the job to get its result. ``async for event in job.events()``
+    yields dictionaries with the keys kind, position, result, done and
+    total, one per finished position.
+    """
+
+    def __init__(self, kind, tasks, combine, on_result=None, on_event=None):
+        """.
+
+        kind      =               name of the workload.
+        tasks     = list of (positions, concurrent future).
+        combine   =  builds the job result from the chunk results.
+        on_result = callable(position, result) run in a thread.
+        on_event  = coroutine function(position, result) awaited in the
+                    event loop before the event of the position is sent.
+        """
+        self.kind = kind
+        self.total = sum(len(positions) for positions, _ in tasks)
+        self.done = 0
+        self._tasks = tasks
+        self._combine = combine
+        self._on_result = on_result
+        self._on_event = on_event
+        self._queue = _asyncio.Queue()
+        self._runner = _asyncio.ensure_future(self._run())
+
+    def __await__(self):
+        """."""
+        return self._runner.__await__()
+
+    def cancel(self):
+        """Cancels the positions not started yet and the job itself.
+
+        Positions already running in a worker finish in background, but
+        their results are discarded.
+        """
+        for _, fut in self._tasks:
+            fut.cancel()
+        self._runner.cancel()
+
+    def cancelled(self):
+        """."""
+        return self._runner.cancelled()
+
+    async def events(self):
+        """Asynchronous iterator over the progress events."""
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            yield event
+
+    async def _run(self):
+        """Collects the chunks as they finish."""
+        loop = _asyncio.get_running_loop()
+        pending = {
+            _asyncio.wrap_future(fut): positions
+            for positions, fut in self._tasks
+        }
+        order = list(pending)
+        results, callbacks = {}, []
+        try:
+            while pending:
+                finished, _ = await _asyncio.wait(
+                    pending, return_when=_asyncio.FIRST_COMPLETED
+                )
+                for wrapped in finished:
+                    positions = pending.pop(wrapped)
+                    chunk = wrapped.result()
+                    results[wrapped] = chunk
+                    for pos, res in zip(positions, chunk):
+                        if self._on_event is not None:
+                            await self._on_event(pos, res)
+                        self.done += 1
+                        if self._on_result is not None:
+                            callbacks.append(
+                                loop.run_in_executor(
+                                    None, self._on_result, pos, res
+                                )
+                            )
+                        self._queue.put_nowait(
+                            {
+                                "kind": self.kind,
+                                "position": pos,
+                                "result": res,
+                                "done": self.done,
+                                "total": self.total,
+                            }
+                        )
+            await _asyncio.gather(*callbacks)
+            chunks = [results[wrapped] for wrapped in order]
+            return self._combine([res for chunk in chunks for res in chunk])
+        finally:
+            for wrapped in pending:
+                wrapped.cancel()
+            self._queue.put_nowait(None)
+
+
+class AsyncAnalysis:
+    """Asyncio front end of a TousAnalysis running on a process pool.
+
+    The tracking state of the nominal model, the ones of the scraper
+    settings given at construction and the fitted model are broadcast to
+    the workers when the pool starts; tasks only carry fingerprints. A
+    loss map with another scraper setting starts a pool of its own for
+    that setting. Jobs must be submitted from a running event loop::
+
+        async with AsyncAnalysis(analysis) as runner:
+            job = runner.submit_lossmap(l_spos)
+            async for event in job.events():
+                ...
+            profile = (await job)["profile"]
+    """
+
+    def __init__(self, analysis, processes=None, vchambers=()):
+        """.
+
+        analysis  =                          TousAnalysis object.
+        processes = number of worker processes (None: all cores).
+        vchambers = scrapers' appertures broadcast with the pool.
+        """
+        self.analysis = analysis
+        self.processes = processes
+        self.vchambers = list(vchambers)
+        self._pool = None
+        self._scraper_pools = {}  # pools of later scraper settings
+        self._broadcast = set()  # fingerprints held by self._pool
+        self._track_state = None
+        self._fit_state = None
+
+    async def __aenter__(self):
+        """."""
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        """."""
+        self.shutdown(wait=exc[0] is None)
+
+    def start(self):
+        """Starts the process pool."""
+        if self._pool is None:
+            ana = self.analysis
+            self._track_state = ana.model_state("tracking")
+            self._fit_state = ModelState(ana.accelerator)
+            states = [self._track_state, self._fit_state]
+            states += [
+                ana.model_state("tracking", vch) for vch in self.vchambers
+            ]
+            self._broadcast = {state.fingerprint for state in states}
+            self._pool = to_par.make_pool(states, self.processes)
+
+    def shutdown(self, wait=True):
+        """Stops the process pools."""
+        pools = list(self._scraper_pools.values())
+        if self._pool is not None:
+            pools.append(self._pool)
+        for pool in pools:
+            pool.shutdown(wait=wait, cancel_futures=not wait)
+        self._pool = None
+        self._scraper_pools.clear()
+        self._broadcast = set()
+
+    def _submit(
+        self,
+        kind,
+        func,
+        positions,
+        args,
+        combine,
+        on_result,
+        on_event=None,
+        pool=None,
+    ):
+        """Submits one task per position and wraps them in a Job."""
+        self.start()
+        pool = self._pool if pool is None else pool
+        tasks = [
+            ([pos], pool.submit(func, *args(pos))) for pos in positions
+        ]
+        return Job(kind, tasks, combine, on_result, on_event)
+
+    def submit_lossmap(self, l_scattered_pos, vchamber=None, on_result=None):
+        """Loss map tracking, one task per scattering position.
+
+        l_scattered_pos =        scattered positions (list or numpy.array).
+        vchamber        = scrapers' apperture (None: nominal appertures).
+        on_result       =   callable(position, tracking dict) in a thread.
+
+        The result has the element indices, the tracking dictionaries and
+        the LossProfile. The profile of a running job is available as
+        job.profile and already holds a position when its event is sent.
+        The scattering rate and the binning of each position run in
+        threads, only the profile update runs in the event loop.
+        """
+        ana = self.analysis
+        spos = ana.spos
+        state, pool = self._track_state_for(vchamber)
+        loop = _asyncio.get_running_loop()
+        rate = loop.run_in_executor(None, ana._rate_nom_lattice)
+        profile = LossProfile()
+
+        def args(pos):
+            index = int(_np.argmin(_np.abs(pos - spos)))
+            return state, ana.deltas, ana.nturns, [index]
+
+        async def update(pos, dic):
+            index = int(_np.argmin(_np.abs(pos - spos)))
+            rate_idx = (await rate)[index]
+            lost_pos, part_prob = await loop.run_in_executor(
+                None, ana._track_lossrate, dic
+            )
+            profile.add(spos[index], lost_pos, part_prob * rate_idx)
+
+        def combine(tracks):
+            indices = [args(pos)[3][0] for pos in l_scattered_pos]
+            return {"indices": indices, "tracks": tracks, "profile": profile}
+
+        job = self._submit(
+            "lossmap",
+            to_par._track_positions,
+            l_scattered_pos,
+            args,
+            combine,
+            on_result,
+            update,
+            pool,
+        )
+        job.profile = profile
+        return job
+
+    def submit_densities(self, lsps, npt=5000, norm=False, on_result=None):
+        """Analytical loss densities (norm_cutacp), one task per position.
+
+        lsps      =              list of s positions.
+        npt       =    number of points of each density.
+        norm      = if True the densities are normalised.
+        on_result =  callable(position, dict) in a thread.
+        """
+        accep = self.analysis.accep
+        state = self._fit_state_for()
+
+        def args(pos):
+            return state, [pos], npt, accep, norm
+
+        def combine(dics):
+            return {
+                key: _np.concatenate([dic[key] for dic in dics])
+                for key in ("fdensp", "fdensn", "deltasp", "deltasn")
+            }
+
+        return self._submit(
+            "densities",
+            _single(to_par._density_positions),
+            lsps,
+            args,
+            combine,
+            on_result,
+        )
+
+    def submit_histograms(self, l_spos, cutaccep=False, on_result=None):
+        """Monte-Carlo densities (histgms), one task per position.
+
+        l_spos    =                     list of s positions.
+        cutaccep  = defines the cutoff on the energy acceptance.
+        on_result =       callable(position, tuple) in a thread.
+        """
+        ana = self.analysis
+        state = self._fit_state_for()
+
+        def args(pos):
+            return (
+                state,
+                [pos],
+                ana.num_part,
+                ana.accep,
+                ana.energy_dev_min,
+                cutaccep,
+            )
+
+        def combine(tups):
+            histsp = [tup[0][0] for tup in tups]
+            histsn = [tup[1][0] for tup in tups]
+            indices = _np.array([tup[2][0] for tup in tups])
+            return histsp, histsn, indices
+
+        return self._submit(
+            "histograms",
+            _single(to_par._mc_positions),
+            l_spos,
+            args,
+            combine,
+            on_result,
+        )
+
+    def _track_state_for(self, vchamber):
+        """Fingerprint of the tracking state and the pool holding it."""
+        self.start()
+        if vchamber is None:
+            return self._track_state.fingerprint, self._pool
+        state = self.analysis.model_state("tracking", vchamber)
+        key = state.fingerprint
+        if key in self._broadcast:
+            return key, self._pool
+        pool = self._scraper_pools.get(key)
+        if pool is None:
+            pool = to_par.make_pool([state], self.processes)
+            self._scraper_pools[key] = pool
+        return key, pool
+
+    def _fit_state_for(self):
+        """."""
+        self.start()
+        return self._fit_state.fingerprint
+
+
+class _single:
+    """Wraps a worker so that its result is a one element list."""
+
+    def __init__(self, func):
+        """."""
+        self.func = func
+
+    def __call__(self, *args):
+        """."""
+        return [self.func(*args)]
@@ -0,0 +1,104 @@
+"""Incremental accumulator for the loss profile along the ring."""
+import bisect as _bisect
+import numpy as _np
+
+
+class LossProfile:
+    """Integrated loss rate per lost position.
+
+    The profile is the trapezoidal integral, over the scattering positions,
+    of the loss rate found at each lost position. Inserting a scattering
+    position only changes the trapezoid weights of its two neighbours, so
+    each update costs O(nnz) of the columns involved instead of a full
+    recompute.
+    """
+
+    def __init__(self):
+        """."""
+        self._scat_pos = []  # sorted scattering positions
+        self._columns = []  # (lost keys, loss rates) of each position
+        self._weights = []  # trapezoid weight of each position
+        self._total = {}
+
+    def __len__(self):
+        """Number of scattering positions already accumulated."""
+        return len(self._scat_pos)
+
+    @property
+    def scattering_positions(self):
+        """."""
+        return _np.array(self._scat_pos)
+
+    @classmethod
+    def from_scat_dict(cls, dic, spos=None):
+        """Builds the profile from a dictionary given by get_scat_dict.
+
+        dic  = cointains the lost positions and the scattered points.
+        spos = if given, columns are integrated over the nearest s of ring.
+        """
+        profile = cls()
+        lost_pos = _np.asarray(dic["lost_positions"], dtype=float)
+        for key in lost_pos.tolist():
+            profile._total.setdefault(key, 0.0)
+
+        for key, column in dic.items():
+            if key == "lost_positions":
+                continue
+            scat_pos = float(key)
+            if spos is not None:
+                scat_pos = spos[_np.argmin(_np.abs(spos - scat_pos))]
+            column = _np.asarray(column, dtype=float)
+            nnz = _np.nonzero(column)[0]
+            profile.add(scat_pos, lost_pos[nnz], column[nnz])
+        return profile
+
+    def add(self, scat_pos, lost_keys, rates):
+        """Adds the loss rates of one scattering position.
+
+        scat_pos  =                    s position of the scattering point.
+        lost_keys = lost positions (or element indices) of the particles.
+        rates     =                   loss rate at each of the lost keys.
+
+        Adding an already accumulated position replaces its loss rates.
+        """
+        scat_pos = float(scat_pos)
+        column = (_np.asarray(lost_keys), _np.asarray(rates, dtype=float))
+
+        idx = _bisect.bisect_left(self._scat_pos, scat_pos)
+        if idx < len(self._scat_pos) and self._scat_pos[idx] == scat_pos:
+            self._scale_column(self._columns[idx], -self._weights[idx])
+            self._columns[idx] = column
+            self._scale_column(column, self._weights[idx])
+            return
+
+        self._scat_pos.insert(idx, scat_pos)
+        self._columns.insert(idx, column)
+        self._weights.insert(idx, 0.0)
+        for j in (idx - 1, idx, idx + 1):
+            if 0 <= j < len(self._scat_pos):
+                self._set_weight(j)
+
+    def profile(self):
+        """Returns the lost positions and the integrated loss rates."""
+        keys = _np.array(sorted(self._total))
+        summed = _np.array([self._total[key] for key in keys])
+        return keys, summed
+
+    def _set_weight(self, j):
+        """Updates the trapezoid weight of the j-th scattering position."""
+        spos = self._scat_pos
+        left = spos[j - 1] if j > 0 else spos[j]
+        right = spos[j + 1] if j < len(spos) - 1 else spos[j]
+        new_weight = (right - left) / 2
+        self._scale_column(self._columns[j], new_weight - self._weights[j])
+        self._weights[j] = new_weight
+
+    def _scale_column(self, column, factor):
+        """Adds factor times the column to the integrated loss rates."""
+        if not factor:
+            for key in column[0].tolist():
+                self._total.setdefault(key, 0.0)
+            return
+        total = self._total
+        for key, rate in zip(column[0].tolist(), column[1].tolist()):
+            total[key] = total.get(key, 0.0) + factor * rate
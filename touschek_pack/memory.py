@@ -0,0 +1,139 @@
+"""Memory budget and automatic chunking of the large arrays.
+
+The footprint of the heavy stages grows with the work they are given:
+the turn-by-turn output of ring_pass with deltas.size x nturns, the
+Monte-Carlo arrays with num_part and the loss densities with the number
+of positions x npt. When a budget is set, each stage estimates its
+footprint up front and splits its particles, Monte-Carlo samples or
+positions in chunks that fit::
+
+    memory.set_budget("4G")  # or TOUSCHEK_MEMORY_BUDGET=4G
+    analysis.get_scat_dict(...)
+    memory.report()  # chunking chosen by each stage
+
+The budget applies to the current process. Process pools made by
+touschek_pack.parallel share it evenly among their workers. Without a
+budget (the default) every stage runs in a single chunk.
+"""
+import contextlib as _contextlib
+import os as _os
+
+_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+# float64 values held per item by each stage, temporaries included
+_TRACK_FLOATS = 12  # initial and final coordinates, loss flags
+_TRACK_TURN_FLOATS = 6  # turn-by-turn coordinates
+_MC_FLOATS = 80  # beams, base change matrices and scattered momenta
+_DENSITY_FLOATS = 40  # f_function_arg_mod temporaries and outputs
+
+_REPORT = {}
+
+
+def parse_size(size):
+    """Number of bytes of a size given as int or string ("512M", "4GB")."""
+    if size is None or isinstance(size, (int, float)):
+        return None if size is None else int(size)
+    text = str(size).strip().lower().rstrip("b").rstrip("i")
+    unit = text[-1:] if text[-1:] in _UNITS else ""
+    return int(float(text[: len(text) - len(unit)]) * _UNITS[unit])
+
+
+_BUDGET = parse_size(_os.environ.get("TOUSCHEK_MEMORY_BUDGET") or None)
+
+
+def set_budget(size=None):
+    """Sets the memory budget of the process (None: no budget)."""
+    global _BUDGET
+    _BUDGET = parse_size(size)
+    return _BUDGET
+
+
+def get_budget():
+    """Memory budget in bytes, or None."""
+    return _BUDGET
+
+
+@_contextlib.contextmanager
+def budget(size):
+    """Sets the memory budget inside a with block."""
+    global _BUDGET
+    previous = _BUDGET
+    set_budget(size)
+    try:
+        yield _BUDGET
+    finally:
+        _BUDGET = previous
+
+
+def tracking_bytes(nparticles, nturns):
+    """Footprint of ring_pass with turn-by-turn output."""
+    floats = _TRACK_FLOATS + _TRACK_TURN_FLOATS * (nturns + 1)
+    return 8 * nparticles * floats
+
+
+def mc_bytes(num_part):
+    """Footprint of create_particles followed by scatter_particles."""
+    return 8 * _MC_FLOATS * num_part
+
+
+def replay_bytes(nparticles, nelem):
+    """Footprint of line_pass over one turn, element by element."""
+    return 8 * 6 * (nelem + 1) * nparticles
+
+
+def replay_record_bytes(nparticles, nelem):
+    """Size of an aperture replay record (envelopes and their turns)."""
+    return nparticles * (nelem * (4 * 4 + 4 * 2) + 2 + 4)
+
+
+def density_bytes(npos, npt):
+    """Footprint of the loss densities of npos positions."""
+    return 8 * _DENSITY_FLOATS * npos * npt
+
+
+def plan(stage, nitems, item_bytes, fixed_bytes=0):
+    """Chooses the chunk size of a stage and records it in the report.
+
+    stage       =                          name of the stage.
+    nitems      = number of items (particles, samples, positions).
+    item_bytes  =                  estimated bytes per item.
+    fixed_bytes =      bytes that do not depend on the chunking.
+
+    Returns the number of items per chunk.
+    """
+    nitems = int(nitems)
+    estimate = fixed_bytes + item_bytes * nitems
+    if _BUDGET is None or estimate <= _BUDGET or nitems == 0:
+        chunk = max(nitems, 1)
+    else:
+        free = max(_BUDGET - fixed_bytes, 0)
+        chunk = int(min(max(free // max(item_bytes, 1), 1), nitems))
+    peak = fixed_bytes + item_bytes * min(chunk, nitems)
+    _REPORT[stage] = {
+        "items": nitems,
+        "chunk": chunk,
+        "nchunks": -(-nitems // chunk),
+        "estimate": int(estimate),
+        "peak": int(peak),
+        "budget": _BUDGET,
+        "fits": _BUDGET is None or peak <= _BUDGET,
+    }
+    return chunk
+
+
+def chunks(nitems, chunk):
+    """Slices splitting range(nitems) in chunks of at most chunk items."""
+    return [
+        slice(start, min(start + chunk, nitems))
+        for start in range(0, nitems, chunk)
+    ]
+
+
+def report():
+    """Chunking chosen by the last run of each stage."""
+    return {stage: dict(info) for stage, info in _REPORT.items()}
+
+
+def clear_report():
+    """."""
+    _REPORT.clear()
@@ -0,0 +1,101 @@
+"""Immutable model-state handles for concurrent analyses."""
+import pickle as _pickle
+
+from touschek_pack.functions import model_fingerprint, set_vchamber_scraper
+
+_FLAGS = ("cavity_on", "radiation_on", "vchamber_on")
+
+
+class ModelState:
+    """Lattice, flags and appertures frozen in a serialised snapshot.
+
+    The handle owns a private copy of the accelerator, so later changes
+    of the original model never reach it. The copy is serialised once;
+    pickling the handle (e.g. to send it to pool workers) only sends those
+    bytes. model() gives a cached instance that must be treated as read
+    only, and copy() gives a private accelerator that may be modified.
+    """
+
+    def __init__(self, model, vchamber=None, scrap_inds=None, **flags):
+        """.
+
+        model      =                          accelerator model.
+        vchamber   = scrapers' apperture (hmin, hmax, vmin, vmax).
+        scrap_inds =  (horizontal, vertical) indices of scrapers.
+        flags      =    cavity_on, radiation_on and vchamber_on.
+        """
+        unknown = set(flags) - set(_FLAGS)
+        if unknown:
+            raise ValueError(f"unknown model flags: {sorted(unknown)}")
+
+        model = _pickle.loads(_pickle.dumps(model))
+        for flag, value in flags.items():
+            setattr(model, flag, value)
+        if vchamber is not None:
+            set_vchamber_scraper(model, vchamber, *scrap_inds)
+
+        self._model = model
+        self._payload = _pickle.dumps(model)
+        self._fingerprint = model_fingerprint(model)
+        self._lattice_fingerprint = None
+
+    @classmethod
+    def _from_payload(cls, payload, fingerprint):
+        """Rebuilds a handle from its serialised model."""
+        state = cls.__new__(cls)
+        state._model = None
+        state._payload = payload
+        state._fingerprint = fingerprint
+        state._lattice_fingerprint = None
+        return state
+
+    def __reduce__(self):
+        """."""
+        return (ModelState._from_payload, (self._payload, self._fingerprint))
+
+    def __eq__(self, other):
+        """."""
+        if not isinstance(other, ModelState):
+            return NotImplemented
+        return self._fingerprint == other._fingerprint
+
+    def __hash__(self):
+        """."""
+        return hash(self._fingerprint)
+
+    @property
+    def fingerprint(self):
+        """Hash of lattice, appertures and flags."""
+        return self._fingerprint
+
+    @property
+    def lattice_fingerprint(self):
+        """Hash of lattice and flags, without the appertures."""
+        if self._lattice_fingerprint is None:
+            self._lattice_fingerprint = model_fingerprint(
+                self.model(), apertures=False
+            )
+        return self._lattice_fingerprint
+
+    @property
+    def payload(self):
+        """Serialised accelerator."""
+        return self._payload
+
+    def model(self):
+        """Shared accelerator of this state (read only by contract)."""
+        if self._model is None:
+            self._model = _pickle.loads(self._payload)
+        return self._model
+
+    def copy(self):
+        """Private accelerator that can be freely modified."""
+        return _pickle.loads(self._payload)
+
+    def with_flags(self, **flags):
+        """Returns a new state with other flags."""
+        return ModelState(self.model(), **flags)
+
+    def with_scrapers(self, vchamber, scrap_inds):
+        """Returns a new state with other scrapers' appertures."""
+        return ModelState(self.model(), vchamber, scrap_inds)
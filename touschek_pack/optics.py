@@ -0,0 +1,166 @@
+"""Optics snapshot: lattice quantities of a model computed once."""
+import collections as _collections
+import time as _time
+
+import numpy as _np
+import pyaccel as _pyaccel
+
+import touschek_pack.functions as to_fu
+from touschek_pack import profiling as _prof
+
+_SNAPSHOTS = _collections.OrderedDict()  # snapshots of the last models
+_SNAPSHOTS_SIZE = 8
+
+
+class OpticsSnapshot:
+    """Lattice quantities of one model, each computed on first use.
+
+    Holds the s positions, twiss and beam envelopes at every element
+    (closed indices), the Lifetime object with the Touschek coefficients
+    b1 and b2 and rate, the Touschek energy acceptance and its 10 cm grid
+    (get_scaccep). The functions taking an optics argument read them
+    from here instead of recomputing them.
+
+    An acceptance given at construction (e.g. a tracked one) is also the
+    one of the Lifetime object, so b1, b2, rate and elements_rate use it
+    too.
+
+    The snapshot belongs to the model as it was when the snapshot was
+    created: after any change of the model or of the acceptance, build a
+    new one (see is_current and snapshot).
+    """
+
+    def __init__(self, model, accep=None):
+        """.
+
+        model = accelerator model.
+        accep = Touschek energy acceptance (None: computed when needed).
+        """
+        self.model = model
+        self.fingerprint = to_fu.model_fingerprint(model)
+        self.report = {}
+        self._cache = {}
+        self._given_accep = accep is not None
+        if accep is not None:
+            self._cache["accep"] = accep
+
+    def _get(self, name, func, *args, **kwargs):
+        """Computes a quantity once and records its cost."""
+        value = self._cache.get(name)
+        if value is None:
+            t0 = _time.perf_counter()
+            with _prof.stage("optics." + name):
+                value = func(*args, **kwargs)
+            self.report[name] = _time.perf_counter() - t0
+            self._cache[name] = value
+        return value
+
+    def is_current(self, model=None):
+        """True if model (default: the snapshot model) was not changed."""
+        model = self.model if model is None else model
+        return to_fu.model_fingerprint(model) == self.fingerprint
+
+    @property
+    def spos(self):
+        """s position of every element (closed)."""
+        return self._get(
+            "spos",
+            lambda: _np.ascontiguousarray(
+                _pyaccel.lattice.find_spos(self.model, indices="closed")
+            ),
+        )
+
+    @property
+    def twiss(self):
+        """Twiss parameters at every element (closed)."""
+        return self._get(
+            "twiss",
+            lambda: _pyaccel.optics.calc_twiss(self.model, indices="closed")[
+                0
+            ],
+        )
+
+    @property
+    def envelopes(self):
+        """Beam envelopes at every element (open)."""
+        return self._get(
+            "envelopes",
+            lambda: _np.ascontiguousarray(
+                _pyaccel.optics.calc_beamenvelope(self.model)
+            ),
+        )
+
+    @property
+    def ltime(self):
+        """Lifetime object of the model (with the given acceptance)."""
+        return self._get("ltime", self._lifetime)
+
+    def _lifetime(self):
+        """."""
+        ltime = _pyaccel.lifetime.Lifetime(self.model)
+        if self._given_accep:
+            accn, accp = self.accep
+            ltime.accepen = {"spos": self.spos, "accp": accp, "accn": accn}
+        return ltime
+
+    @property
+    def b1(self):
+        """Touschek coefficient b1 on the 10 cm grid."""
+        return self.ltime.touschek_data["touschek_coeffs"]["b1"]
+
+    @property
+    def b2(self):
+        """Touschek coefficient b2 on the 10 cm grid."""
+        return self.ltime.touschek_data["touschek_coeffs"]["b2"]
+
+    @property
+    def rate(self):
+        """Touschek scattering rate on the 10 cm grid."""
+        return self.ltime.touschek_data["rate"]
+
+    @property
+    def accep(self):
+        """Touschek energy acceptance."""
+        return self._get(
+            "accep",
+            _pyaccel.optics.calc_touschek_energy_acceptance,
+            self.model,
+        )
+
+    def scaccep(self, accep=None):
+        """10 cm grid and energy acceptance on it (as get_scaccep).
+
+        accep = acceptance to be used (None: the snapshot acceptance).
+        """
+        if accep is None or accep is self.accep:
+            return self._get(
+                "scaccep",
+                to_fu.get_scaccep,
+                self.model,
+                self.accep,
+                spos=self.spos,
+            )
+        return to_fu.get_scaccep(self.model, accep, spos=self.spos)
+
+    @property
+    def elements_rate(self):
+        """Touschek scattering rate interpolated at every element."""
+        return self._get(
+            "elements_rate", to_fu.get_elements_rate, self.model, self.ltime
+        )
+
+
+def snapshot(model):
+    """OpticsSnapshot of model, shared by the calls on the same lattice.
+
+    Snapshots are kept for the last models used and found by fingerprint,
+    so a changed model (lattice, flags or appertures) gets a new one.
+    """
+    key = to_fu.model_fingerprint(model)
+    snap = _SNAPSHOTS.pop(key, None)
+    if snap is None:
+        snap = OpticsSnapshot(model)
+    _SNAPSHOTS[key] = snap
+    while len(_SNAPSHOTS) > _SNAPSHOTS_SIZE:
+        _SNAPSHOTS.popitem(last=False)
+    return snap
@@ -0,0 +1,287 @@
+"""Process-pool helpers to run tracking concurrently.
+
+Model states are broadcast to the workers once, by the pool initializer.
+Tasks only carry the fingerprint of the state they use, so the lattice is
+never pickled per task.
+"""
+import concurrent.futures as _futures
+import multiprocessing as _mp
+import os as _os
+import queue as _queue
+
+import numpy as _np
+
+import touschek_pack.functions as to_fu
+from touschek_pack import memory as _mem
+from touschek_pack.optics import OpticsSnapshot
+
+_WORKER_STATES = {}
+_WORKER_OPTICS = {}  # optics snapshots of the states, by fingerprint
+
+
+def _init_worker(states, budget=None, seeds=None):
+    """Pool initializer: keeps the model states and the memory budget.
+
+    seeds = queue of SeedSequence, one per worker, used to reseed the
+            Monte-Carlo generator so workers never share random streams.
+    """
+    _WORKER_STATES.clear()
+    _WORKER_STATES.update(states)
+    _WORKER_OPTICS.clear()
+    _mem.set_budget(budget)
+    if seeds is not None:
+        try:
+            seed = seeds.get(timeout=5)
+        except _queue.Empty:  # worker started beyond the seeds spawned
+            seed = _np.random.SeedSequence(spawn_key=(_os.getpid(),))
+        to_fu.set_random_seed(seed)
+
+
+def worker_model(state):
+    """Accelerator of a state inside a worker (read only).
+
+    state = fingerprint of a state broadcast by make_pool.
+    """
+    return _WORKER_STATES[state].model()
+
+
+def worker_optics(state):
+    """OpticsSnapshot of a state inside a worker, built once per state."""
+    snap = _WORKER_OPTICS.get(state)
+    if snap is None:
+        snap = _WORKER_OPTICS[state] = OpticsSnapshot(worker_model(state))
+    return snap
+
+
+def make_pool(states, processes=None):
+    """Process pool whose workers hold the given model states.
+
+    states    =           iterable of ModelState to be broadcast.
+    processes = number of worker processes (None: all cores).
+
+    The memory budget of the current process, if any, is shared evenly
+    among the workers. Each worker gets its own random stream, spawned
+    from the generator of the current process (see set_random_seed).
+    """
+    processes = processes or _os.cpu_count() or 1
+    states = {state.fingerprint: state for state in states}
+    budget = _mem.get_budget()
+    if budget is not None:
+        budget //= processes
+    ctx = _mp.get_context()
+    seeds = ctx.Queue()
+    root = _np.random.SeedSequence(int(to_fu._RNG.integers(2**63)))
+    for seed in root.spawn(processes):
+        seeds.put(seed)
+    return _futures.ProcessPoolExecutor(
+        processes,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(states, budget, seeds),
+    )
+
+
+def _track_positions(state, deltas, nturns, indices, binned=False):
+    """Worker: tracks a list of positions.
+
+    binned = if True, each item is the tracking dictionary and its
+             track_lossrate binning.
+    """
+    model = worker_model(state)
+    dics = [
+        to_fu.track_eletrons_d(deltas, nturns, idx, model, parallel=False)
+        for idx in indices
+    ]
+    if not binned:
+        return dics
+    spos = worker_optics(state).spos
+    return [(dic, to_fu.track_lossrate(spos, dic)) for dic in dics]
+
+
+def _density_positions(state, lsps, npt, accep, norm):
+    """Worker: analytical loss densities (norm_cutacp) of positions."""
+    snap = worker_optics(state)
+    return to_fu.norm_cutacp(
+        snap.model, lsps, npt, accep, norm, optics=snap
+    )
+
+
+def _mc_positions(state, l_spos, num_part, accep, de_min, cutaccep):
+    """Worker: Monte-Carlo scattering densities (histgms) of positions."""
+    snap = worker_optics(state)
+    return to_fu.histgms(
+        snap.model, l_spos, num_part, accep, de_min, cutaccep, optics=snap
+    )
+
+
+def _seed_optics(state, lsps, npt, accep=None):
+    """Worker: acceptance, rate and loss densities of a fitted model.
+
+    accep = energy acceptance (None: the linear one of the model), also
+            used for the rate.
+    """
+    if accep is None:
+        snap = worker_optics(state)
+        accep = snap.accep
+    else:
+        snap = OpticsSnapshot(worker_model(state), accep)
+    dens = None
+    if npt:
+        dens = to_fu.norm_cutacp(
+            snap.model, lsps, npt, accep, norm=True, optics=snap
+        )
+    return {
+        "accep": accep,
+        "rate": snap.elements_rate,
+        "densities": dens,
+    }
+
+
+def _acceptance_positions(state, indices, nturns, delta_max, tol, ntrial):
+    """Worker: tracked momentum acceptance of a list of elements."""
+    model = worker_model(state)
+    return [
+        to_fu.bisect_acceptance(
+            model, idx, nturns, delta_max, tol, ntrial, parallel=False
+        )
+        for idx in indices
+    ]
+
+
+def tracked_acceptance(
+    state,
+    indices,
+    nturns,
+    delta_max=0.1,
+    tol=1e-4,
+    ntrial=4,
+    processes=None,
+):
+    """Tracked momentum acceptance of many elements concurrently.
+
+    state     =            ModelState with the tracking flags set.
+    indices   =             element indices where it is computed.
+    nturns    =                     number of turns to survive.
+    delta_max =            largest energy deviation searched.
+    tol       =                 tolerance of the acceptance.
+    ntrial    = trial deviations of each sign per ring_pass.
+    processes =  number of worker processes (None: all cores).
+
+    Elements are split among the workers, each running
+    bisect_acceptance on its elements. Returns the negative and the
+    positive acceptance at indices, as arrays.
+    """
+    processes = processes or _os.cpu_count() or 1
+    args = (nturns, delta_max, tol, ntrial)
+    with make_pool([state], processes) as pool:
+        futures = submit_acceptance(
+            pool, state, indices, *args, nchunks=4 * processes
+        )
+        return acceptance_result(futures)
+
+
+def submit_acceptance(
+    pool, state, indices, nturns, delta_max, tol, ntrial=4, nchunks=1
+):
+    """Submits the tracked acceptance of indices to a pool.
+
+    pool    = pool from make_pool holding state.
+    nchunks =      number of tasks the elements are split in.
+
+    The other arguments are the ones of tracked_acceptance. Returns the
+    futures, to be passed to acceptance_result.
+    """
+    indices = [int(idx) for idx in indices]
+    args = (nturns, delta_max, tol, ntrial)
+    return [
+        pool.submit(_acceptance_positions, state.fingerprint, chunk, *args)
+        for chunk in _split(indices, nchunks)
+    ]
+
+
+def acceptance_result(futures):
+    """Negative and positive acceptance from submit_acceptance futures."""
+    accs = [acc for fut in futures for acc in fut.result()]
+    return _np.array(accs, dtype=float).reshape(-1, 2).T
+
+
+def acceptance_indices(nelem, npoints=None):
+    """Elements evenly spread where the acceptance is tracked.
+
+    nelem   =                 number of elements of the model.
+    npoints = number of elements tracked (None: all elements).
+    """
+    npts = min(npoints or nelem, nelem)
+    return _np.unique(_np.linspace(0, nelem - 1, npts).astype(int))
+
+
+def interp_acceptance(spos, indices, accs):
+    """Acceptance of every element from the tracked elements.
+
+    spos    =         s position of every element (closed).
+    indices =                     tracked elements.
+    accs    = negative and positive acceptance at indices.
+
+    The interpolation is periodic in the ring circumference.
+    """
+    period = spos[-1]
+    return _np.array(
+        [
+            _np.interp(spos, spos[indices], acc, period=period)
+            for acc in accs
+        ]
+    )
+
+
+def _split(items, nchunks):
+    """Splits items in at most nchunks contiguous chunks."""
+    if not len(items):
+        return []
+    nchunks = max(1, min(nchunks, len(items)))
+    size = -(-len(items) // nchunks)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def scraper_sweep(
+    state,
+    vchambers,
+    deltas,
+    nturns,
+    indices,
+    scrap_inds,
+    processes=None,
+):
+    """Tracks all positions for each scraper apperture concurrently.
+
+    state      =           ModelState with the tracking flags set.
+    vchambers  =       list of scrapers' apperture to be evaluated.
+    deltas     =                   energy deviations for tracking.
+    nturns     =                               number of turns.
+    indices    =          element indices of scattering positions.
+    scrap_inds = (horizontal, vertical) indices of the scrapers.
+    processes  =     number of worker processes (None: all cores).
+
+    Every setting is an independent ModelState, so the appertures of one
+    setting never leak into another. Returns, for each setting, the list
+    of tracking dictionaries in the order of indices.
+    """
+    indices = list(indices)
+    processes = processes or _os.cpu_count() or 1
+    states = [state.with_scrapers(vch, scrap_inds) for vch in vchambers]
+    nchunks = -(-processes // max(1, len(states)))
+    chunks = _split(indices, nchunks)
+
+    with make_pool(states, processes) as pool:
+        futures = [
+            [
+                pool.submit(
+                    _track_positions, stt.fingerprint, deltas, nturns, chunk
+                )
+                for chunk in chunks
+            ]
+            for stt in states
+        ]
+        return [
+            [dic for fut in setting for dic in fut.result()]
+            for setting in futures
+        ]
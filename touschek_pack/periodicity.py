@@ -0,0 +1,135 @@
+"""Superperiod structure of the ring.
+
+In a ring made of identical superperiods the optics, the scattering
+densities and the tracking from a given element repeat in every
+superperiod. Results computed for one superperiod are mapped around the
+ring by shifting element indices by multiples of the superperiod size.
+"""
+import numpy as _np
+from pyaccel.lattice import find_spos as _find_spos
+
+from touschek_pack.functions import element_signature, track_eletrons_d
+
+
+class Periodicity:
+    """Superperiods of a ring and the maps between them."""
+
+    def __init__(self, nelem, nperiods, length):
+        """.
+
+        nelem    =           number of elements of the ring.
+        nperiods =                  number of superperiods.
+        length   = circumference of the ring [m].
+        """
+        self.nelem = int(nelem)
+        self.nperiods = int(nperiods)
+        self.length = float(length)
+
+    @property
+    def period(self):
+        """Number of elements of a superperiod."""
+        return self.nelem // self.nperiods
+
+    @property
+    def period_length(self):
+        """Length of a superperiod [m]."""
+        return self.length / self.nperiods
+
+    def fold_index(self, index):
+        """Equivalent index in the first superperiod and the shift back."""
+        base = int(index) % self.period
+        return base, int(index) - base
+
+    def unfold_index(self, index, shift):
+        """Maps an element index of the first superperiod by shift."""
+        return (_np.asarray(index) + shift) % self.nelem
+
+    def fold_positions(self, l_spos):
+        """Equivalent positions in the first superperiod.
+
+        Returns the distinct folded positions, the inverse map giving the
+        folded position of each input and the element shift of each input.
+        """
+        l_spos = _np.asarray(l_spos, dtype=float)
+        nper = _np.floor(l_spos / self.period_length)
+        folded = _np.round(l_spos - nper * self.period_length, 9)
+        folded, inverse = _np.unique(folded, return_inverse=True)
+        return folded, inverse, nper.astype(int) * self.period
+
+    def map_track(self, dic, shift):
+        """Tracking dictionary of track_eletrons_d shifted by shift."""
+        dic = dict(dic)
+        dic["element_lost"] = _np.intp(
+            self.unfold_index(dic["element_lost"], shift)
+        )
+        return dic
+
+
+def find_periodicity(acc, nperiods=None):
+    """Returns the Periodicity of acc.
+
+    acc      =                                     accelerator model.
+    nperiods = number of superperiods to be checked (None: detected as
+               the largest number of identical superperiods).
+
+    Elements are compared by type, fields and apertures, so scrapers or
+    insertion devices present in only some superperiods break the
+    symmetry. A ValueError is raised if acc does not have nperiods.
+    """
+    nelem = len(acc)
+    length = _find_spos(acc, indices="closed")[-1]
+    sigs = [element_signature(elem) for elem in acc]
+
+    if nperiods is None:
+        cands = [num for num in range(nelem, 1, -1) if not nelem % num]
+    else:
+        cands = [int(nperiods)]
+    for num in cands:
+        period = nelem // num
+        if not nelem % num and all(
+            sigs[idx] == sigs[idx % period] for idx in range(period, nelem)
+        ):
+            return Periodicity(nelem, num, length)
+
+    if nperiods is not None and int(nperiods) != 1:
+        raise ValueError(f"lattice does not have {nperiods} superperiods")
+    return Periodicity(nelem, 1, length)
+
+
+def validate_tracking(model, periodicity, deltas, nturns, indices):
+    """Compares mapped tracking with full-ring tracking.
+
+    model       =             accelerator model used for tracking.
+    periodicity =                      Periodicity of the model.
+    deltas      =                energy deviations for tracking.
+    nturns      =                                number of turns.
+    indices     = element indices of the positions to be checked.
+
+    Returns, for each index, the fraction of tracked particles lost at the
+    same element and turn by both computations.
+    """
+    agreement = []
+    for index in indices:
+        base, shift = periodicity.fold_index(index)
+        full = track_eletrons_d(deltas, nturns, index, model)
+        mapped = periodicity.map_track(
+            track_eletrons_d(deltas, nturns, base, model), shift
+        )
+        lost_full = _lost_map(full)
+        lost_mapped = _lost_map(mapped)
+        same = sum(
+            lost_full.get(delta) == lost for delta, lost in lost_mapped.items()
+        )
+        total = len(set(lost_full) | set(lost_mapped))
+        agreement.append(1.0 if not total else same / total)
+    return {"indices": list(indices), "agreement": agreement}
+
+
+def _lost_map(dic):
+    """Maps energy deviation to (element, turn) of the lost particles."""
+    return {
+        float(delta): (int(elem), int(turn))
+        for delta, elem, turn in zip(
+            dic["energy_deviation"], dic["element_lost"], dic["turn_lost"]
+        )
+    }
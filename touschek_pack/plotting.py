@@ -0,0 +1,326 @@
+"""Plotting layer of touschek_pack.
+
+Only this module imports matplotlib. The compute API (functions and
+TousAnalysis computations) never imports it, so batch workers do not pay
+its import cost.
+"""
+import matplotlib.pyplot as _plt
+import matplotlib.cm as _cm
+import numpy as _np
+import pyaccel as _pyaccel
+
+from touschek_pack import optics as _optics
+from touschek_pack import profiling as _prof
+
+
+def lattice_curves(acc):
+    """s positions and betax of acc, from the optics snapshot of acc.
+
+    acc = accelerator model.
+
+    Snapshots are keyed by the model fingerprint, so changing the lattice
+    or its appertures gives new curves.
+    """
+    snap = _optics.snapshot(acc)
+    return {"spos": snap.spos[:-1], "betax": snap.twiss.betax[:-1]}
+
+
+def _downsample(val, shape):
+    """Sums val over contiguous blocks to at most shape pixels."""
+    for axis, npix in enumerate(shape):
+        size = val.shape[axis]
+        if size > npix:
+            starts = _np.linspace(0, size, npix + 1)[:-1].astype(int)
+            starts = _np.unique(starts)
+            val = _np.add.reduceat(val, starts, axis=axis)
+    return val
+
+
+@_prof.timed("plotting")
+def plot_track_d(
+    acc,
+    dic_tracked,
+    index_list,
+    offs_list,
+    par,
+    element_idx,
+    accep,
+    delt,
+    f_dens,
+):
+    """Plot the tracking results for a given s position.
+
+    acc         =                                    accelerator model.
+    dic_tracked =      dictionary of informations provided by tracking.
+    index_list  =     defines the physical limitants from linear model.
+    offs_list   =                       list of e_dev used in tracking.
+    par         =  defines the analysis for positive or negative e_dev.
+    element_idx =              defines initial conditions for tracking.
+    accep       =                           touschek energy acceptance.
+    delt        =  energy deviation for the touschek loss rate density.
+    fdens       =                           touschek loss rate density.
+    """
+    # ----------------
+
+    turn_lost = dic_tracked["turn_lost"]
+    element_lost = dic_tracked["element_lost"]
+    deltas = dic_tracked["energy_deviation"] * 1e2
+
+    cm = 1 / 2.54  # 'poster'
+    curves = lattice_curves(acc)
+    betax = curves["betax"] * (1 / 5)
+    spos = curves["spos"]
+
+    fig = _plt.figure(figsize=(38.5 * cm, 18 * cm))
+    gs = _plt.GridSpec(
+        1,
+        3,
+        left=0.1,
+        right=0.98,
+        wspace=0.03,
+        top=0.95,
+        bottom=0.1,
+        width_ratios=[2, 3, 8],
+    )
+    a1 = fig.add_subplot(gs[0, 0])
+    a2 = fig.add_subplot(gs[0, 1], sharey=a1)
+    a3 = fig.add_subplot(gs[0, 2], sharey=a1)
+    a1.tick_params(axis="both", labelsize=18)
+    a2.tick_params(
+        axis="y",
+        which="both",
+        left=False,
+        right=False,
+        labelleft=False,
+        labelsize=18,
+    )
+    a3.tick_params(
+        axis="y",
+        which="both",
+        left=False,
+        right=False,
+        labelleft=False,
+        labelsize=18,
+    )
+    a2.tick_params(axis="both", labelsize=18)
+    a3.tick_params(axis="both", labelsize=18)
+    a1.set_title(r"$\delta \times scat. rate$", fontsize=20)
+    a2.set_title(r"$\delta \times$ lost turn", fontsize=20)
+    a3.set_title(r"tracking ", fontsize=20)
+
+    a1.set_xlabel(r"$\tau _T$ [1/s]", fontsize=25)
+    a2.set_xlabel(r"number of turns", fontsize=25)
+    a3.set_xlabel(r"$s$ [m]", fontsize=25)
+
+    a1.grid(True, alpha=0.5, ls="--", color="k", axis="y")
+    a2.grid(True, alpha=0.5, ls="--", color="k", axis="y")
+    a3.grid(True, alpha=0.5, ls="--", color="k", axis="y")
+    _plt.subplots_adjust(wspace=0.1)
+
+    if "pos" in par:
+        a1.set_ylabel(r"positive $\delta$ [%]", fontsize=25)
+        a3.plot(spos[element_lost], deltas, "r.", label="lost pos. (track)")
+        acp_s = accep[1][element_idx]
+        indx = _np.argmin(_np.abs(offs_list - acp_s))
+        a3.plot(
+            spos[index_list][:indx],
+            offs_list[:indx] * 1e2,
+            "b.",
+            label=r"accep. limit",
+            alpha=0.25,
+        )
+
+    elif "neg" in par:
+        a1.set_ylabel(r"negative $\delta$ [%]", fontsize=25)
+        a3.plot(spos[element_lost], deltas, "r.", label="lost pos. (track)")
+        acp_s = accep[0][element_idx]
+        indx = _np.argmin(_np.abs(offs_list + acp_s))
+        a3.plot(
+            spos[index_list][:indx],
+            -offs_list[:indx] * 1e2,
+            "b.",
+            label=r"accep. limit",
+            alpha=0.25,
+        )
+
+    a1.plot(f_dens, delt, label="Scattering touschek rate", color="black")
+    a2.plot(turn_lost, deltas, "k.")
+    stri = f"{acc[element_idx].fam_name}, ({spos[element_idx]:.2f} m)"
+    a3.plot(spos[element_idx], 0, "ko", label=stri)
+    a3.plot(
+        spos, _np.sqrt(betax), color="orange", label=r"$ \sqrt{\beta_x}  $"
+    )
+    _plt.hlines(
+        acp_s * 1e2,
+        spos[0],
+        spos[-1],
+        color="black",
+        linestyles="dashed",
+        alpha=0.5,
+    )
+    _pyaccel.graphics.draw_lattice(acc, offset=-0.5, height=0.5, gca=True)
+    a3.legend(loc="upper right", ncol=1, fontsize=15)
+    fig.show()
+
+
+@_prof.timed("plotting")
+def plot_normtousd(acc, spos_ring, spos, dic):
+    """Touschek scattering loss density.
+
+    acc       =                     accelerator model.
+    spos_ring =     s position of every model element.
+    spos      = s positions where dic was calculated.
+    dic       =           densities given by norm_cutacp.
+    """
+    fdensp, fdensn = dic["fdensp"], dic["fdensn"]
+    deltasp, deltasn = dic["deltasp"], dic["deltasn"]
+
+    _, ax = _plt.subplots(figsize=(10, 5))
+    ax.set_title("Probability density analytically calculated", fontsize=20)
+    ax.grid(True, alpha=0.5, ls="--", color="k")
+    ax.xaxis.grid(False)
+    ax.set_xlabel(r"$\delta$ [%]", fontsize=25)
+    ax.set_ylabel("PDF", fontsize=25)
+    ax.tick_params(axis="both", labelsize=28)
+
+    for idx, _ in enumerate(spos):
+        array_fdens = fdensp[idx]
+        # pega o primeiro item onde ocorre a condição passada
+        # como argumento para a função numpy.where
+        index = _np.intp(_np.where(array_fdens <= 1e-2)[0][1])
+
+        # this block selects the best index
+        # for plot the density distribution
+        if not idx:
+            best_index = index
+        else:
+            if best_index < index:  # eu não entendi direito porquê disso
+                best_index = index
+            else:
+                pass
+
+    for idx, s in enumerate(spos):
+        mod_ind = _np.argmin(_np.abs(spos_ring - s))
+
+        fdenspi = fdensp[idx][:best_index]
+        fdensni = fdensn[idx][:best_index]
+        deltaspi = deltasp[idx][:best_index] * 1e2
+        deltasni = -deltasn[idx][:best_index] * 1e2
+
+        color = _cm.gist_rainbow(idx / len(spos))
+        not_desired = [
+            "calc_mom_accep",
+            "mia",
+            "mib",
+            "mip",
+            "mb1",
+            "mb2",
+            "mc",
+        ]
+
+        while acc[mod_ind].fam_name in not_desired:
+            mod_ind += 1
+
+        fam_name = acc[mod_ind].fam_name
+        s_stri = _np.round(spos_ring[mod_ind], 2)
+        stri = f"{fam_name} em {s_stri} m"
+
+        ax.plot(deltaspi, fdenspi, label=stri, color=color)
+        ax.plot(deltasni, fdensni, color=color)
+
+    ax.legend(loc="best", fontsize=20)
+
+
+@_prof.timed("plotting")
+def plot_histograms(acc, spos_ring, hp, hn, idx_model):
+    """Touschek scattering density from Monte-Carlo simulation.
+
+    acc       =                    accelerator model.
+    spos_ring =    s position of every model element.
+    hp        = positive e_dev of each position [%].
+    hn        = negative e_dev of each position [%].
+    idx_model =          model indices of positions.
+    """
+    fig, ax = _plt.subplots(
+        ncols=len(idx_model), nrows=1, figsize=(30, 10), sharey=True
+    )
+    fig.suptitle(
+        "Probability density calculated by Monte-Carlo simulation",
+        fontsize=20,
+    )
+
+    for index, iten in enumerate(idx_model):
+        color = _cm.jet(index / len(idx_model))
+        ay = ax[index]
+        if not index:
+            ay.set_ylabel("PDF", fontsize=25)
+
+        ay.grid(True, alpha=0.5, ls="--", color="k")
+        ay.xaxis.grid(False)
+        ay.set_xlabel(r"$\delta$ [%]", fontsize=25)
+        ay.tick_params(axis="both", labelsize=18)
+
+        stri = f"{acc[iten].fam_name:s}, {spos_ring[iten]:.2f}"
+        ay.hist(hp[index], density=True, bins=200, color=color, label=stri)
+        ay.hist(hn[index], density=True, bins=200, color=color)
+        _plt.tight_layout()
+        ay.legend()
+
+
+@_prof.timed("plotting")
+def plot_loss_profile(acc, lost_pos, summed):
+    """Plot the loss rate integral along the ring.
+
+    acc      =                       accelerator model.
+    lost_pos =          lost positions along the ring.
+    summed   = loss rate integrated over the scattering.
+    """
+    _, ax = _plt.subplots(
+        figsize=(13, 7), gridspec_kw={"hspace": 0.2, "wspace": 0.2}
+    )
+    ax.set_title("loss rate integral along the ring", fontsize=16)
+
+    ax.set_xlabel("lost position [m]", fontsize=16)
+    ax.set_ylabel("loss rate [1/s]", fontsize=16)
+    ax.tick_params(axis="both", labelsize=16)
+
+    ax.plot(lost_pos, summed, color="navy")
+    _pyaccel.graphics.draw_lattice(acc, offset=-1e-6, height=1e-6, gca=True)
+
+
+@_prof.timed("plotting")
+def plot_scat_dict(spos_ring, table, max_pixels=1000):
+    """Heatmap plot indicating the warm points of loss along the ring.
+
+    spos_ring  =              s position of every model element.
+    table      =                     ScatTable with the loss rates.
+    max_pixels = largest number of pixels along each axis; the rates
+                 are summed over blocks of neighbouring positions.
+    """
+    val = _downsample(table.rates, (max_pixels, max_pixels))
+    val = _np.array(val, dtype=float).T
+    idx = val != 0.0
+    val[idx] = _np.log10(val[idx])
+    val[~idx] = val[idx].min()
+
+    fig, ax = _plt.subplots(figsize=(10, 10))
+
+    heatmp = ax.imshow(
+        val,
+        cmap="jet",
+        origin="lower",
+        interpolation="nearest",
+        extent=(0, spos_ring[-1], 0, spos_ring[-1]),
+    )
+
+    cbar = _plt.colorbar(heatmp)
+    cbar.set_label("Loss rate [1/s] in logarithmic scale", rotation=90)
+
+    ax.set_title("Loss profile", fontsize=16)
+
+    ax.set_xlabel("scattered positions [m]", fontsize=16)
+    ax.set_ylabel("lost positions [m]", fontsize=16)
+
+    fig.tight_layout()
+    _plt.gca().set_aspect("equal")
+    _plt.show()
@@ -0,0 +1,178 @@
+"""Stage-level profiling and counters of the analysis pipeline.
+
+Profiling is disabled by default and then costs a single global lookup
+per instrumented stage. Enable it with the context manager::
+
+    with profiling.profile() as prof:
+        analysis.get_scat_dict(...)
+    prof.to_json("stages.json")
+    prof.to_trace("trace.json")  # chrome://tracing or speedscope
+
+or with enable()/disable(). Only the current process is profiled, work
+done inside pool workers is seen as the time the parent waited for it.
+"""
+import contextlib as _contextlib
+import functools as _functools
+import json as _json
+import os as _os
+import threading as _threading
+import time as _time
+
+_ACTIVE = None
+
+
+class Profiler:
+    """Wall and CPU time per stage plus event counters."""
+
+    def __init__(self):
+        """."""
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self._origin = _time.perf_counter()
+        self._lock = _threading.Lock()
+
+    def add_stage(self, name, start, wall, cpu):
+        """Records one execution of a stage."""
+        with self._lock:
+            stt = self.stages.setdefault(
+                name, {"calls": 0, "wall": 0.0, "cpu": 0.0}
+            )
+            stt["calls"] += 1
+            stt["wall"] += wall
+            stt["cpu"] += cpu
+            self.events.append(
+                (name, start - self._origin, wall, _threading.get_ident())
+            )
+
+    def count(self, name, num=1):
+        """Increments a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def to_dict(self):
+        """Stages and counters as a dictionary."""
+        return {"stages": self.stages, "counters": self.counters}
+
+    def to_json(self, path=None):
+        """Returns (and optionally writes) the stages and counters."""
+        text = _json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, "w") as fil:
+                fil.write(text)
+        return text
+
+    def to_trace(self, path=None):
+        """Returns (and optionally writes) a Chrome trace-event file.
+
+        The format is read by chrome://tracing, Perfetto and speedscope,
+        which draw the nested stages as a flame chart.
+        """
+        pid = _os.getpid()
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": wall * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start, wall, tid in self.events
+        ]
+        events += [
+            {"name": name, "ph": "C", "ts": 0, "pid": pid, "args": {name: n}}
+            for name, n in self.counters.items()
+        ]
+        text = _json.dumps({"traceEvents": events})
+        if path is not None:
+            with open(path, "w") as fil:
+                fil.write(text)
+        return text
+
+
+class _Stage:
+    """Context manager timing one stage."""
+
+    __slots__ = ("prof", "name", "start", "cpu")
+
+    def __init__(self, prof, name):
+        """."""
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        """."""
+        self.cpu = _time.process_time()
+        self.start = _time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        """."""
+        wall = _time.perf_counter() - self.start
+        cpu = _time.process_time() - self.cpu
+        self.prof.add_stage(self.name, self.start, wall, cpu)
+        return False
+
+
+_NULL_STAGE = _contextlib.nullcontext()
+
+
+def stage(name):
+    """Context manager timing a stage (no-op when profiling is off)."""
+    prof = _ACTIVE
+    if prof is None:
+        return _NULL_STAGE
+    return _Stage(prof, name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as a stage."""
+
+    def deco(func):
+        @_functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+def count(name, num=1):
+    """Increments a counter (no-op when profiling is off)."""
+    prof = _ACTIVE
+    if prof is not None:
+        prof.count(name, num)
+
+
+def active():
+    """Profiler currently enabled, or None."""
+    return _ACTIVE
+
+
+def enable(profiler=None):
+    """Enables profiling and returns the active Profiler."""
+    global _ACTIVE
+    _ACTIVE = profiler or Profiler()
+    return _ACTIVE
+
+
+def disable():
+    """Disables profiling and returns the Profiler that was active."""
+    global _ACTIVE
+    prof, _ACTIVE = _ACTIVE, None
+    return prof
+
+
+@_contextlib.contextmanager
+def profile(profiler=None):
+    """Enables profiling inside a with block."""
+    global _ACTIVE
+    previous = _ACTIVE
+    prof = enable(profiler)
+    try:
+        yield prof
+    finally:
+        _ACTIVE = previous
@@ -0,0 +1,334 @@
+"""Aperture replay: loss tracking for many appertures from one record.
+
+The particles scattered at one element are tracked once, element by
+element, with the vacuum chamber off. For each particle and element the
+record keeps only the envelope of the trajectory over the turns (largest
+and smallest x and y, in float32) and the turn where each extreme was
+first reached, plus the turn and element where the particle was lost by
+the dynamics, if it was. Appertures only remove particles, they never
+change the trajectory of the ones that survive, so a particle is lost at
+an element exactly when its envelope there leaves the appertures. Any
+set of hmin, hmax, vmin and vmax (e.g. scraper settings) is then
+evaluated by array comparisons instead of a new ring_pass.
+
+Limits of validity:
+
+- the record must be made with the same lattice, cavity and radiation
+  flags as the tracking it replaces, and vchamber_on False;
+- appertures are checked at the end of each element, as the tracking
+  does;
+- the elements where a particle leaves rectangular chambers (vchamber 0)
+  are exact, but the turn used at each element is the one of the extreme
+  crossing the apperture, which can be later than the first crossing.
+  When a particle leaves the chamber at several elements in different
+  turns, the element reported can then differ from tracking. Losses of
+  Touschek particles mostly happen in the first turns, where this is
+  rare;
+- p-norm chambers (vchamber p > 0) are checked with the corner of the
+  envelope, which overestimates the losses;
+- coordinates are kept in float32, so particles closer than about 1e-9 m
+  to an apperture edge may be classified differently.
+
+ApertureReplay.validate compares the replay with true tracking.
+"""
+import collections as _collections
+import hashlib as _hashlib
+
+import numpy as _np
+import pyaccel as _pyaccel
+
+import touschek_pack.functions as to_fu
+from touschek_pack import memory as _mem
+from touschek_pack import profiling as _prof
+from touschek_pack.periodicity import _lost_map
+
+_LIMITS = ("hmin", "hmax", "vmin", "vmax", "vchamber")
+_EXTREMES = ("xmax", "xmin", "ymax", "ymin")
+
+
+def aperture_limits(model, vchamber=None, scraph_inds=(), scrapv_inds=()):
+    """Appertures of every element of model, as arrays.
+
+    model       =                             accelerator model.
+    vchamber    = scrapers' apperture (hmin, hmax, vmin, vmax), set on
+                  the returned arrays only (None: as in the model).
+    scraph_inds =                indices of horizontal scrapers.
+    scrapv_inds =                  indices of vertical scrapers.
+    """
+    limits = {
+        attr: _np.array(
+            [getattr(elem, attr, 0) for elem in model], dtype=float
+        )
+        for attr in _LIMITS
+    }
+    if vchamber is not None:
+        limits["hmin"][list(scraph_inds)] = vchamber[0]
+        limits["hmax"][list(scraph_inds)] = vchamber[1]
+        limits["vmin"][list(scrapv_inds)] = vchamber[2]
+        limits["vmax"][list(scrapv_inds)] = vchamber[3]
+    return limits
+
+
+class ApertureReplay:
+    """Trajectory envelopes of the particles scattered at one element."""
+
+    def __init__(self, deltas, n_turn, element_idx, envelope, turns, lost):
+        """.
+
+        deltas      =           energy deviations of the particles.
+        n_turn      =                       number of turns tracked.
+        element_idx =               element where the tracking starts.
+        envelope    = dictionary with xmax, xmin, ymax and ymin, float32
+                      arrays with shape (particles, elements) and
+                      elements counted from element_idx.
+        turns       = first turn where each extreme was reached (same
+                      keys and shapes, int16).
+        lost        = (turn, element from element_idx) of the particles
+                      lost by the dynamics (n_turn, 0 if not lost).
+        """
+        self.deltas = _np.asarray(deltas)
+        self.n_turn = int(n_turn)
+        self.element_idx = int(element_idx)
+        self.envelope = envelope
+        self.turns = turns
+        self.lost = lost
+
+    @property
+    def nelem(self):
+        """."""
+        return self.envelope["xmax"].shape[1]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the record."""
+        arrays = [*self.envelope.values(), *self.turns.values(), *self.lost]
+        return sum(arr.nbytes for arr in arrays)
+
+    @classmethod
+    def record(
+        cls, model, deltas, n_turn, element_idx, pos_x=1e-5, pos_y=3e-6
+    ):
+        """Tracks the particles element by element and keeps envelopes.
+
+        model       = accelerator model with vchamber_on False.
+        deltas      =                     energy deviations.
+        n_turn      =                number of turns desired.
+        element_idx =    element where the scattering ocurred.
+        pos_x       =                small pertubation in x.
+        pos_y       =                small pertubation in y.
+        """
+        if model.vchamber_on:
+            raise ValueError("the replay must be recorded with vchamber off")
+        deltas = _np.asarray(deltas, dtype=float)
+        element_idx = int(element_idx) % len(model)
+        nelem, npart = len(model), deltas.size
+        rin = to_fu._initial_particles(
+            deltas, element_idx, model, pos_x, pos_y
+        )
+        shape = (npart, nelem)
+        envelope = {
+            key: _np.full(shape, sign * _np.inf, dtype=_np.float32)
+            for key, sign in zip(_EXTREMES, (-1, 1, -1, 1))
+        }
+        turns = {key: _np.zeros(shape, dtype=_np.int16) for key in _EXTREMES}
+        lost_turn = _np.full(npart, n_turn, dtype=_np.int16)
+        lost_elem = _np.zeros(npart, dtype=_np.int32)
+
+        chunk = _mem.plan(
+            "replay",
+            npart,
+            _mem.replay_bytes(1, nelem),
+            fixed_bytes=_mem.replay_record_bytes(npart, nelem),
+        )
+        for slc in _mem.chunks(npart, chunk):
+            part = rin[:, slc]
+            for turn in range(n_turn):
+                with _prof.stage("line_pass"):
+                    out, *_ = _pyaccel.tracking.line_pass(
+                        model,
+                        part,
+                        indices="closed",
+                        element_offset=element_idx,
+                    )
+                out = out.reshape(6, part.shape[1], nelem + 1)
+                for key, coord, larger in (
+                    ("xmax", 0, True),
+                    ("xmin", 0, False),
+                    ("ymax", 2, True),
+                    ("ymin", 2, False),
+                ):
+                    val = out[coord, :, 1:]
+                    env = envelope[key][slc]
+                    new = val > env if larger else val < env
+                    env[new] = val[new]
+                    turns[key][slc][new] = turn
+
+                # first element where the particle became nan
+                nans = _np.isnan(out[0, :, 1:])
+                new = nans.any(axis=1) & (lost_turn[slc] == n_turn)
+                lost_turn[slc][new] = turn
+                lost_elem[slc][new] = nans[new].argmax(axis=1)
+                part = out[:, :, -1]
+        _prof.count("particle_turns", npart * n_turn)
+        lost = lost_turn, lost_elem
+        return cls(deltas, n_turn, element_idx, envelope, turns, lost)
+
+    def _loss_keys(self, limits, slc):
+        """turn * nelem + element of the apperture loss at each element."""
+        order = (self.element_idx + _np.arange(self.nelem)) % self.nelem
+        lim = {
+            key: val[order].astype(_np.float32) for key, val in limits.items()
+        }
+        env = {key: val[slc] for key, val in self.envelope.items()}
+        trn = {
+            key: val[slc].astype(_np.int64) for key, val in self.turns.items()
+        }
+        never = self.n_turn + 1
+        turn = _np.full(env["xmax"].shape, never, dtype=_np.int64)
+
+        rect = lim["vchamber"] == 0
+        for key, lkey, larger in (
+            ("xmax", "hmax", True),
+            ("xmin", "hmin", False),
+            ("ymax", "vmax", True),
+            ("ymin", "vmin", False),
+        ):
+            out = env[key] > lim[lkey] if larger else env[key] < lim[lkey]
+            out &= rect
+            turn = _np.where(out, _np.minimum(turn, trn[key]), turn)
+
+        if not rect.all():
+            shape = lim["vchamber"]
+            if _np.any(shape < 0):
+                raise ValueError("only vchamber shapes >= 0 are supported")
+            pnorm = _np.where(rect, 1, shape)
+            xc = (lim["hmax"] + lim["hmin"]) / 2
+            yc = (lim["vmax"] + lim["vmin"]) / 2
+            lx = (lim["hmax"] - lim["hmin"]) / 2
+            ly = (lim["vmax"] - lim["vmin"]) / 2
+            dx = _np.maximum(env["xmax"] - xc, xc - env["xmin"])
+            dy = _np.maximum(env["ymax"] - yc, yc - env["ymin"])
+            norm = _np.abs(dx / lx) ** pnorm + _np.abs(dy / ly) ** pnorm
+            tx = _np.where(
+                env["xmax"] - xc >= xc - env["xmin"], trn["xmax"], trn["xmin"]
+            )
+            ty = _np.where(
+                env["ymax"] - yc >= yc - env["ymin"], trn["ymax"], trn["ymin"]
+            )
+            out = ~rect & (norm > 1)
+            turn = _np.where(out, _np.maximum(tx, ty), turn)
+
+        keys = turn * self.nelem + _np.arange(self.nelem)
+        keys[turn == never] = never * self.nelem
+        return keys
+
+    def first_loss(self, limits):
+        """Tracking dictionary (as track_eletrons_d) for the appertures.
+
+        limits = appertures of every element, see aperture_limits.
+        """
+        npart = self.deltas.size
+        nelem = self.nelem
+        lost_turn, lost_elem = self.lost
+        dyn = _np.where(
+            lost_turn < self.n_turn,
+            lost_turn.astype(_np.int64) * nelem + lost_elem,
+            (self.n_turn + 1) * nelem,
+        )
+        first = _np.empty(npart, dtype=_np.int64)
+
+        chunk = _mem.plan("replay_eval", npart, 64 * nelem)
+        with _prof.stage("replay"):
+            for slc in _mem.chunks(npart, chunk):
+                first[slc] = self._loss_keys(limits, slc).min(axis=1)
+        first = _np.minimum(first, dyn)
+
+        lost = first < self.n_turn * nelem
+        turn_lost = _np.full(npart, self.n_turn)
+        element_lost = _np.full(npart, self.element_idx, dtype=_np.intp)
+        turn_lost[lost] = first[lost] // nelem
+        element_lost[lost] = (self.element_idx + first[lost] % nelem) % nelem
+        return to_fu._lost_dict(
+            self.deltas, turn_lost, element_lost, self.n_turn, self.element_idx
+        )
+
+    def validate(self, model):
+        """Compares the replay with tracking on model.
+
+        model = accelerator model with the appertures to be checked and
+                vchamber_on True.
+
+        Returns the fraction of particles lost at the same element and
+        turn by both computations.
+        """
+        full = _lost_map(
+            to_fu.track_eletrons_d(
+                self.deltas, self.n_turn, self.element_idx, model
+            )
+        )
+        mapped = _lost_map(self.first_loss(aperture_limits(model)))
+        same = sum(full.get(delta) == lost for delta, lost in mapped.items())
+        total = len(set(full) | set(mapped))
+        return 1.0 if not total else same / total
+
+
+class ReplayCache:
+    """ApertureReplay records kept in LRU order under a size limit."""
+
+    def __init__(self, maxbytes=2**30):
+        """.
+
+        maxbytes = largest number of bytes held by the records (None:
+                   the memory budget, unlimited if there is none).
+        """
+        self.maxbytes = maxbytes
+        self._data = _collections.OrderedDict()
+        self._nbytes = 0
+
+    def __len__(self):
+        """."""
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the records."""
+        return self._nbytes
+
+    def clear(self):
+        """."""
+        self._data.clear()
+        self._nbytes = 0
+
+    @staticmethod
+    def key(state, deltas, nturns, index):
+        """Returns the cache key of one record.
+
+        Only the lattice fingerprint of state is used: records are made
+        without vacuum chamber, so they serve any set of appertures.
+        """
+        digest = _hashlib.sha1(
+            _np.asarray(deltas, dtype=float).tobytes()
+        ).hexdigest()
+        return (int(index), digest, int(nturns), state.lattice_fingerprint)
+
+    def get(self, key):
+        """Returns a cached record or None."""
+        replay = self._data.get(key)
+        if replay is not None:
+            self._data.move_to_end(key)
+            _prof.count("replay_cache_hits")
+        return replay
+
+    def put(self, key, replay):
+        """."""
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._nbytes -= old.nbytes
+        self._data[key] = replay
+        self._nbytes += replay.nbytes
+        limit = self.maxbytes
+        if limit is None:
+            limit = _mem.get_budget()
+        while limit is not None and self._nbytes > limit and len(self._data):
+            _, old = self._data.popitem(last=False)
+            self._nbytes -= old.nbytes
@@ -0,0 +1,223 @@
+"""On-disk columnar format for loss tables and scattering densities.
+
+Every result is a directory with one .npy file per array plus a small
+meta.json. Arrays are opened with numpy memory mapping, so loading is
+independent of the result size and reads are zero-copy.
+"""
+import json as _json
+import os as _os
+
+import numpy as _np
+
+_META = "meta.json"
+
+
+def _write_meta(path, kind, **meta):
+    """."""
+    _os.makedirs(path, exist_ok=True)
+    meta["kind"] = kind
+    with open(_os.path.join(path, _META), "w") as fil:
+        _json.dump(meta, fil)
+
+
+def _read_meta(path):
+    """."""
+    with open(_os.path.join(path, _META), "r") as fil:
+        return _json.load(fil)
+
+
+def _save(path, name, array):
+    """."""
+    _np.save(_os.path.join(path, name + ".npy"), _np.ascontiguousarray(array))
+
+
+def _load(path, name, mmap_mode="r"):
+    """."""
+    return _np.load(_os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+
+class ScatTable:
+    """Loss rates of each scattering position at each lost position.
+
+    Rates are stored with one contiguous row per scattering position, so
+    a single column of the original dictionary is a zero-copy read. The
+    object can be used wherever the dictionary given by get_scat_dict is
+    expected.
+    """
+
+    def __init__(self, lost_positions, scat_keys, rates):
+        """.
+
+        lost_positions =               lost positions along the ring.
+        scat_keys      =     keys (str) of the scattering positions.
+        rates          = array (scattering positions x lost positions).
+        """
+        self.lost_positions = lost_positions
+        self.scat_keys = list(scat_keys)
+        self.rates = rates
+        self._rows = {key: row for row, key in enumerate(self.scat_keys)}
+
+    @classmethod
+    def from_dict(cls, dic):
+        """Builds the table from the dictionary given by get_scat_dict."""
+        scat_keys = [key for key in dic if key != "lost_positions"]
+        rates = _np.array([dic[key] for key in scat_keys], dtype=float)
+        lost_pos = _np.asarray(dic["lost_positions"], dtype=float)
+        return cls(lost_pos, scat_keys, rates.reshape(len(scat_keys), -1))
+
+    @classmethod
+    def from_columns(cls, scat_keys, columns):
+        """Builds the table from sparse columns.
+
+        scat_keys =           keys (str) of the scattering positions.
+        columns   = (lost positions, loss rates) of each scattering key.
+        """
+        lost_pos = _np.unique(
+            _np.concatenate(
+                [_np.asarray(lost, dtype=float) for lost, _ in columns]
+                or [_np.zeros(0)]
+            )
+        )
+        rates = _np.zeros((len(columns), lost_pos.size))
+        for row, (lost, rate) in zip(rates, columns):
+            lost = _np.asarray(lost, dtype=float)
+            _np.add.at(row, _np.searchsorted(lost_pos, lost), rate)
+        return cls(lost_pos, scat_keys, rates)
+
+    @property
+    def scat_positions(self):
+        """."""
+        return _np.array(self.scat_keys, dtype=float)
+
+    def keys(self):
+        """."""
+        return ["lost_positions"] + self.scat_keys
+
+    def items(self):
+        """."""
+        for key in self.keys():
+            yield key, self[key]
+
+    def __iter__(self):
+        """."""
+        return iter(self.keys())
+
+    def __getitem__(self, key):
+        """."""
+        if key == "lost_positions":
+            return self.lost_positions
+        return self.rates[self._rows[key]]
+
+    def to_dict(self):
+        """Materialises the table as a get_scat_dict dictionary."""
+        return {key: list(value) for key, value in self.items()}
+
+
+def save_scat_table(path, dic):
+    """Saves the loss table given by get_scat_dict.
+
+    path = result directory.
+    dic  = dictionary (or ScatTable) with lost and scattered positions.
+    """
+    table = dic if isinstance(dic, ScatTable) else ScatTable.from_dict(dic)
+    _write_meta(path, "scat_table", scat_keys=table.scat_keys)
+    _save(path, "lost_positions", table.lost_positions)
+    _save(path, "rates", table.rates)
+
+
+def load_scat_table(path, mmap_mode="r"):
+    """Opens a loss table saved by save_scat_table without reading it."""
+    meta = _read_meta(path)
+    return ScatTable(
+        _load(path, "lost_positions", mmap_mode),
+        meta["scat_keys"],
+        _load(path, "rates", mmap_mode),
+    )
+
+
+def merge_scat_tables(tables):
+    """Joins tables of disjoint scattering positions into one table.
+
+    tables = iterable of ScatTable (e.g. the shards of a run).
+
+    Columns are sorted by scattering position and the lost positions are
+    the union of those of all tables.
+    """
+    keys, columns = [], []
+    for table in tables:
+        nnz = [_np.nonzero(row)[0] for row in table.rates]
+        keys += table.scat_keys
+        columns += [
+            (table.lost_positions[idx], row[idx])
+            for row, idx in zip(table.rates, nnz)
+        ]
+    order = _np.argsort(_np.array(keys, dtype=float), kind="stable")
+    return ScatTable.from_columns(
+        [keys[i] for i in order], [columns[i] for i in order]
+    )
+
+
+def as_scat_table(obj):
+    """Returns a ScatTable from a dictionary, a table or a result path."""
+    if isinstance(obj, ScatTable):
+        return obj
+    if isinstance(obj, (str, _os.PathLike)):
+        return load_scat_table(obj)
+    return ScatTable.from_dict(obj)
+
+
+def save_densities(path, dic, spos=None):
+    """Saves the loss densities given by norm_cutacp.
+
+    path = result directory.
+    dic  = dictionary with fdensp, fdensn, deltasp and deltasn.
+    spos = s positions where the densities were calculated.
+    """
+    _write_meta(path, "densities", fields=sorted(dic))
+    for key, value in dic.items():
+        _save(path, key, value)
+    if spos is not None:
+        _save(path, "spos", spos)
+
+
+def load_densities(path, mmap_mode="r"):
+    """Opens densities saved by save_densities as memory mapped arrays."""
+    meta = _read_meta(path)
+    dic = {key: _load(path, key, mmap_mode) for key in meta["fields"]}
+    if _os.path.isfile(_os.path.join(path, "spos.npy")):
+        dic["spos"] = _load(path, "spos", mmap_mode)
+    return dic
+
+
+def save_histograms(path, histsp, histsn, indices):
+    """Saves the Monte-Carlo densities given by histgms.
+
+    path    =                                result directory.
+    histsp  =   list of positive energy deviations per position.
+    histsn  =   list of negative energy deviations per position.
+    indices = model indices of the positions.
+    """
+    _write_meta(path, "histograms")
+    for name, hists in (("histsp", histsp), ("histsn", histsn)):
+        offsets = _np.cumsum([0] + [len(hist) for hist in hists])
+        values = _np.concatenate(hists) if len(hists) else _np.zeros(0)
+        _save(path, name, values)
+        _save(path, name + "_offsets", offsets)
+    _save(path, "indices", indices)
+
+
+def load_histograms(path, mmap_mode="r"):
+    """Opens histograms saved by save_histograms.
+
+    Returns the same tuple as histgms, with each histogram being a
+    zero-copy view of the memory mapped file.
+    """
+    out = []
+    for name in ("histsp", "histsn"):
+        values = _load(path, name, mmap_mode)
+        offsets = _load(path, name + "_offsets", None)
+        out.append(
+            [values[ini:end] for ini, end in zip(offsets, offsets[1:])]
+        )
+    out.append(_load(path, "indices", None))
+    return tuple(out)
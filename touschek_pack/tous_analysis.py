@@ -1,17 +1,43 @@
 """tous_analysis."""
-from pyaccel.lifetime import Lifetime
+import time as _time
 from pyaccel.lattice import get_attribute, find_indices, find_spos
 import touschek_pack.functions as to_fu
-import pymodels
-import pyaccel.optics as py_op
+import touschek_pack.parallel as to_par
+from touschek_pack import memory as _mem
+from touschek_pack import profiling as _prof
+from touschek_pack.loss_profile import LossProfile
+from touschek_pack.checkpoint import CheckpointStore
+from touschek_pack.clustering import cluster_positions, validate_clusters
+from touschek_pack.model_state import ModelState
+from touschek_pack.optics import OpticsSnapshot
+from touschek_pack.periodicity import find_periodicity, validate_tracking
+from touschek_pack.replay import (
+    ApertureReplay,
+    ReplayCache,
+    aperture_limits,
+)
+from touschek_pack.results import as_scat_table, load_histograms
+from touschek_pack.track_cache import TrackCache
 import numpy as _np
-import matplotlib.pyplot as _plt
-import matplotlib.cm as _cm
 from mathphys.beam_optics import beam_rigidity as _beam_rigidity
-import pandas as _pd
-import scipy.integrate as scyint
-import pyaccel as _pyaccel
 from mathphys.functions import load_pickle
+import os as _os
+
+_PATH = _os.path.dirname(_os.path.abspath(__file__))
+
+
+def _plotting():
+    """Imports the plotting layer (and matplotlib) only when plotting."""
+    from touschek_pack import plotting
+
+    return plotting
+
+
+def _create_nominal_model():
+    """."""
+    import pymodels
+
+    return pymodels.si.create_accelerator()
 
 
 class TousAnalysis:
@@ -30,32 +56,73 @@ class TousAnalysis:
             beta = beam_energy
 
         self._model_fit = accelerator
-        self._model = pymodels.si.create_accelerator()
-
+        self._model = None  # nominal model, built on first use
+        self._states = {}  # ModelState of the nominal model per usage
+        self._build_report = {}
+
+        self._optics = None  # OpticsSnapshot of the fitted model
+        self._accep_mode = "linear"  # or "tracked" momentum acceptance
+        self._accep_points = 200  # elements tracked (None: all elements)
+        self._accep_nturns = 100  # turns to survive in the acceptance
+        self._accep_tolerance = 1e-4
         self._amp_and_limidx = None
-        self._sc_accps = None
-        self._accep = None
-        self._inds_pos = load_pickle(
-            "/".join(__file__.split("/")[:-1]) + "/ph_lim.pickle"
-        )
-        self._inds_neg = load_pickle(
-            "/".join(__file__.split("/")[:-1]) + "/ph_lim_neg.pickle"
-        )
+        self._inds_pos = None
+        self._inds_neg = None
         self._amps_pos = None
         self._amps_neg = None
+        self._amp_optics = None  # per-offset arrays kept by calc_amp
+        self._amp_planes = None  # select_planes of +/- offsets
+        self._amp_coupling = 1.0  # Jy / Jx of the combined limits
+        self._fast_amp = False  # chromatic-expansion surrogate of calc_amp
+        self._symmetry = None  # superperiods used to reduce the work
+        self.track_cache = TrackCache()  # shared by plots and loss maps
+        self.replays = ReplayCache()  # ApertureReplay records, LRU
+        self.combined_tracking = True  # tracks +/- deltas in one batch
+        self._periodicities = {}
+        self.cluster_tolerance = None  # optics clustering of tracking
+        self.cluster_ndown = 20  # downstream elements equal in a cluster
         self.num_part = 50000
+        self.mc_tolerance = None  # adaptive M.C. stop tolerance (None: off)
+        self.mc_samples = None  # particles drawn per position (adaptive)
         self.energy_dev_min = 1e-4
 
         self.beta = beta  # beta factor
-        self.h_pos = get_attribute(self._model_fit, "hmax", indices="closed")
-        self.h_neg = get_attribute(self._model_fit, "hmin", indices="closed")
-        self.ltime = Lifetime(self._model_fit)
+        self._h_pos = None
+        self._h_neg = None
+        self._v_pos = None
+        self._v_neg = None
+        self._vchamber = None  # scrapers' apperture of the amplitudes
+        self._amp_apertures = None  # fitted appertures with the scrapers
         self._off_energy = energy_off  # (linear model) en_dev to amplitudes
         self.nturns = n_turns
         self._deltas = deltas
-        self.spos = find_spos(self._model_fit, indices="closed")
-        self.scraph_inds = find_indices(self._model, "fam_name", "SHVC")
-        self.scrapv_inds = find_indices(self._model, "fam_name", "SVVC")
+        self._scraph_inds = None
+        self._scrapv_inds = None
+        self.checkpoint = None  # directory or CheckpointStore for tracking
+
+    def _build(self, name, func, *args, **kwargs):
+        """Builds a lazy member and records how long it took."""
+        t0 = _time.perf_counter()
+        with _prof.stage("build." + name):
+            value = func(*args, **kwargs)
+        self._build_report[name] = _time.perf_counter() - t0
+        return value
+
+    def construction_report(self):
+        """Returns the members already built and their cost in seconds."""
+        report = dict(self._build_report)
+        if self._optics is not None:
+            for name, cost in self._optics.report.items():
+                report["optics." + name] = cost
+        return report
+
+    @staticmethod
+    def chunking_report():
+        """Returns the chunking chosen under the memory budget.
+
+        See touschek_pack.memory.set_budget.
+        """
+        return _mem.report()
 
     @property
     def accelerator(self):
@@ -66,6 +133,143 @@ class TousAnalysis:
     def accelerator(self, new_model):
         """."""
         self._model_fit = new_model
+        self.invalidate_optics()
+
+    def invalidate_optics(self):
+        """Drops everything derived from the fitted model.
+
+        Called when the accelerator is replaced; call it after changing
+        the fitted model in place.
+        """
+        self._optics = None
+        self._h_pos = None
+        self._h_neg = None
+        self._v_pos = None
+        self._v_neg = None
+        self._amp_apertures = None
+        self._amp_and_limidx = None
+        self._amp_optics = None
+        self._amp_planes = None
+        self._amps_pos = None
+        self._amps_neg = None
+        self._inds_pos = None
+        self._inds_neg = None
+        self._periodicities.pop("fit", None)
+
+    @property
+    def optics(self):
+        """OpticsSnapshot of the fitted model.
+
+        s positions, twiss, envelopes, lifetime and energy acceptance of
+        the fitted model, computed once and shared by the densities, the
+        Monte-Carlo and the loss rates.
+        """
+        if self._optics is None:
+            accep = None
+            if self._accep_mode == "tracked":
+                accep = self._build("tracked_accep", self._tracked_accep)
+            self._optics = self._build(
+                "optics", OpticsSnapshot, self._model_fit, accep
+            )
+        return self._optics
+
+    @property
+    def accep_mode(self):
+        """Energy acceptance used by the analysis.
+
+        "linear": calc_touschek_energy_acceptance. "tracked": momentum
+        acceptance found by tracking the fitted model for accep_nturns
+        turns at accep_points elements (bisect_acceptance, run on a
+        process pool) and interpolated around the ring. Either one is
+        used wherever accep is (cutoffs, densities, Monte-Carlo) and
+        by the Lifetime object giving the loss rates.
+        """
+        return self._accep_mode
+
+    @accep_mode.setter
+    def accep_mode(self, value):
+        """."""
+        if value not in ("linear", "tracked"):
+            raise ValueError(f"unknown acceptance mode: {value}")
+        self._accep_mode = value
+        self._optics = None
+
+    @property
+    def accep_points(self):
+        """Elements where the tracked acceptance is computed (None: all)."""
+        return self._accep_points
+
+    @accep_points.setter
+    def accep_points(self, value):
+        """."""
+        self._accep_points = value
+        self._optics = None
+
+    @property
+    def accep_nturns(self):
+        """Turns a particle must survive inside the tracked acceptance."""
+        return self._accep_nturns
+
+    @accep_nturns.setter
+    def accep_nturns(self, value):
+        """."""
+        self._accep_nturns = value
+        self._optics = None
+
+    @property
+    def accep_tolerance(self):
+        """Tolerance of the tracked acceptance."""
+        return self._accep_tolerance
+
+    @accep_tolerance.setter
+    def accep_tolerance(self, value):
+        """."""
+        self._accep_tolerance = value
+        self._optics = None
+
+    def _tracked_accep(self, processes=None):
+        """Tracked momentum acceptance of every element (closed)."""
+        model = self._model_fit
+        indices = to_par.acceptance_indices(len(model), self.accep_points)
+        state = ModelState(model, **self._STATE_FLAGS["tracking"])
+        accs = to_par.tracked_acceptance(
+            state,
+            indices,
+            self.accep_nturns,
+            delta_max=float(_np.max(self._deltas)),
+            tol=self.accep_tolerance,
+            processes=processes,
+        )
+        spos = find_spos(model, indices="closed")
+        return to_par.interp_acceptance(spos, indices, accs)
+
+    @property
+    def symmetry(self):
+        """Symmetry mode: None (off), "auto" or number of superperiods.
+
+        When set, densities, envelopes and tracking starts are computed
+        for one superperiod only and mapped around the ring. Models whose
+        superperiods differ (e.g. scrapers in a single sector) fall back
+        to the full ring in "auto" mode. See check_periodicity.
+        """
+        return self._symmetry
+
+    @symmetry.setter
+    def symmetry(self, value):
+        """."""
+        self._symmetry = value
+        self._periodicities.clear()
+
+    def _periodicity(self, model, key):
+        """Periodicity of model under the symmetry mode (None if off)."""
+        if self._symmetry is None:
+            return None
+        per = self._periodicities.get(key)
+        if per is None:
+            nper = None if self._symmetry == "auto" else self._symmetry
+            per = find_periodicity(model, nper)
+            self._periodicities[key] = per
+        return per if per.nperiods > 1 else None
 
     @property
     def nom_model(self):
@@ -74,16 +278,163 @@ class TousAnalysis:
         Some calculus involves nominal model without coupling and vertical
         dispersion corretion.
         """
+        if self._model is None:
+            self._model = self._build("nom_model", _create_nominal_model)
         return self._model
 
+    _STATE_FLAGS = {
+        "optics": {"cavity_on": False, "radiation_on": False},
+        "tracking": {
+            "cavity_on": True,
+            "radiation_on": True,
+            "vchamber_on": True,
+        },
+        "replay": {
+            "cavity_on": True,
+            "radiation_on": True,
+            "vchamber_on": False,
+        },
+    }
+
+    def model_state(self, kind="tracking", vchamber=None):
+        """Immutable state of the nominal model for one kind of analysis.
+
+        kind     = "optics" (linear model), "tracking" or "replay"
+                   (tracking without vacuum chamber).
+        vchamber = scrapers' apperture (hmin, hmax, vmin, vmax).
+
+        States are built from a copy of the nominal model, so analyses
+        running concurrently never change each other's flags or
+        appertures. They are cached until the nominal model is changed
+        through set_vchamber_scraper.
+        """
+        key = (kind, None if vchamber is None else tuple(vchamber))
+        state = self._states.get(key)
+        if state is not None:
+            _prof.count("state_cache_hits")
+        else:
+            scrap_inds = (self.scraph_inds, self.scrapv_inds)
+            state = ModelState(
+                self.nom_model,
+                vchamber=vchamber,
+                scrap_inds=scrap_inds,
+                **self._STATE_FLAGS[kind],
+            )
+            self._states[key] = state
+        return state
+
     @property
-    def accep(self):
-        """Defines Touschek energy acceptance."""
-        if self._accep is None:
-            self._accep = py_op.calc_touschek_energy_acceptance(
-                self.accelerator
+    def ltime(self):
+        """Lifetime object of the fitted model."""
+        return self.optics.ltime
+
+    @property
+    def spos(self):
+        """s position of every element of the fitted model."""
+        return self.optics.spos
+
+    @property
+    def h_pos(self):
+        """Horizontal max apperture of the fitted model."""
+        if self._h_pos is None:
+            self._h_pos = self._build(
+                "h_pos",
+                get_attribute,
+                self._model_fit,
+                "hmax",
+                indices="closed",
             )
-        return self._accep
+        return self._h_pos
+
+    @property
+    def h_neg(self):
+        """Horizontal min apperture of the fitted model."""
+        if self._h_neg is None:
+            self._h_neg = self._build(
+                "h_neg",
+                get_attribute,
+                self._model_fit,
+                "hmin",
+                indices="closed",
+            )
+        return self._h_neg
+
+    @property
+    def v_pos(self):
+        """Vertical max apperture of the fitted model."""
+        if self._v_pos is None:
+            self._v_pos = self._build(
+                "v_pos",
+                get_attribute,
+                self._model_fit,
+                "vmax",
+                indices="closed",
+            )
+        return self._v_pos
+
+    @property
+    def v_neg(self):
+        """Vertical min apperture of the fitted model."""
+        if self._v_neg is None:
+            self._v_neg = self._build(
+                "v_neg",
+                get_attribute,
+                self._model_fit,
+                "vmin",
+                indices="closed",
+            )
+        return self._v_neg
+
+    @property
+    def amp_apertures(self):
+        """Appertures (hmax, hmin, vmax, vmin) used for the amplitudes.
+
+        Copies of the appertures of the fitted model with the setting of
+        set_vchamber_scraper at its scrapers; h_pos, h_neg, v_pos and
+        v_neg are never changed.
+        """
+        if self._amp_apertures is None:
+            aper = [
+                arr.copy()
+                for arr in (self.h_pos, self.h_neg, self.v_pos, self.v_neg)
+            ]
+            if self._vchamber is not None:
+                hinds, vinds = self._fit_scrap_inds()
+                vch = self._vchamber
+                aper[1][hinds], aper[0][hinds] = vch[0], vch[1]
+                aper[3][vinds], aper[2][vinds] = vch[2], vch[3]
+            self._amp_apertures = tuple(aper)
+        return self._amp_apertures
+
+    def _fit_scrap_inds(self):
+        """Indices of the horizontal and vertical scrapers of the fit."""
+        return (
+            find_indices(self._model_fit, "fam_name", "SHVC"),
+            find_indices(self._model_fit, "fam_name", "SVVC"),
+        )
+
+    @property
+    def scraph_inds(self):
+        """Indices of the horizontal scrapers."""
+        if self._scraph_inds is None:
+            self._scraph_inds = self._build(
+                "scraph_inds", find_indices, self.nom_model, "fam_name", "SHVC"
+            )
+        return self._scraph_inds
+
+    @property
+    def scrapv_inds(self):
+        """Indices of the vertical scrapers."""
+        if self._scrapv_inds is None:
+            self._scrapv_inds = self._build(
+                "scrapv_inds", find_indices, self.nom_model, "fam_name", "SVVC"
+            )
+        return self._scrapv_inds
+
+    @property
+    def accep(self):
+        """Defines Touschek energy acceptance (see accep_mode)."""
+        return self.optics.accep
 
     @property
     def s_calc(self):
@@ -92,9 +443,7 @@ class TousAnalysis:
         Defines s position and get the energy accpetance both at each 10
         meters.
         """
-        if self._sc_accps is None:
-            self._sc_accps = to_fu.get_scaccep(self.accelerator, self.accep)
-        return self._sc_accps
+        return self.optics.scaccep()
 
     @property
     def amp_and_limidx(self):
@@ -104,21 +453,85 @@ class TousAnalysis:
         physical limitants for positive and negative e_dev
         """
         if self._amp_and_limidx is None:
-            self._model.cavity_on = False
-            self._model.radiation_on = False
+            t0 = _time.perf_counter()
+            model = self.model_state("optics").model()
+            if self.fast_amp:
+                calc_amp = to_fu.calc_amp_fast
+                kwargs = {}
+            else:
+                calc_amp = to_fu.calc_amp
+                kwargs = {"return_optics": True}
 
-            self._amps_pos, self._inds_pos = to_fu.calc_amp(
-                self._model, self.off_energy, self.h_pos, self.h_neg
+            hmax, hmin = self.amp_apertures[:2]
+            self._amps_pos, self._inds_pos, optics_pos = calc_amp(
+                model, self.off_energy, hmax, hmin, **kwargs
             )
 
-            self._amps_neg, self._inds_neg = to_fu.calc_amp(
-                self._model, -self.off_energy, self.h_pos, self.h_neg
+            self._amps_neg, self._inds_neg, optics_neg = calc_amp(
+                model, -self.off_energy, hmax, hmin, **kwargs
             )
+            self._amp_optics = optics_pos, optics_neg
+            self._build_report["amp_and_limidx"] = _time.perf_counter() - t0
 
             self._amp_and_limidx = True
 
         return self._amp_and_limidx
 
+    @property
+    def amp_planes(self):
+        """Horizontal, vertical and combined limits (positive, negative).
+
+        Each item is the dictionary of calc_amp_planes for +off_energy and
+        -off_energy, built from the twiss arrays kept by amp_and_limidx.
+        """
+        if self._amp_planes is None:
+            self.amp_and_limidx
+            args = self.amp_apertures
+            self._amp_planes = self._build(
+                "amp_planes",
+                lambda: tuple(
+                    to_fu.select_planes(
+                        optics, *args, coupling=self.amp_coupling
+                    )
+                    for optics in self._amp_optics
+                ),
+            )
+        return self._amp_planes
+
+    @property
+    def fast_amp(self):
+        """If True, amp_and_limidx uses the calc_amp_fast surrogate."""
+        return self._fast_amp
+
+    @fast_amp.setter
+    def fast_amp(self, value):
+        """."""
+        self._fast_amp = value
+        self._amp_and_limidx = None
+        self._amp_optics = None
+        self._amp_planes = None
+
+    @property
+    def amp_coupling(self):
+        """Ratio Jy / Jx used for the combined limits of amp_planes."""
+        return self._amp_coupling
+
+    @amp_coupling.setter
+    def amp_coupling(self, value):
+        """."""
+        self._amp_coupling = value
+        self._amp_planes = None
+
+    @property
+    def amp_fit_report(self):
+        """Residuals of the fast_amp surrogate (positive, negative offsets).
+
+        None when the amplitudes were computed with exact twiss solves.
+        """
+        if self._amp_optics is None or "fit" not in self._amp_optics[0]:
+            return None
+        return tuple(optics["fit"] for optics in self._amp_optics)
+
     @property
     def off_energy(self):
         """."""
@@ -149,16 +562,28 @@ class TousAnalysis:
         """
         dev_percent /= 100
         self._deltas = _np.linspace(0, dev_percent, steps)
+        if self._accep_mode == "tracked":  # searched up to max(deltas)
+            self._optics = None
 
     # the four properties defining below are to be static
     @property
     def inds_pos(self):
         """."""
+        if self._inds_pos is None:
+            self._inds_pos = self._build(
+                "inds_pos", load_pickle, _os.path.join(_PATH, "ph_lim.pickle")
+            )
         return self._inds_pos
 
     @property
     def inds_neg(self):
         """."""
+        if self._inds_neg is None:
+            self._inds_neg = self._build(
+                "inds_neg",
+                load_pickle,
+                _os.path.join(_PATH, "ph_lim_neg.pickle"),
+            )
         return self._inds_neg
 
     @property
@@ -176,54 +601,98 @@ class TousAnalysis:
         return self.amp_and_limidx, self.accep, self.s_calc
 
     def set_vchamber_scraper(self, vchamber):
-        """Function for setting the vchamber apperture."""
-        model = self._model
-        scph_inds = self.scraph_inds
-        scpv_inds = self.scrapv_inds
-
-        for iten in scph_inds:
-            model[iten].hmin = vchamber[0]
-            model[iten].hmax = vchamber[1]
-        for iten in scpv_inds:
-            model[iten].vmin = vchamber[2]
-            model[iten].vmax = vchamber[3]
+        """Function for setting the vchamber apperture.
+
+        If the amplitudes from the linear model were already calculated,
+        only the limits at the horizontal scrapers are re-evaluated, and
+        the limits of amp_planes only at the scrapers. The scrapers are
+        set on amp_apertures, the fitted appertures are left untouched
+        (see check_amp_update).
+        """
+        to_fu.set_vchamber_scraper(
+            self.nom_model, vchamber, self.scraph_inds, self.scrapv_inds
+        )
+        self._states.clear()
+        self._vchamber = tuple(vchamber)
+        self._amp_apertures = None
+        args = self.amp_apertures
+        hinds, vinds = self._fit_scrap_inds()
+        if self._amp_optics is not None:
+            optics_pos, optics_neg = self._amp_optics
+            self._amps_pos, self._inds_pos = to_fu.update_amp(
+                optics_pos, hinds, *args[:2]
+            )
+            self._amps_neg, self._inds_neg = to_fu.update_amp(
+                optics_neg, hinds, *args[:2]
+            )
+        if self._amp_planes is not None:
+            elements = _np.union1d(hinds, vinds)
+            for planes, optics in zip(self._amp_planes, self._amp_optics):
+                to_fu.update_planes(planes, optics, elements, *args)
+
+    def check_amp_update(self):
+        """Compares the updated amplitudes with a full calc_amp.
+
+        Returns the largest relative difference of the amplitudes and the
+        fraction of offsets with the same limitant element, computed
+        with the current amp_apertures on the positive and negative
+        offsets.
+        """
+        self.amp_and_limidx
+        model = self.model_state("optics").model()
+        hmax, hmin = self.amp_apertures[:2]
+        diff, same = 0.0, []
+        for sign, amps, inds in (
+            (1, self._amps_pos, self._inds_pos),
+            (-1, self._amps_neg, self._inds_neg),
+        ):
+            amps_full, inds_full = to_fu.calc_amp(
+                model, sign * self.off_energy, hmax, hmin
+            )
+            ok = amps_full > 0
+            diff = max(
+                diff,
+                float(
+                    _np.max(
+                        _np.abs(amps[ok] / amps_full[ok] - 1), initial=0
+                    )
+                ),
+            )
+            same.append(_np.asarray(inds) == _np.asarray(inds_full))
+        return {
+            "amp_residual": diff,
+            "index_match": float(_np.mean(_np.concatenate(same))),
+        }
 
     def _single_pos_track(self, single_spos, par):
-        """Single position tracking."""
-        self._model.cavity_on = True
-        self._model.radiation_on = True
-        self._model.vchamber_on = True
+        """Single position tracking.
+
+        Results are kept in track_cache. With combined_tracking, the first
+        call at a position also tracks the opposite sign, so looking at
+        both signs costs one orbit search and one ring_pass.
+        """
+        state = self.model_state("tracking")
         s = self.spos
 
         index = _np.argmin(_np.abs(s - single_spos))
         if "pos" in par:
-            res = to_fu.track_eletrons_d(
-                self.deltas,
-                self.nturns,
-                index,
-                self._model,
-                pos_x=1e-5,
-                pos_y=3e-6,
-            )
+            sign = 1
         elif "neg" in par:
-            res = to_fu.track_eletrons_d(
-                -self.deltas,
-                self.nturns,
-                index,
-                self._model,
-                pos_x=1e-5,
-                pos_y=3e-6,
-            )
-
-        return res
+            sign = -1
+        return self.track_cache.track(
+            state,
+            self.deltas,
+            self.nturns,
+            index,
+            sign,
+            both=self.combined_tracking,
+        )
 
     def _get_weighting_tous(self, single_spos, npt=5000):
         """."""
-        scalc, daccp, daccn = to_fu.get_scaccep(self.accelerator, self.accep)
+        scalc, daccp, daccn = self.s_calc
         bf = self.beta  # bf:beta factor
-        lt = self.ltime
-        b1 = lt.touschek_data["touschek_coeffs"]["b1"]
-        b2 = lt.touschek_data["touschek_coeffs"]["b2"]
+        b1, b2 = self.optics.b1, self.optics.b2
 
         taup, taun = (bf * daccp) ** 2, (bf * daccn) ** 2
         idx = _np.argmin(_np.abs(scalc - single_spos))
@@ -299,7 +768,7 @@ class TousAnalysis:
             inds = _np.intp(self.inds_neg)
         index = _np.argmin(_np.abs(s - single_spos))
 
-        to_fu.plot_track_d(
+        _plotting().plot_track_d(
             self.accelerator,
             dic,
             inds,
@@ -317,253 +786,336 @@ class TousAnalysis:
         spos = desired s positions (list or numpy.array)
         """
         spos_ring = self.spos
-        dic = to_fu.norm_cutacp(
-            self._model_fit, spos, 5000, self._accep, norm=True
+        dic = self._fit_densities(spos, 5000, norm=True)
+
+        _plotting().plot_normtousd(self._model_fit, spos_ring, spos, dic)
+
+    def _fit_densities(self, lsps, npt, norm=False):
+        """norm_cutacp of the fitted model, folded by the symmetry mode."""
+        model, optics = self._model_fit, self.optics
+        args = npt, self.accep, norm
+        per = self._periodicity(model, "fit")
+        if per is None:
+            return to_fu.norm_cutacp(model, lsps, *args, optics=optics)
+        folded, inverse, _ = per.fold_positions(lsps)
+        dic = to_fu.norm_cutacp(model, folded, *args, optics=optics)
+        return {key: val[inverse] for key, val in dic.items()}
+
+    def _fit_histograms(self, l_spos, cutaccep=False):
+        """histgms of the fitted model, folded by the symmetry mode.
+
+        With mc_tolerance set, histgms_adaptive draws batches of num_part
+        / 5 particles until convergence, up to 4 * num_part per position,
+        and mc_samples keeps the particles drawn at each position.
+        """
+        model = self._model_fit
+        per = self._periodicity(model, "fit")
+        if per is not None:
+            folded, inverse, shifts = per.fold_positions(l_spos)
+            histsp, histsn, indices = self._histgms(model, folded, cutaccep)
+            if self.mc_samples is not None:
+                self.mc_samples = self.mc_samples[inverse]
+            return (
+                [histsp[i] for i in inverse],
+                [histsn[i] for i in inverse],
+                indices[inverse] + shifts,
+            )
+        return self._histgms(model, l_spos, cutaccep)
+
+    def _histgms(self, model, l_spos, cutaccep):
+        """Fixed size or adaptive Monte-Carlo densities."""
+        args = self.accep, self.energy_dev_min, cutaccep
+        if self.mc_tolerance is None:
+            self.mc_samples = None
+            return to_fu.histgms(
+                model, l_spos, self.num_part, *args, optics=self.optics
+            )
+        *tup, self.mc_samples = to_fu.histgms_adaptive(
+            model,
+            l_spos,
+            *args,
+            tol=self.mc_tolerance,
+            batch=max(self.num_part // 5, 1),
+            max_part=4 * self.num_part,
+            optics=self.optics,
         )
+        return tuple(tup)
 
-        fdensp, fdensn = dic["fdensp"], dic["fdensn"]
-        deltasp, deltasn = dic["deltasp"], dic["deltasn"]
-
-        _, ax = _plt.subplots(figsize=(10, 5))
-        ax.set_title(
-            "Probability density analytically calculated", fontsize=20
-        )
-        ax.grid(True, alpha=0.5, ls="--", color="k")
-        ax.xaxis.grid(False)
-        ax.set_xlabel(r"$\delta$ [%]", fontsize=25)
-        ax.set_ylabel("PDF", fontsize=25)
-        ax.tick_params(axis="both", labelsize=28)
-
-        for idx, _ in enumerate(spos):
-            array_fdens = fdensp[idx]
-            # pega o primeiro item onde ocorre a condição passada
-            # como argumento para a função numpy.where
-            index = _np.intp(_np.where(array_fdens <= 1e-2)[0][1])
-
-            # this block selects the best index
-            # for plot the density distribution
-            if not idx:
-                best_index = index
-            else:
-                if best_index < index:  # eu não entendi direito porquê disso
-                    best_index = index
-                else:
-                    pass
-
-        for idx, s in enumerate(spos):
-            mod_ind = _np.argmin(_np.abs(spos_ring - s))
-
-            fdenspi = fdensp[idx][:best_index]
-            fdensni = fdensn[idx][:best_index]
-            deltaspi = deltasp[idx][:best_index] * 1e2
-            deltasni = -deltasn[idx][:best_index] * 1e2
-
-            color = _cm.gist_rainbow(idx / len(spos))
-            not_desired = [
-                "calc_mom_accep",
-                "mia",
-                "mib",
-                "mip",
-                "mb1",
-                "mb2",
-                "mc",
-            ]
+    def plot_histograms(self, l_spos=None, hists=None):
+        """Touschek scattering density from Monte-Carlo simulation.
 
-            while self._model_fit[mod_ind].fam_name in not_desired:
-                mod_ind += 1
+        l_spos = desired s positions (list or array).
+        hists  = histgms result, or directory saved by save_histograms,
+                 to plot instead of running the simulation.
+        """
+        if hists is None:
+            tup = self._fit_histograms(l_spos, cutaccep=False)
+        elif isinstance(hists, tuple):
+            tup = hists
+        else:
+            tup = load_histograms(hists)
 
-            fam_name = self._model_fit[mod_ind].fam_name
-            s_stri = _np.round(spos_ring[mod_ind], 2)
-            stri = f"{fam_name} em {s_stri} m"
+        hp, hn, idx_model = tup
 
-            ax.plot(deltaspi, fdenspi, label=stri, color=color)
-            ax.plot(deltasni, fdensni, color=color)
+        _plotting().plot_histograms(
+            self._model_fit, self.spos, hp, hn, idx_model
+        )
 
-        ax.legend(loc="best", fontsize=20)
+    @_prof.timed("tracking")
+    def _get_track_def(self, l_scattered_pos, scrap, vchamber):
+        """Tracking for getting the loss profile along the ring.
 
-    def plot_histograms(self, l_spos):
-        """Touschek scattering density from Monte-Carlo simulation.
+        l_scattered_pos = scattered positions (list or numpy.array).
+        scrap = if True, the vchamber's height will be changed.
+        vchmaber = defines the new vchamber's apperture.
 
-        l_spos = desired s positions (list or array).
+        If self.checkpoint is set, every tracked position is saved as soon
+        as it finishes and positions already saved are not tracked again.
         """
-        s = self.spos
-        accep = self.accep
-        model = self._model_fit
+        all_track = []
+        spos = self.spos
+        indices = [int(_np.argmin(_np.abs(s - spos))) for s in l_scattered_pos]
+
+        state = self.model_state("tracking", vchamber if scrap else None)
+        model = state.model()
+
+        store, key = self.checkpoint, None
+        if store is not None:
+            if not isinstance(store, CheckpointStore):
+                store = CheckpointStore(store)
+            key = store.run_key(
+                state,
+                self._deltas,
+                self.nturns,
+                vchamber if scrap else None,
+            )
 
-        tup = to_fu.histgms(
-            self._model_fit,
-            l_spos,
-            self.num_part,
-            accep,
-            self.energy_dev_min,
-            cutaccep=False,
+        # with the symmetry mode, tracking starts in the first superperiod
+        per = self._periodicity(model, state.fingerprint)
+        folds = [
+            (index, 0) if per is None else per.fold_index(index)
+            for index in indices
+        ]
+        # with clustering, only one position per cluster is tracked
+        clusters = self._clusters(model, [base for base, _ in folds])
+        cache = self.track_cache
+
+        for base, shift in folds:
+            if clusters is not None:
+                base, cshift = clusters.representative(base)
+                shift += cshift
+            ckey = cache.key(state, self._deltas, self.nturns, base, 1)
+            dic = cache.get(ckey)
+            if dic is None and store is not None:
+                dic = store.load(key, base)
+                if dic is not None:
+                    _prof.count("checkpoint_hits")
+            if dic is None:
+                dic = to_fu.track_eletrons_d(
+                    self._deltas, self.nturns, base, model
+                )
+                if store is not None:
+                    store.save(key, base, dic)
+            cache.put(ckey, dic)
+            if clusters is not None:
+                dic = clusters.map_track(dic, shift)
+            elif shift:
+                dic = per.map_track(dic, shift)
+            all_track.append(dic)
+
+        return all_track, indices
+
+    def _clusters(self, model, indices):
+        """PositionClusters of the indices (None if clustering is off)."""
+        if self.cluster_tolerance is None:
+            return None
+        clusters = cluster_positions(
+            self.optics,
+            model,
+            indices,
+            tol=self.cluster_tolerance,
+            ndown=self.cluster_ndown,
         )
+        _prof.count("clustered_positions", len(set(indices)) - len(clusters))
+        return clusters
 
-        hp, hn, idx_model = tup
+    def check_clusters(self, l_scattered_pos=None, nsample=3, npos=500):
+        """Compares clustered tracking with direct tracking.
 
-        fig, ax = _plt.subplots(
-            ncols=len(l_spos), nrows=1, figsize=(30, 10), sharey=True
+        l_scattered_pos = positions to be clustered (None: npos positions
+                          spread along the ring).
+        nsample         = number of non-representative positions whose
+                          mapped tracking is checked.
+        npos            =   number of default positions along the ring.
+
+        Uses cluster_tolerance (0.02 if not set). Returns the number of
+        positions and clusters and, for each checked position, the
+        fraction of particles lost at the same element and turn.
+        """
+        spos = self.spos
+        if l_scattered_pos is None:
+            l_scattered_pos = _np.linspace(0, spos[-1], npos + 2)[1:-1]
+        indices = [int(_np.argmin(_np.abs(s - spos))) for s in l_scattered_pos]
+        model = self.model_state("tracking").model()
+        clusters = cluster_positions(
+            self.optics,
+            model,
+            indices,
+            tol=self.cluster_tolerance or 0.02,
+            ndown=self.cluster_ndown,
         )
-        fig.suptitle(
-            "Probability density calculated by Monte-Carlo simulation",
-            fontsize=20,
+        report = {
+            "positions": clusters.indices.size,
+            "clusters": len(clusters),
+        }
+        report.update(
+            validate_clusters(
+                model, clusters, self._deltas, self.nturns, nsample
+            )
         )
+        return report
 
-        for index, iten in enumerate(idx_model):
-            color = _cm.jet(index / len(idx_model))
-            ay = ax[index]
-            if not index:
-                ay.set_ylabel("PDF", fontsize=25)
+    def aperture_replay(self, index):
+        """ApertureReplay of the particles scattered at element index.
 
-            ay.grid(True, alpha=0.5, ls="--", color="k")
-            ay.xaxis.grid(False)
-            ay.set_xlabel(r"$\delta$ [%]", fontsize=25)
-            ay.tick_params(axis="both", labelsize=18)
-
-            stri = f"{model[iten].fam_name:s}, {s[iten]:.2f}"
-            ay.hist(hp[index], density=True, bins=200, color=color, label=stri)
-            ay.hist(hn[index], density=True, bins=200, color=color)
-            _plt.tight_layout()
-            ay.legend()
+        Records are kept in replays (an LRU limited in bytes), keyed on
+        the lattice without appertures, so they survive scraper changes.
+        """
+        state = self.model_state("replay")
+        key = self.replays.key(state, self._deltas, self.nturns, index)
+        replay = self.replays.get(key)
+        if replay is None:
+            replay = ApertureReplay.record(
+                state.model(), self._deltas, self.nturns, index
+            )
+            self.replays.put(key, replay)
+        return replay
 
-    def _get_track_def(self, l_scattered_pos, scrap, vchamber):
-        """Tracking for getting the loss profile along the ring.
+    def replay_track_def(self, l_scattered_pos, vchamber=None):
+        """Same as _get_track_def, from aperture replays.
 
         l_scattered_pos = scattered positions (list or numpy.array).
-        scrap = if True, the vchamber's height will be changed.
-        vchmaber = defines the new vchamber's apperture.
+        vchamber        = scrapers' apperture (None: nominal appertures).
+
+        Each position is tracked once without vacuum chamber; any other
+        vchamber is then evaluated without tracking. See
+        touschek_pack.replay for the limits of validity.
         """
-        all_track = []
-        indices = []
         spos = self.spos
+        indices = [int(_np.argmin(_np.abs(s - spos))) for s in l_scattered_pos]
+        limits = aperture_limits(
+            self.model_state("tracking").model(),
+            vchamber,
+            self.scraph_inds,
+            self.scrapv_inds,
+        )
+        all_track = [
+            self.aperture_replay(index).first_loss(limits)
+            for index in indices
+        ]
+        return all_track, indices
 
-        self._model.radiation_on = True
-        self._model.cavity_on = True
-        self._model.vchamber_on = True
+    def check_replay(self, l_scattered_pos, vchamber=None):
+        """Compares aperture replay with tracking.
 
-        if scrap:
-            self.set_vchamber_scraper(vchamber)
+        l_scattered_pos = positions to be checked.
+        vchamber        = scrapers' apperture (None: nominal appertures).
 
-        for _, scattered_pos in enumerate(l_scattered_pos):
-            index = _np.argmin(_np.abs(scattered_pos - spos))
-            indices.append(index)
-            dic = to_fu.track_eletrons_d(
-                self._deltas, self.nturns, index, self._model
+        Returns, for each position, the fraction of particles lost at the
+        same element and turn by both computations.
+        """
+        spos = self.spos
+        model = self.model_state("tracking", vchamber).model()
+        return [
+            self.aperture_replay(
+                int(_np.argmin(_np.abs(s - spos)))
+            ).validate(model)
+            for s in l_scattered_pos
+        ]
+
+    def check_periodicity(self, l_scattered_pos=None, nsample=3):
+        """Compares the symmetry mode with full-ring computations.
+
+        l_scattered_pos = positions to be checked (None: nsample positions
+                          spread along the ring).
+
+        Returns the superperiods found for the tracking and fitted models,
+        the agreement of the mapped tracking for each position and the
+        largest relative difference of the folded loss densities.
+        """
+        spos = self.spos
+        if l_scattered_pos is None:
+            l_scattered_pos = _np.linspace(0, spos[-1], nsample + 2)[1:-1]
+        indices = [int(_np.argmin(_np.abs(s - spos))) for s in l_scattered_pos]
+        state = self.model_state("tracking")
+        model = state.model()
+        report = {"positions": list(l_scattered_pos)}
+
+        per = self._periodicity(model, state.fingerprint)
+        report["tracking_periods"] = 1 if per is None else per.nperiods
+        if per is not None:
+            report.update(
+                validate_tracking(
+                    model, per, self._deltas, self.nturns, indices
+                )
             )
-            all_track.append(dic)
 
-        hx = self._model_fit[self.scraph_inds[0]].hmax
-        hn = self._model_fit[self.scraph_inds[0]].hmin
-        vx = self._model_fit[self.scrapv_inds[0]].vmax
-        vn = self._model_fit[self.scrapv_inds[0]].vmin
-        vchamber = [hx, hn, vx, vn]
+        per = self._periodicity(self._model_fit, "fit")
+        report["fit_periods"] = 1 if per is None else per.nperiods
+        if per is not None:
+            full = to_fu.norm_cutacp(
+                self._model_fit,
+                l_scattered_pos,
+                5000,
+                self.accep,
+                optics=self.optics,
+            )
+            folded = self._fit_densities(l_scattered_pos, 5000)
+            report["density_residual"] = max(
+                _np.nanmax(
+                    _np.abs(folded[key] - full[key])
+                    / _np.maximum(_np.abs(full[key]).max(), 1e-30)
+                )
+                for key in ("fdensp", "fdensn")
+            )
+        return report
 
-        self.set_vchamber_scraper(vchamber)
+    def _rate_nom_lattice(self):
+        """Touschek scattering rate interpolated at every element."""
+        return self.optics.elements_rate
 
-        return all_track, indices
+    def _track_lossrate(self, dic):
+        """Loss probability at each lost position for one tracking.
 
-    def _concat_track_lossrate(self, l_scattered_pos, scrap, vchamber):
+        dic = tracking dictionary given by track_eletrons_d.
+        """
+        return to_fu.track_lossrate(self.spos, dic)
+
+    def _concat_track_lossrate(
+        self, l_scattered_pos, scrap, vchamber, profile=None
+    ):
         # não consegui resolvero erro que o ruff indicou nessa função
-        """Generating the data for the plot."""
+        """Generating the data for the plot.
+
+        profile = LossProfile updated as each scattering position finishes.
+        """
         all_track, indices = self._get_track_def(
             l_scattered_pos, scrap, vchamber
         )
         spos = self.spos
-        fact = 0.03
-
-        tous_rate = self.ltime.touschek_data["rate"]  # scattering rate
+        rate_nom_lattice = self._rate_nom_lattice()
         prob, lostp, all_lostp = [], [], []
 
-        # comentar os dois métodos implementados.
-        # um deles parece ser mais rápido.
-        # for j, single_track in enumerate(all_track):
         for j, dic in enumerate(all_track):
             index = indices[j]
-
-            lostinds = dic["element_lost"]
-            deltas = dic["energy_deviation"]
-
-            # lostinds = _np.zeros(len(single_track))
-            # deltas = _np.zeros(len(single_track))
-            # for idx, iten in enumerate(single_track):
-            #     _, ellost, delta = iten
-            #     lostinds[idx] = ellost
-            #     deltas[idx] = delta
-            # lostinds = _np.intp(lostinds)
-
-            lost_positions = _np.round(spos[lostinds], 2)
-
-            step = int((deltas[0] + deltas[-1]) / fact)
-            itv_track = _np.linspace(deltas[0], deltas[-1], step)
-
-            data = _pd.DataFrame({"lost_pos_by_tracking": lost_positions})
-            # dataframe that storages the tracking data
-            lost_pos_column = (
-                data.groupby("lost_pos_by_tracking").groups
-            ).keys()
-            data = _pd.DataFrame({"lost_pos_by_tracking": lost_pos_column})
-            # this step agroups the lost_positions
-
-            itv_delta = []
-            for current, next_iten in zip(itv_track, itv_track[1:]):
-                stri = f"{current*1e2:.2f} % < delta < {next_iten*1e2:.2f} %"
-                data[stri] = _np.zeros(len(list(lost_pos_column)))  # this step
-                # creates new columns in the dataframe and fill with zeros
-
-                itv_delta.append((current, next_iten))
-                # Next step must calculate each matrix element from the
-                # dataframe
-
-            var = list(data.index)
-            if var == lost_pos_column:
-                pass
-            else:
-                data = data.set_index("lost_pos_by_tracking")
-
-            for idx, lost_pos in enumerate(lost_positions):  # essas duas
-                # estruturas de repetição são responsáveis por calcular
-                # o percentual dos eletrons que possuem um determinado desvio
-                # de energia e se perdem em um intervalo de desvio de energia
-                # específico
-                delta = deltas[idx]
-                # lps = []
-                for i, interval in enumerate(itv_delta):
-                    if not i:  # subtle difference: <= in first iteraction
-                        if interval[0] <= delta <= interval[1]:
-                            stri = f"{interval[0]*1e2:.2f} % < delta < {interval[1]*1e2:.2f} %"
-                            data.loc[lost_pos, stri] += 1
-
-                    else:
-                        if interval[0] < delta <= interval[1]:
-                            stri = f"{interval[0]*1e2:.2f} % < delta < {interval[1]*1e2:.2f} %"
-                            data.loc[lost_pos, stri] += 1
-
-            data = data / len(deltas)
-
-            npt = int((spos[-1] - spos[0]) / 0.1)
-
-            scalc = _np.linspace(spos[0], spos[-1], npt)
-            rate_nom_lattice = _np.interp(spos, scalc, tous_rate)
-
-            lost_pos_df = []
-            part_prob = []
-            # Calculates the loss probablity by tracking
-            for indx, iten in data.iterrows():
-                t_prob = 0
-                for idx, m in enumerate(iten):
-                    t_prob += m
-                    if idx == iten.count() - 1:
-                        # appends the probability after sum
-                        part_prob.append(t_prob)
-                        lost_pos_df.append(indx)
-
-            lost_pos_df = _np.array(lost_pos_df)
-            part_prob = _np.array(part_prob)
+            lost_pos_df, part_prob = self._track_lossrate(dic)
 
             # Calculates the absolute probability for electron loss
             # by touschek scattering rate
             prob.append(part_prob * rate_nom_lattice[index])
             lostp.append(lost_pos_df)
+            if profile is not None:
+                profile.add(spos[index], lost_pos_df, prob[-1])
 
             # Aqui eu pego as posições em que os elétrons foram perdidos
             # e armazeno todas em uma grande lista sem repetição de qualquer
@@ -578,11 +1130,11 @@ class TousAnalysis:
 
         return all_lostp, prob, lostp
 
-    def _f_scat_table(self, l_scattered_pos, scrap, vchamber):
+    def _f_scat_table(self, l_scattered_pos, scrap, vchamber, profile=None):
         """Generates the heat map of loss positions."""
         dic_res = {}
         all_lostp, prob, lostp = self._concat_track_lossrate(
-            l_scattered_pos, scrap, vchamber
+            l_scattered_pos, scrap, vchamber, profile
         )
         n_scat = _np.round(l_scattered_pos, 2)
 
@@ -612,10 +1164,13 @@ class TousAnalysis:
         return dic_res
 
     def get_scat_dict(
-        self, l_scattered_pos, reording_key, scrap, vchamber
+        self, l_scattered_pos, reording_key, scrap, vchamber, profile=None
     ):
-        """Get the reordered dictionary."""
-        dic = self._f_scat_table(l_scattered_pos, scrap, vchamber)
+        """Get the reordered dictionary.
+
+        profile = optional LossProfile, kept up to date during the tracking.
+        """
+        dic = self._f_scat_table(l_scattered_pos, scrap, vchamber, profile)
 
         zip_tuples = zip(*[dic[chave] for chave in dic])
         new_tuples = sorted(
@@ -630,41 +1185,94 @@ class TousAnalysis:
 
         return new_dict
 
-    def get_loss_profile(self, dic):
-        """Integrates the lost positions for all scattering points.
+    def scraper_sweep(
+        self, l_scattered_pos, vchambers, processes=None, replay=False
+    ):
+        """Loss maps for many scrapers' appertures evaluated concurrently.
 
-        dic = cointains the lost positions and the scattered points.
+        l_scattered_pos = scattered positions (list or numpy.array).
+        vchambers       = list of appertures (hmin, hmax, vmin, vmax).
+        processes       =  number of worker processes (None: all cores).
+        replay          = if True, settings are evaluated from aperture
+                          replays (see replay_track_def) instead of
+                          being tracked.
+
+        The Touschek rate along the ring does not depend on the scrapers
+        and is computed once. Returns one dictionary per setting with the
+        tracking results, the LossProfile and the fraction of the loss
+        rate lost at the horizontal and vertical scrapers. Each lost
+        position is weighted by the loss rate put in the profile.
         """
         spos = self.spos
+        indices = [_np.argmin(_np.abs(pos - spos)) for pos in l_scattered_pos]
+        rate_nom_lattice = self._rate_nom_lattice()
+        # lost positions are rounded as in _track_lossrate
+        scrap_h = _np.round(spos[self.scraph_inds], 2)
+        scrap_v = _np.round(spos[self.scrapv_inds], 2)
+
+        if replay:
+            tracks = [
+                self.replay_track_def(l_scattered_pos, vch)[0]
+                for vch in vchambers
+            ]
+        else:
+            tracks = to_par.scraper_sweep(
+                self.model_state("tracking"),
+                vchambers,
+                self._deltas,
+                self.nturns,
+                indices,
+                (self.scraph_inds, self.scrapv_inds),
+                processes=processes,
+            )
 
-        df = _pd.DataFrame(dic)
-        a = df.set_index("lost_positions")
-
-        scat_pos = _np.array(a.columns, dtype=float)
+        results = []
+        for vchamber, all_track in zip(vchambers, tracks):
+            profile = LossProfile()
+            lost_h, lost_v, lost_all = 0.0, 0.0, 0.0
+            for index, dic in zip(indices, all_track):
+                lost_pos_df, part_prob = self._track_lossrate(dic)
+                rates = part_prob * rate_nom_lattice[index]
+                profile.add(spos[index], lost_pos_df, rates)
+
+                lost_pos_df = _np.asarray(lost_pos_df, dtype=float)
+                lost_all += rates.sum()
+                lost_h += rates[_np.isin(lost_pos_df, scrap_h)].sum()
+                lost_v += rates[_np.isin(lost_pos_df, scrap_v)].sum()
+
+            lost_all = lost_all or 1.0
+            results.append(
+                {
+                    "vchamber": vchamber,
+                    "tracks": all_track,
+                    "indices": indices,
+                    "profile": profile,
+                    "hscraper_fraction": lost_h / lost_all,
+                    "vscraper_fraction": lost_v / lost_all,
+                    "scraper_fraction": (lost_h + lost_v) / lost_all,
+                }
+            )
+        return results
 
-        indices = []
-        for iten in scat_pos:
-            ind = _np.argmin(_np.abs(spos - iten))
-            indices.append(ind)
+    def get_loss_accumulator(self, dic):
+        """Builds a LossProfile from a scattering dictionary.
 
-        summed = []
-        for idx, _ in a.iterrows():
-            sum_row = scyint.trapz(a.loc[idx], spos[indices])
-            summed.append(sum_row)
+        dic = cointains the lost positions and the scattered points (dict,
+        ScatTable or directory saved by save_scat_table).
+        """
+        return LossProfile.from_scat_dict(as_scat_table(dic), self.spos)
 
-        _, ax = _plt.subplots(
-            figsize=(13, 7), gridspec_kw={"hspace": 0.2, "wspace": 0.2}
-        )
-        ax.set_title("loss rate integral along the ring", fontsize=16)
+    def get_loss_profile(self, dic):
+        """Integrates the lost positions for all scattering points.
 
-        ax.set_xlabel("lost position [m]", fontsize=16)
-        ax.set_ylabel("loss rate [1/s]", fontsize=16)
-        ax.tick_params(axis="both", labelsize=16)
+        dic = cointains the lost positions and the scattered points, or a
+        LossProfile already accumulated.
+        """
+        if not isinstance(dic, LossProfile):
+            dic = self.get_loss_accumulator(dic)
+        lost_pos, summed = dic.profile()
 
-        ax.plot(list(a.index), summed, color="navy")
-        _pyaccel.graphics.draw_lattice(
-            self._model_fit, offset=-1e-6, height=1e-6, gca=True
-        )
+        _plotting().plot_loss_profile(self._model_fit, lost_pos, summed)
 
     def get_loss_profilel(self, l_dic):
         """Comparing distinct loss profiles.
@@ -673,59 +1281,19 @@ class TousAnalysis:
         """
         lista = []
         for dic in l_dic:
-            s = self.spos
-
-            df = _pd.DataFrame(dic)
-            a = df.set_index("lost_positions")
-
-            scat_pos = _np.array(a.columns, dtype=float)
-
-            indices = []
-            for iten in scat_pos:
-                ind = _np.argmin(_np.abs(s - iten))
-                indices.append(ind)
-
-            summed = []
-            for idx, _ in a.iterrows():
-                sum_row = scyint.trapz(a.loc[idx], s[indices])
-                summed.append(sum_row)
-
-            lista.append((a.index, summed))
+            if not isinstance(dic, LossProfile):
+                dic = self.get_loss_accumulator(dic)
+            lista.append(dic.profile())
 
         return lista
 
-    def plot_scat_dict(self, new_dic):
+    def plot_scat_dict(self, new_dic, max_pixels=1000):
         """Heatmap plot indicating the warm points of loss along the ring.
 
-        new_dic = contains the reordered dict with lost positions and
-        scattered points.
+        new_dic    = contains the reordered dict with lost positions and
+                     scattered points (or a ScatTable or a directory saved
+                     by save_scat_table).
+        max_pixels = largest number of pixels along each axis.
         """
-        s = self.spos
-
-        df = _pd.DataFrame(new_dic)
-        df = df.set_index("lost_positions")
-
-        val = df.values.copy()
-        idx = val != 0.0
-        val[idx] = _np.log10(val[idx])
-        val[~idx] = val[idx].min()
-
-        fig, ax = _plt.subplots(figsize=(10, 10))
-
-        y = _np.linspace(0, s[-1], df.shape[0] + 1)
-        x = _np.linspace(0, s[-1], df.shape[1] + 1)
-        x_mesh, y_mesh = _np.meshgrid(x, y)
-
-        heatmp = ax.pcolor(x_mesh, y_mesh, val, cmap="jet", shading="flat")
-
-        cbar = _plt.colorbar(heatmp)
-        cbar.set_label("Loss rate [1/s] in logarithmic scale", rotation=90)
-
-        ax.set_title("Loss profile", fontsize=16)
-
-        ax.set_xlabel("scattered positions [m]", fontsize=16)
-        ax.set_ylabel("lost positions [m]", fontsize=16)
-
-        fig.tight_layout()
-        _plt.gca().set_aspect("equal")
-        _plt.show()
+        table = as_scat_table(new_dic)
+        _plotting().plot_scat_dict(self.spos, table, max_pixels)
@@ -0,0 +1,83 @@
+"""LRU cache of tracking results shared by the analyses."""
+import collections as _collections
+import hashlib as _hashlib
+
+import numpy as _np
+
+import touschek_pack.functions as to_fu
+from touschek_pack import profiling as _prof
+
+
+class TrackCache:
+    """Tracking dictionaries of track_eletrons_d kept in LRU order.
+
+    Entries are keyed by element index, energy deviation grid, number of
+    turns, model state and sign of the deviations, so a position tracked
+    once for a plot or a loss map is not tracked again while the model
+    state is unchanged. With both=True a miss tracks the positive and the
+    negative deviations in a single ring_pass batch and keeps both.
+    """
+
+    def __init__(self, maxsize=256):
+        """.
+
+        maxsize = largest number of tracking dictionaries kept.
+        """
+        self.maxsize = maxsize
+        self._data = _collections.OrderedDict()
+
+    def __len__(self):
+        """."""
+        return len(self._data)
+
+    def clear(self):
+        """."""
+        self._data.clear()
+
+    @staticmethod
+    def key(state, deltas, nturns, index, sign):
+        """Returns the cache key of one tracking."""
+        digest = _hashlib.sha1(
+            _np.asarray(deltas, dtype=float).tobytes()
+        ).hexdigest()
+        return (int(index), digest, int(nturns), state.fingerprint, sign)
+
+    def get(self, key):
+        """Returns a cached tracking dictionary or None."""
+        dic = self._data.get(key)
+        if dic is not None:
+            self._data.move_to_end(key)
+            _prof.count("track_cache_hits")
+        return dic
+
+    def put(self, key, dic):
+        """."""
+        self._data[key] = dic
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def track(self, state, deltas, nturns, index, sign=1, both=False):
+        """Tracking of sign * deltas from element index, cached.
+
+        state  =         ModelState used for tracking.
+        deltas = magnitude of the energy deviations.
+        nturns =                   number of turns.
+        index  =     element where the tracking starts.
+        sign   =         +1 or -1, sign of the deviations.
+        both   =   if True, a miss also tracks the opposite sign.
+        """
+        deltas = _np.asarray(deltas, dtype=float)
+        key = self.key(state, deltas, nturns, index, sign)
+        dic = self.get(key)
+        if dic is not None:
+            return dic
+        model = state.model()
+        if both:
+            dics = to_fu.track_eletrons_pm(deltas, nturns, index, model)
+            for sgn, res in zip((1, -1), dics):
+                self.put(self.key(state, deltas, nturns, index, sgn), res)
+            return dics[0] if sign > 0 else dics[1]
+        dic = to_fu.track_eletrons_d(sign * deltas, nturns, index, model)
+        self.put(key, dic)
+        return dic